@@ -15,12 +15,29 @@ import tiktoken
 from markdownify import markdownify as md
 from docx import Document
 from pptx import Presentation
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Dict, Iterator, List, Tuple, Optional
+import os
 import re
-from collections import Counter
+import logging
+from collections import defaultdict
+from itertools import accumulate
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import json
+import posixpath
+import zipfile
+from lxml import etree
 import pdf_inspector
 
+logger = logging.getLogger(__name__)
+
+
+# Versión de la lógica de extracción. Forma parte de la clave de la caché de
+# extracción (material/extraction_cache.py): subirla cada vez que un cambio
+# acá modifique la salida (capítulos, tokens, marcadores de página, páginas
+# escaneadas) para que no se sigan sirviendo resultados de la versión vieja.
+EXTRACTOR_VERSION = 4
+
 
 class DocumentProcessor:
     """
@@ -53,7 +70,10 @@ class DocumentProcessor:
                    remove_footers: bool = True,
                    extract_toc: bool = True,
                    max_pages: Optional[int] = None,
-                   pages_per_block: int = 40) -> Dict:
+                   pages_per_block: int = 40,
+                   parallel_workers: int = 0,
+                   parallel_min_pages: int = 150,
+                   verify_scanned_pages: bool = False) -> Dict:
         """
         Procesa un PDF completo y extrae estructura + contenido limpio.
 
@@ -71,6 +91,17 @@ class DocumentProcessor:
                 (TOC), en vez de tratar todo el documento como un único
                 "capítulo" gigante (imposible de seleccionar por partes),
                 se lo divide en bloques de esta cantidad de páginas.
+            parallel_workers: Cantidad de procesos para extraer el texto de
+                las páginas en paralelo (ver _extract_page_table). 0 o 1 =
+                extracción en serie, como siempre.
+            parallel_min_pages: Por debajo de esta cantidad de páginas se
+                extrae en serie aunque parallel_workers > 1 — levantar los
+                procesos cuesta más de lo que se ahorra en documentos cortos.
+            verify_scanned_pages: Además de clasificar las páginas
+                escaneadas con PyMuPDF (ver _classify_scanned_pages), correr
+                pdf-inspector y loguear en qué páginas no coinciden. El
+                resultado sigue siendo el de PyMuPDF; es para auditar el
+                clasificador, cuesta una segunda lectura del archivo.
 
         Returns:
             Diccionario con estructura:
@@ -91,121 +122,270 @@ class DocumentProcessor:
             'stats': {}
         }
 
-        # Abrir PDF con PyMuPDF
+        for event in self.iter_pdf_chapters(
+            file_path,
+            remove_headers=remove_headers,
+            remove_footers=remove_footers,
+            extract_toc=extract_toc,
+            max_pages=max_pages,
+            pages_per_block=pages_per_block,
+            parallel_workers=parallel_workers,
+            parallel_min_pages=parallel_min_pages,
+            verify_scanned_pages=verify_scanned_pages,
+        ):
+            if event['type'] == 'metadata':
+                result['metadata'] = event['metadata']
+                result['toc'] = event['toc']
+                result['scanned_pages'] = event['scanned_pages']
+            elif event['type'] == 'chapter':
+                result['chapters'].append(event['chapter'])
+            elif event['type'] == 'stats':
+                result['stats'] = event['stats']
+
+        return result
+
+    def iter_pdf_chapters(self, file_path: str,
+                          remove_headers: bool = True,
+                          remove_footers: bool = True,
+                          extract_toc: bool = True,
+                          max_pages: Optional[int] = None,
+                          pages_per_block: int = 40,
+                          parallel_workers: int = 0,
+                          parallel_min_pages: int = 150,
+                          verify_scanned_pages: bool = False) -> Iterator[Dict]:
+        """
+        Variante generadora de process_pdf (mismos argumentos, misma salida
+        armada de a partes): en vez de devolver todo junto al final, va
+        entregando eventos a medida que se extrae el documento, para que la
+        subida pueda mostrar el primer capítulo sin esperar al libro entero
+        (ver upload_and_process_document_stream).
+
+        Eventos, en este orden:
+            {'type': 'metadata', 'metadata': {...}, 'toc': [...],
+             'scanned_pages': [...]}
+            {'type': 'chapter', 'chapter': {...}, 'pages_done': int}  # uno por capítulo
+            {'type': 'stats', 'stats': {...}}
+
+        'pages_done' es hasta qué página física se lleva extraído (para una
+        barra de progreso sobre metadata['total_pages']).
+
+        En modo serie el texto de cada página se extrae recién cuando el
+        capítulo que la contiene lo necesita (_LazyPageTable), y se suelta
+        apenas ese capítulo se entregó: el primer capítulo sale después de
+        leer solo sus páginas, y la memoria no acumula el texto del libro
+        entero. Con extracción en paralelo (ver _extract_page_table) la tabla
+        se arma completa primero — los procesos no pueden ir entregando de a
+        una página — y después se emiten los capítulos.
+
+        Levanta ValueError (igual que process_pdf) en el primer next() si el
+        documento supera max_pages.
+        """
         doc = fitz.open(file_path)
+        try:
+            if max_pages and doc.page_count > max_pages:
+                raise ValueError(
+                    f'El documento tiene {doc.page_count} páginas y supera el máximo permitido '
+                    f'de {max_pages}. Subí solo las páginas o el capítulo que necesitás analizar.'
+                )
+
+            self.stats['total_pages'] = doc.page_count
+
+            metadata = {
+                'title': doc.metadata.get('title', ''),
+                'author': doc.metadata.get('author', ''),
+                'subject': doc.metadata.get('subject', ''),
+                'total_pages': doc.page_count,
+                'format': doc.metadata.get('format', 'PDF')
+            }
 
-        if max_pages and doc.page_count > max_pages:
-            page_count = doc.page_count
+            # Qué páginas son imágenes escaneadas sin texto. PyMuPDF no
+            # distingue "no hay texto" de "está vacía" — antes esas páginas
+            # simplemente desaparecían de los capítulos sin ningún aviso. Se
+            # clasifican con el mismo fitz.Document (ver
+            # _classify_scanned_pages) en vez de que pdf-inspector abra y
+            # parsee el archivo entero otra vez; el texto crudo que haga
+            # falta leer acá queda en `raw_texts` y la tabla de páginas lo
+            # reusa en vez de volver a extraerlo.
+            raw_texts: Dict[int, str] = {}
+            scanned_pages = self._classify_scanned_pages(doc, raw_texts=raw_texts)
+            if verify_scanned_pages:
+                self._verify_scanned_pages(file_path, scanned_pages)
+
+            # Extraer TOC (tabla de contenidos) si existe
+            toc = []
+            if extract_toc:
+                toc = [
+                    {'level': level, 'title': title, 'page': page}
+                    for level, title, page in doc.get_toc()
+                ]
+
+            yield {'type': 'metadata', 'metadata': metadata, 'toc': toc, 'scanned_pages': scanned_pages}
+
+            # Detectar headers/footers repetitivos
+            headers_to_remove = []
+            footers_to_remove = []
+
+            if remove_headers or remove_footers:
+                headers_to_remove, footers_to_remove = self._detect_repetitive_text(
+                    doc, raw_texts=raw_texts,
+                )
+
+            # Texto limpio + número impreso de cada página, extraído una sola
+            # vez y compartido por los tres armados de capítulos de abajo: en
+            # paralelo, la tabla completa; en serie, a demanda.
+            if parallel_workers and parallel_workers > 1 and doc.page_count >= parallel_min_pages:
+                page_table = self._extract_page_table(
+                    doc, file_path, headers_to_remove, footers_to_remove,
+                    parallel_workers=parallel_workers, parallel_min_pages=parallel_min_pages,
+                )
+            else:
+                page_table = _LazyPageTable(doc, headers_to_remove, footers_to_remove,
+                                            raw_texts=raw_texts)
+
+            # Páginas escaneadas: ya no son motivo automático para descartar un
+            # capítulo (ver más abajo) — con la IA de imágenes (Gemini) se puede
+            # generar igual a partir de ellas, así que se mantienen seleccionables.
+            scanned_pages_set = set(scanned_pages)
+
+            # Extraer texto por capítulo si hay TOC, sino por páginas
+            if toc:
+                chapters = self._iter_chapters_from_toc(page_table, toc, scanned_pages_set)
+            elif doc.page_count > pages_per_block:
+                # Sin TOC y documento largo: partirlo en bloques de páginas para
+                # que se pueda seleccionar y generar por partes, en vez de un
+                # único capítulo gigante imposible de procesar de una corrida.
+                chapters = self._iter_chapters_by_page_blocks(page_table, pages_per_block, scanned_pages_set)
+            else:
+                chapters = self._iter_single_chapter(page_table, scanned_pages_set)
+
+            total_chapters = 0
+            total_tokens = 0
+            pages_done = 0
+            for chapter in chapters:
+                total_chapters += 1
+                total_tokens += chapter['tokens']
+                pages_done = max(pages_done, chapter['pages'][-1] if chapter['pages'] else 0)
+                yield {'type': 'chapter', 'chapter': chapter, 'pages_done': pages_done}
+                if isinstance(page_table, _LazyPageTable):
+                    # Capítulos de un TOC ordenado no vuelven atrás; si uno
+                    # desordenado lo hace, la página se vuelve a extraer.
+                    page_table.release_before(pages_done)
+
+            # Calcular stats finales
+            yield {'type': 'stats', 'stats': {
+                'total_pages': doc.page_count,
+                'total_chapters': total_chapters,
+                'total_tokens': total_tokens,
+                'removed_headers': self.stats['removed_headers'],
+                'removed_footers': self.stats['removed_footers']
+            }}
+        finally:
             doc.close()
-            raise ValueError(
-                f'El documento tiene {page_count} páginas y supera el máximo permitido '
-                f'de {max_pages}. Subí solo las páginas o el capítulo que necesitás analizar.'
-            )
 
-        # Extraer metadata
-        result['metadata'] = {
-            'title': doc.metadata.get('title', ''),
-            'author': doc.metadata.get('author', ''),
-            'subject': doc.metadata.get('subject', ''),
-            'total_pages': doc.page_count,
-            'format': doc.metadata.get('format', 'PDF')
+    def _iter_single_chapter(self, page_table, scanned_pages: set) -> Iterator[Dict]:
+        """
+        Sin TOC y documento corto: un solo capítulo alcanza. Se extrae
+        directo por página (una sola pasada sobre el PDF) para poder
+        incrustar los marcadores de página.
+        """
+        doc_pages = [page_num + 1 for page_num in range(len(page_table))]
+        doc_printed_pages = []
+        page_texts = []
+        for page_num in range(len(page_table)):
+            printed, text = page_table[page_num]
+            doc_printed_pages.append(printed)
+            page_texts.append(text)
+
+        # Mismo criterio que _iter_chapters_from_toc/_iter_chapters_by_page_
+        # blocks: un documento entero sin texto SE DESCARTA solo si tampoco
+        # es escaneado (ej. página realmente vacía) — ver
+        # [[project_fotosintesis_prompt_leak]]. Si es escaneado, se
+        # mantiene: la IA de imágenes puede generar a partir de ahí.
+        # Chequeado antes de los marcadores de página, que no son texto real.
+        has_text = bool(''.join(page_texts).strip())
+        all_scanned = bool(doc_pages) and set(doc_pages).issubset(scanned_pages)
+        if not has_text and not all_scanned:
+            return
+
+        content = self._join_pages_with_markers(doc_pages, page_texts)
+        yield {
+            'title': 'Documento completo',
+            'content': content,
+            'tokens': self.count_tokens(content),
+            'pages': doc_pages,
+            'printed_pages': doc_printed_pages,
         }
 
-        self.stats['total_pages'] = doc.page_count
-
-        # Chequeo rápido (~0.2s incluso en libros de 600 páginas, ver
-        # [[project_pdf_inspector_evaluation]]) de qué páginas son imágenes
-        # escaneadas sin texto. PyMuPDF no distingue "no hay texto" de
-        # "está vacía" — antes esas páginas simplemente desaparecían de los
-        # capítulos sin ningún aviso. Best-effort: si pdf-inspector falla
-        # con este archivo, seguimos con la extracción normal sin el aviso.
-        result['scanned_pages'] = self._detect_scanned_pages(file_path)
-        
-        # Extraer TOC (tabla de contenidos) si existe
-        if extract_toc:
-            toc = doc.get_toc()
-            result['toc'] = [
-                {'level': level, 'title': title, 'page': page}
-                for level, title, page in toc
-            ]
-        
-        # Detectar headers/footers repetitivos
-        headers_to_remove = []
-        footers_to_remove = []
+    # Una página se considera escaneada si tiene menos texto extraíble que
+    # esto (en caracteres, sin espacios a los costados)...
+    _SCANNED_MAX_TEXT_CHARS = 50
+    # ...y sus imágenes cubren al menos esta fracción del área de la página.
+    _SCANNED_MIN_IMAGE_COVERAGE = 0.5
 
-        if remove_headers or remove_footers:
-            headers_to_remove, footers_to_remove = self._detect_repetitive_text(doc)
-        
-        # Páginas escaneadas: ya no son motivo automático para descartar un
-        # capítulo (ver más abajo) — con la IA de imágenes (Gemini) se puede
-        # generar igual a partir de ellas, así que se mantienen seleccionables.
-        scanned_pages_set = set(result['scanned_pages'])
-
-        # Extraer texto por capítulo si hay TOC, sino por páginas
-        if result['toc'] and len(result['toc']) > 0:
-            result['chapters'] = self._extract_chapters_from_toc(
-                doc, result['toc'], headers_to_remove, footers_to_remove, scanned_pages_set
-            )
-        elif doc.page_count > pages_per_block:
-            # Sin TOC y documento largo: partirlo en bloques de páginas para
-            # que se pueda seleccionar y generar por partes, en vez de un
-            # único capítulo gigante imposible de procesar de una corrida.
-            result['chapters'] = self._extract_chapters_by_page_blocks(
-                doc, headers_to_remove, footers_to_remove, pages_per_block, scanned_pages_set
-            )
-        else:
-            # Sin TOC y documento corto: un solo capítulo alcanza. Se
-            # extrae directo por página (una sola pasada sobre el PDF)
-            # para poder incrustar los marcadores de página.
-            doc_pages = []
-            doc_printed_pages = []
-            page_texts = []
-            for page_num in range(doc.page_count):
-                raw_text = doc[page_num].get_text()
-                doc_pages.append(page_num + 1)
-                doc_printed_pages.append(self._detect_printed_page_number(raw_text))
-                text = self._remove_repetitive_patterns(raw_text, headers_to_remove, footers_to_remove)
-                page_texts.append(text.strip())
-
-            # Mismo criterio que _extract_chapters_from_toc/_extract_chapters_
-            # by_page_blocks: un documento entero sin texto SE DESCARTA solo si
-            # tampoco es escaneado (ej. página realmente vacía) — ver
-            # [[project_fotosintesis_prompt_leak]]. Si es escaneado, se
-            # mantiene: la IA de imágenes puede generar a partir de ahí.
-            # Chequeado antes de los marcadores de página, que no son texto real.
-            has_text = bool(''.join(page_texts).strip())
-            all_scanned = bool(doc_pages) and set(doc_pages).issubset(scanned_pages_set)
-            if not has_text and not all_scanned:
-                result['chapters'] = []
-            else:
-                content = self._join_pages_with_markers(doc_pages, page_texts)
-                result['chapters'] = [{
-                    'title': 'Documento completo',
-                    'content': content,
-                    'tokens': self.count_tokens(content),
-                    'pages': doc_pages,
-                    'printed_pages': doc_printed_pages,
-                }]
-        
-        # Calcular stats finales
-        result['stats'] = {
-            'total_pages': doc.page_count,
-            'total_chapters': len(result['chapters']),
-            'total_tokens': sum(ch['tokens'] for ch in result['chapters']),
-            'removed_headers': self.stats['removed_headers'],
-            'removed_footers': self.stats['removed_footers']
-        }
-        
-        doc.close()
-        return result
+    def _classify_scanned_pages(self, doc: fitz.Document,
+                                raw_texts: Optional[Dict[int, str]] = None) -> List[int]:
+        """
+        Devuelve las páginas (1-indexed) que son imágenes escaneadas sin
+        texto extraíble: poco texto y una imagen (o varias) tapando buena
+        parte de la página.
+
+        Va de lo más barato a lo más caro, para no leer el texto de páginas
+        que no pueden ser escaneadas:
+        1. Sin imágenes en sus recursos (page.get_images, solo mira el
+           diccionario de la página) -> no es escaneada. Es el caso de casi
+           todas las páginas de un libro de texto.
+        2. Con imágenes: se mide qué fracción de la página cubren las que
+           realmente se dibujan (page.get_image_info). Una figura o un logo
+           no alcanzan -> no es escaneada.
+        3. Cubierta de imágenes: se extrae el texto crudo (y se guarda en
+           `raw_texts`, ver iter_pdf_chapters). Solo es escaneada si casi
+           no tiene texto — un escaneo con capa OCR se extrae normal.
+
+        Nunca levanta excepción: una página que PyMuPDF no puede analizar
+        simplemente no se marca.
+        """
+        scanned = []
+        for page_num in range(doc.page_count):
+            try:
+                page = doc[page_num]
+                if not page.get_images():
+                    continue
+                if self._image_coverage(page) < self._SCANNED_MIN_IMAGE_COVERAGE:
+                    continue
+                text = raw_texts.get(page_num) if raw_texts is not None else None
+                if text is None:
+                    text = page.get_text()
+                    if raw_texts is not None:
+                        raw_texts[page_num] = text
+                if len(text.strip()) < self._SCANNED_MAX_TEXT_CHARS:
+                    scanned.append(page_num + 1)
+            except Exception as exc:
+                logger.debug(f'No se pudo clasificar la página {page_num + 1}: {exc}')
+        return scanned
+
+    @staticmethod
+    def _image_coverage(page: fitz.Page) -> float:
+        """Fracción (0-1) del área de la página cubierta por imágenes. Las
+        superposiciones se suman (puede sobreestimar), con tope en 1."""
+        page_area = abs(page.rect)
+        if not page_area:
+            return 0.0
+        covered = sum(
+            abs(fitz.Rect(info['bbox']) & page.rect)
+            for info in page.get_image_info()
+        )
+        return min(1.0, covered / page_area)
 
     def _detect_scanned_pages(self, file_path: str) -> List[int]:
         """
         Devuelve las páginas (1-indexed) que pdf-inspector clasifica como
         escaneadas/sin texto extraíble. Nunca levanta excepción: ante
         cualquier error (archivo atípico, versión de pdf-inspector distinta,
-        etc.) devuelve lista vacía y la extracción sigue con PyMuPDF como
-        si este chequeo no existiera.
+        etc.) devuelve lista vacía.
+
+        Ya no se usa en la extracción normal (ver _classify_scanned_pages):
+        queda como referencia para verify_scanned_pages y
+        scripts/bench_scanned_detection.py.
         """
         try:
             detection = pdf_inspector.detect_pdf(file_path)
@@ -213,81 +393,257 @@ class DocumentProcessor:
         except Exception:
             return []
 
+    def _verify_scanned_pages(self, file_path: str, scanned_pages: List[int]) -> None:
+        """Compara la clasificación de PyMuPDF con la de pdf-inspector y
+        loguea las páginas en que difieren."""
+        reference = set(self._detect_scanned_pages(file_path))
+        ours = set(scanned_pages)
+        if reference == ours:
+            return
+        logger.warning(
+            f'Páginas escaneadas de {os.path.basename(file_path)}: el clasificador '
+            f'de PyMuPDF difiere de pdf-inspector — solo PyMuPDF: {sorted(ours - reference)}, '
+            f'solo pdf-inspector: {sorted(reference - ours)}'
+        )
+
+    # Páginas que se leen para detectar headers/footers: todas en documentos
+    # de hasta este tamaño, y en los más largos una de cada ceil(n / esto)
+    # repartidas por todo el documento (no solo el principio).
+    _RUNNING_HEAD_SAMPLE_PAGES = 120
+    # Un encabezado "de capítulo" (cambia de un capítulo a otro, así que no
+    # llega al threshold global) tiene que aparecer en al menos esta
+    # cantidad de páginas muestreadas seguidas...
+    _RUNNING_HEAD_MIN_RUN = 3
+    # ...donde "seguidas" tolera saltearse una (encabezados que alternan
+    # entre páginas pares e impares: título del libro / del capítulo).
+    _RUNNING_HEAD_MAX_GAP = 2
+    # Al limpiar, los headers/footers detectados solo se buscan entre las
+    # primeras y últimas líneas no vacías de cada página (ver
+    # _remove_repetitive_patterns): en el cuerpo, una línea igual al
+    # encabezado es texto.
+    _RUNNING_HEAD_EDGE_LINES = 3
+
+    _DIGIT_RUN_RE = re.compile(r'\d+')
+
     def _detect_repetitive_text(self, doc: fitz.Document,
-                                threshold: float = 0.7) -> Tuple[List[str], List[str]]:
+                                threshold: float = 0.7,
+                                raw_texts: Optional[Dict[int, str]] = None) -> Tuple[List[str], List[str]]:
         """
         Detecta headers y footers repetitivos.
 
         Reusa el `fitz.Document` ya abierto por process_pdf en vez de abrir
         el PDF de nuevo con pdfplumber: pdfplumber (pdfminer.six por debajo,
         con análisis de layout completo) es notablemente más lento que
-        PyMuPDF para lo mismo, y aquí solo se necesita texto plano de las
-        primeras páginas — no vale la pena una segunda librería ni una
-        segunda apertura del archivo solo para eso.
+        PyMuPDF para lo mismo, y aquí solo se necesita texto plano.
+
+        Mira la primera y la última línea de páginas de todo el documento
+        (ver _RUNNING_HEAD_SAMPLE_PAGES), con los números normalizados —
+        "Capítulo 3 · 47" y "Capítulo 3 · 48" cuentan como la misma línea.
+        Una línea es header/footer si:
+        - aparece en más de `threshold` de las páginas muestreadas (título
+          del libro, "Página N"), o
+        - aparece en una racha de páginas muestreadas seguidas (ver
+          _RUNNING_HEAD_MIN_RUN): el encabezado de un capítulo, que antes
+          se escapaba porque solo se miraban las primeras 10 páginas. Un
+          título de sección que abre varias páginas sueltas del libro
+          ("1. RESULTADOS" en cada capítulo) no forma racha y se conserva.
 
         Args:
             doc: Documento PyMuPDF ya abierto
             threshold: Porcentaje de páginas donde debe aparecer para considerarse repetitivo (0-1)
+            raw_texts: Si se pasa un dict {página 0-based: texto crudo}, se
+                usan las páginas que ya traiga y se le agregan las leídas acá,
+                para no extraerlas dos veces (ver _LazyPageTable).
 
         Returns:
-            Tupla (headers, footers) con listas de textos a eliminar
+            Tupla (headers, footers) con listas de textos a eliminar. Los
+            dígitos de cada texto valen como "cualquier número" al limpiar
+            (ver _compile_line_filter).
         """
-        headers = []
-        footers = []
-
         total_pages = doc.page_count
         if total_pages == 0:
             return [], []
 
-        # Recolectar primeras/últimas líneas de cada página
-        top_lines = []
-        bottom_lines = []
-
-        for page_num in range(min(10, total_pages)):  # Samplear primeras 10 páginas
-            text = doc[page_num].get_text()
+        stride = max(1, -(-total_pages // self._RUNNING_HEAD_SAMPLE_PAGES))
+
+        # Línea normalizada -> posiciones (en la muestra) donde aparece, y
+        # el primer texto real visto para ella.
+        top_positions = defaultdict(list)
+        bottom_positions = defaultdict(list)
+        originals: Dict[str, str] = {}
+        sampled = 0
+
+        for position, page_num in enumerate(range(0, total_pages, stride)):
+            text = raw_texts.get(page_num) if raw_texts is not None else None
+            if text is None:
+                text = doc[page_num].get_text()
+                if raw_texts is not None:
+                    raw_texts[page_num] = text
             if not text:
                 continue
 
             lines = text.strip().split('\n')
-            if len(lines) > 0:
-                top_lines.append(lines[0].strip())
+            sampled += 1
+            first = lines[0].strip()
+            key = self._DIGIT_RUN_RE.sub('#', first)
+            top_positions[key].append(position)
+            originals.setdefault(key, first)
             if len(lines) > 1:
-                bottom_lines.append(lines[-1].strip())
+                last = lines[-1].strip()
+                key = self._DIGIT_RUN_RE.sub('#', last)
+                bottom_positions[key].append(position)
+                originals.setdefault(key, last)
+
+        # Identificar repetitivos (aparecen en >threshold% de páginas). Al
+        # menos en dos: en un documento de 1-2 páginas con texto, el
+        # threshold solo daba 0-1 y cualquier primera línea (el título, el
+        # texto entero de la página) contaba como header.
+        min_occurrences = max(2, int(sampled * threshold))
+
+        def repetitive(positions_by_line, min_length):
+            found = []
+            for key, positions in positions_by_line.items():
+                text = originals[key]
+                if len(text) <= min_length or key == '#':
+                    continue  # muy corto, o un número de página solo
+                if len(positions) >= min_occurrences or self._longest_run(positions) >= self._RUNNING_HEAD_MIN_RUN:
+                    found.append((text, len(positions)))
+            return found
 
-        # Contar frecuencias
-        top_counter = Counter(top_lines)
-        bottom_counter = Counter(bottom_lines)
+        headers = []
+        footers = []
+        for text, count in repetitive(top_positions, 5):  # Mín 5 chars
+            headers.append(text)
+            self.stats['removed_headers'] += count * stride
+        for text, count in repetitive(bottom_positions, 3):
+            footers.append(text)
+            self.stats['removed_footers'] += count * stride
 
-        # Identificar repetitivos (aparecen en >threshold% de páginas)
-        min_occurrences = int(len(top_lines) * threshold)
+        return headers, footers
 
-        for text, count in top_counter.items():
-            if count >= min_occurrences and len(text) > 5:  # Mín 5 chars
-                headers.append(text)
-                self.stats['removed_headers'] += count
+    @classmethod
+    def _longest_run(cls, positions: List[int]) -> int:
+        """Largo de la racha más larga de posiciones (crecientes) separadas
+        por a lo sumo _RUNNING_HEAD_MAX_GAP."""
+        longest = run = 1 if positions else 0
+        for previous, current in zip(positions, positions[1:]):
+            run = run + 1 if current - previous <= cls._RUNNING_HEAD_MAX_GAP else 1
+            longest = max(longest, run)
+        return longest
+
+    @classmethod
+    def _compile_line_filter(cls, headers: List[str],
+                             footers: List[str]) -> Callable[[str, bool], bool]:
+        """
+        Arma, una vez por documento, la función que decide si una línea
+        (ya sin espacios a los costados) es un header, un footer o un
+        número de página solitario. El segundo argumento dice si la línea
+        está en el borde de la página (ver _RUNNING_HEAD_EDGE_LINES): fuera
+        de los bordes solo se sacan números de página solitarios.
+
+        Todos los headers van en una sola regex y todos los footers en otra,
+        en vez de probar la línea contra cada uno. La línea tiene que ser
+        entera el header/footer (fullmatch): cada corrida de dígitos se
+        compila como \\d+, para que el encabezado "Capítulo 3 · 47"
+        detectado en una página también limpie el "Capítulo 3 · 48" de la
+        siguiente, y con un match de prefijo eso cortaba también líneas del
+        cuerpo como "Capítulo 3 · 12 ejercicios resueltos".
+        """
+        def alternation(texts):
+            return '|'.join(
+                cls._DIGIT_RUN_RE.sub(lambda _m: r'\d+', re.escape(text))
+                for text in sorted(set(texts), key=len, reverse=True)
+            )
 
-        for text, count in bottom_counter.items():
-            if count >= min_occurrences and len(text) > 3:
-                # Ignorar números de página simples
-                if not re.match(r'^\d+$', text):
-                    footers.append(text)
-                    self.stats['removed_footers'] += count
+        header_re = re.compile(f'(?:{alternation(headers)})') if headers else None
+        footer_re = re.compile(f'(?:{alternation(footers)})') if footers else None
+        page_number_re = cls._DIGIT_RUN_RE
 
-        return headers, footers
-    
-    def _extract_chapters_from_toc(self, doc: fitz.Document,
-                                   toc: List[Dict],
-                                   headers: List[str],
-                                   footers: List[str],
-                                   scanned_pages: Optional[set] = None) -> List[Dict]:
+        def is_repetitive_line(line: str, at_edge: bool = True) -> bool:
+            if page_number_re.fullmatch(line):
+                return True
+            return at_edge and bool(
+                (header_re is not None and header_re.fullmatch(line))
+                or (footer_re is not None and footer_re.fullmatch(line))
+            )
+
+        return is_repetitive_line
+
+    @classmethod
+    def _process_page_text(cls, raw_text: str,
+                           is_repetitive_line: Callable[[str, bool], bool]) -> Tuple[Optional[int], str]:
+        """
+        Lo que se hace con el texto crudo de cada página, igual en serie que
+        en paralelo: (número impreso detectado, texto limpio sin headers/
+        footers). Un solo lugar para que ambos caminos den la misma salida
+        byte a byte. `is_repetitive_line` sale de _compile_line_filter.
+        """
+        printed = cls._detect_printed_page_number(raw_text)
+        text = cls._remove_repetitive_patterns(raw_text, is_repetitive_line)
+        return printed, text.strip()
+
+    def _extract_page_table(self, doc: fitz.Document, file_path: str,
+                            headers: List[str],
+                            footers: List[str],
+                            parallel_workers: int = 0,
+                            parallel_min_pages: int = 150) -> List[Tuple[Optional[int], str]]:
+        """
+        Extrae (número impreso, texto limpio) de todas las páginas, indexado
+        por página física 0-based.
+
+        Con parallel_workers > 1 y al menos parallel_min_pages páginas, el
+        rango se reparte en tramos contiguos entre procesos (cada uno abre su
+        propio fitz.Document — no se puede compartir entre procesos) y los
+        resultados se rearman en orden de página. Los procesos se lanzan con
+        'spawn' y no con fork: el worker de gunicorn corre con varios threads
+        y hacer fork de un proceso con threads vivos puede heredar locks
+        tomados. Si el pool falla por cualquier motivo, se cae a la
+        extracción en serie — más lenta, pero misma salida.
+        """
+        page_count = doc.page_count
+        if parallel_workers and parallel_workers > 1 and page_count >= parallel_min_pages:
+            # Más tramos que procesos para repartir mejor la carga: páginas
+            # escaneadas (sin texto) se resuelven casi gratis y dejarían
+            # ocioso a un proceso con un único tramo grande de ellas.
+            slice_size = max(1, -(-page_count // (parallel_workers * 4)))
+            ranges = [
+                (start, min(start + slice_size, page_count))
+                for start in range(0, page_count, slice_size)
+            ]
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=parallel_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                ) as pool:
+                    parts = pool.map(
+                        _extract_page_range,
+                        [file_path] * len(ranges),
+                        [start for start, _end in ranges],
+                        [end for _start, end in ranges],
+                        [headers] * len(ranges),
+                        [footers] * len(ranges),
+                    )
+                    return [page for part in parts for page in part]
+            except Exception as e:
+                logger.warning(f'Extracción paralela de páginas falló ({e}); se sigue en serie.')
+
+        is_repetitive_line = self._compile_line_filter(headers, footers)
+        return [
+            self._process_page_text(doc[page_num].get_text(), is_repetitive_line)
+            for page_num in range(page_count)
+        ]
+
+    def _iter_chapters_from_toc(self, page_table,
+                                toc: List[Dict],
+                                scanned_pages: Optional[set] = None) -> Iterator[Dict]:
         """
         Extrae contenido organizado por capítulos según TOC.
         Detecta automáticamente el nivel más granular: si un nivel-1 tiene
         hijos en nivel-2, usa esos hijos como capítulos (con prefijo de la
         parte). Si un nivel-1 no tiene hijos, lo considera capítulo directo.
         """
-        chapters = []
         scanned_pages = scanned_pages or set()
+        page_count = len(page_table)
 
         flat_items = self._flatten_toc_to_chapters(toc)
 
@@ -305,21 +661,20 @@ class DocumentProcessor:
             if i < len(flat_items) - 1:
                 end_page = flat_items[i + 1]['page'] - 1
             else:
-                end_page = doc.page_count
+                end_page = page_count
 
-            end_page = max(start_page + 1, min(end_page, doc.page_count))
+            end_page = max(start_page + 1, min(end_page, page_count))
 
             # Extraer texto de páginas del capítulo
             chapter_text = []
             chapter_pages = []
             chapter_printed_pages = []
             for page_num in range(start_page, end_page):
-                if page_num < doc.page_count:
-                    raw_text = doc[page_num].get_text()
+                if page_num < page_count:
+                    printed, text = page_table[page_num]
                     chapter_pages.append(page_num + 1)
-                    chapter_printed_pages.append(self._detect_printed_page_number(raw_text))
-                    text = self._remove_repetitive_patterns(raw_text, headers, footers)
-                    chapter_text.append(text.strip())
+                    chapter_printed_pages.append(printed)
+                    chapter_text.append(text)
 
             # Sin texto: se descarta como capítulo seleccionable SOLO si
             # tampoco es escaneado (secciones realmente vacías) — generar
@@ -338,29 +693,24 @@ class DocumentProcessor:
 
             content = self._join_pages_with_markers(chapter_pages, chapter_text)
 
-            chapters.append({
+            yield {
                 'title': item['display_title'],
                 'content': content,
                 'tokens': self.count_tokens(content),
                 'pages': chapter_pages,
                 'printed_pages': chapter_printed_pages,
-            })
-
-        return chapters
+            }
 
-    def _extract_chapters_by_page_blocks(self, doc: fitz.Document,
-                                         headers: List[str],
-                                         footers: List[str],
-                                         pages_per_block: int,
-                                         scanned_pages: Optional[set] = None) -> List[Dict]:
+    def _iter_chapters_by_page_blocks(self, page_table,
+                                      pages_per_block: int,
+                                      scanned_pages: Optional[set] = None) -> Iterator[Dict]:
         """
         Divide un PDF sin TOC en bloques consecutivos de páginas, cada uno
         tratado como un "capítulo" seleccionable. Es el equivalente sintético
-        de _extract_chapters_from_toc para documentos sin estructura
+        de _iter_chapters_from_toc para documentos sin estructura
         detectable (muy común en PDFs escaneados/convertidos).
         """
-        chapters = []
-        total_pages = doc.page_count
+        total_pages = len(page_table)
         scanned_pages = scanned_pages or set()
 
         for start_page in range(0, total_pages, pages_per_block):
@@ -370,13 +720,12 @@ class DocumentProcessor:
             block_pages = []
             block_printed_pages = []
             for page_num in range(start_page, end_page):
-                raw_text = doc[page_num].get_text()
+                printed, text = page_table[page_num]
                 block_pages.append(page_num + 1)
-                block_printed_pages.append(self._detect_printed_page_number(raw_text))
-                text = self._remove_repetitive_patterns(raw_text, headers, footers)
-                block_text.append(text.strip())
+                block_printed_pages.append(printed)
+                block_text.append(text)
 
-            # Mismo criterio que _extract_chapters_from_toc: un bloque sin
+            # Mismo criterio que _iter_chapters_from_toc: un bloque sin
             # texto se descarta solo si tampoco es escaneado — si lo es, se
             # mantiene seleccionable porque la IA de imágenes puede generar
             # a partir de esas páginas (chequeado antes de los marcadores de
@@ -388,15 +737,13 @@ class DocumentProcessor:
 
             content = self._join_pages_with_markers(block_pages, block_text)
 
-            chapters.append({
+            yield {
                 'title': f'Páginas {start_page + 1}-{end_page}',
                 'content': content,
                 'tokens': self.count_tokens(content),
                 'pages': block_pages,
                 'printed_pages': block_printed_pages,
-            })
-
-        return chapters
+            }
 
     def _flatten_toc_to_chapters(self, toc: List[Dict]) -> List[Dict]:
         """
@@ -451,33 +798,23 @@ class DocumentProcessor:
         return flat_items
 
     
-    def _remove_repetitive_patterns(self, text: str, 
-                                    headers: List[str], 
-                                    footers: List[str]) -> str:
+    @classmethod
+    def _remove_repetitive_patterns(cls, text: str,
+                                    is_repetitive_line: Callable[[str, bool], bool]) -> str:
         """
-        Elimina patrones repetitivos del texto.
+        Elimina patrones repetitivos del texto (headers, footers y números
+        de página solitarios, según `is_repetitive_line` — ver
+        _compile_line_filter). Headers y footers solo entre las primeras y
+        últimas _RUNNING_HEAD_EDGE_LINES líneas no vacías de la página.
         """
         lines = text.split('\n')
-        cleaned_lines = []
-        
-        for line in lines:
-            line_stripped = line.strip()
-            
-            # Saltar headers
-            if any(line_stripped.startswith(h) or line_stripped == h for h in headers):
-                continue
-            
-            # Saltar footers
-            if any(line_stripped.endswith(f) or line_stripped == f for f in footers):
-                continue
-            
-            # Saltar números de página solitarios
-            if re.match(r'^\d+$', line_stripped):
-                continue
-            
-            cleaned_lines.append(line)
-
-        return '\n'.join(cleaned_lines)
+        stripped = [line.strip() for line in lines]
+        filled = [i for i, line in enumerate(stripped) if line]
+        edge = set(filled[:cls._RUNNING_HEAD_EDGE_LINES]) | set(filled[-cls._RUNNING_HEAD_EDGE_LINES:])
+        return '\n'.join(
+            line for i, line in enumerate(lines)
+            if not is_repetitive_line(stripped[i], i in edge)
+        )
 
     # Patrones conservadores para el número "impreso" de una página (el que
     # el libro muestra en el pie/encabezado, ej. "322"), que puede no
@@ -491,7 +828,8 @@ class DocumentProcessor:
         re.compile(r'^[-–—]?\s*(\d{1,4})\s*[-–—]?$'),
     )
 
-    def _detect_printed_page_number(self, page_text: str) -> Optional[int]:
+    @classmethod
+    def _detect_printed_page_number(cls, page_text: str) -> Optional[int]:
         """
         Busca el número de página impreso en la primera/última línea de una
         página. Devuelve None si no encuentra nada que calce con confianza
@@ -503,7 +841,7 @@ class DocumentProcessor:
             return None
         candidates = [lines[0], lines[-1]] if len(lines) > 1 else [lines[0]]
         for line in candidates:
-            for pattern in self._PRINTED_PAGE_PATTERNS:
+            for pattern in cls._PRINTED_PAGE_PATTERNS:
                 match = pattern.match(line)
                 if match:
                     number = int(match.group(1))
@@ -537,7 +875,13 @@ class DocumentProcessor:
     def process_docx(self, file_path: str) -> Dict:
         """
         Procesa un archivo DOCX y extrae estructura por estilos (Heading 1, 2, etc.).
-        
+
+        Lee los párrafos en streaming desde el zip (ver iter_docx_paragraphs)
+        en vez de cargar el árbol entero de python-docx — en un DOCX de
+        200+ páginas eso era la mayor parte del tiempo y de la memoria. Si
+        el archivo tiene una estructura que la lectura en streaming no
+        contempla, se cae a python-docx, con la misma salida.
+
         Returns:
             Diccionario similar a process_pdf con capítulos organizados
         """
@@ -547,60 +891,59 @@ class DocumentProcessor:
             'full_text': '',
             'stats': {}
         }
-        
-        doc = Document(file_path)
-        
+
+        try:
+            core_properties = read_docx_core_properties(file_path)
+            paragraphs = list(iter_docx_paragraphs(file_path))
+        except Exception as exc:
+            logger.info(f'DOCX {os.path.basename(file_path)}: sin lectura en streaming ({exc}); se usa python-docx.')
+            doc = Document(file_path)
+            core_properties = {
+                'title': doc.core_properties.title or '',
+                'author': doc.core_properties.author or '',
+                'subject': doc.core_properties.subject or '',
+            }
+            paragraphs = [
+                (para.style.name if para.style else None, para.text)
+                for para in doc.paragraphs
+            ]
+
         # Extraer metadata
-        core_props = doc.core_properties
-        result['metadata'] = {
-            'title': core_props.title or '',
-            'author': core_props.author or '',
-            'subject': core_props.subject or '',
-            'total_paragraphs': len(doc.paragraphs)
-        }
-        
-        # Organizar por headings
-        current_chapter = None
-        chapters_list = []
-        
-        for para in doc.paragraphs:
+        result['metadata'] = dict(core_properties, total_paragraphs=len(paragraphs))
+
+        # Organizar por headings: cada capítulo es su título y el rango de
+        # párrafos que tiene debajo; el contenido se arma al final de una
+        # sola vez (concatenar párrafo por párrafo copia el capítulo entero
+        # en cada paso).
+        sections = []
+        for index, (style_name, text) in enumerate(paragraphs):
             # Detectar si es un título (Heading 1)
-            if para.style and para.style.name and para.style.name.startswith('Heading 1'):
-                # Guardar capítulo anterior si existe
-                if current_chapter:
-                    chapters_list.append(current_chapter)
-                
-                # Iniciar nuevo capítulo
-                current_chapter = {
-                    'title': para.text,
-                    'content': '',
-                    'tokens': 0
-                }
-            elif current_chapter:
-                # Añadir contenido al capítulo actual
-                current_chapter['content'] += para.text + '\n\n'
-        
-        # Guardar último capítulo
-        if current_chapter:
-            chapters_list.append(current_chapter)
+            if style_name and style_name.startswith('Heading 1'):
+                if sections:
+                    sections[-1][2] = index
+                sections.append([text, index + 1, len(paragraphs)])
 
-        # Descartar secciones sin contenido (dos Heading 1 seguidos, o el
-        # último heading del documento sin texto debajo) — no tiene sentido
-        # ofrecerlas como capítulo seleccionable para generar preguntas.
-        chapters_list = [ch for ch in chapters_list if ch['content'].strip()]
+        chapters_list = []
+        for title, start, end in sections:
+            content = ''.join([f'{text}\n\n' for _style, text in paragraphs[start:end]])
+            # Descartar secciones sin contenido (dos Heading 1 seguidos, o el
+            # último heading del documento sin texto debajo) — no tiene sentido
+            # ofrecerlas como capítulo seleccionable para generar preguntas.
+            if content.strip():
+                chapters_list.append({
+                    'title': title,
+                    'content': content,
+                    'tokens': self.count_tokens(content)
+                })
 
         # Si no hay capítulos, considerar todo el documento
         if not chapters_list:
-            full_text = '\n\n'.join([p.text for p in doc.paragraphs])
+            full_text = '\n\n'.join([text for _style, text in paragraphs])
             chapters_list.append({
                 'title': 'Documento completo',
                 'content': full_text,
                 'tokens': self.count_tokens(full_text)
             })
-        else:
-            # Calcular tokens
-            for chapter in chapters_list:
-                chapter['tokens'] = self.count_tokens(chapter['content'])
         
         result['chapters'] = chapters_list
         result['full_text'] = '\n\n'.join([ch['content'] for ch in chapters_list])
@@ -697,40 +1040,176 @@ class DocumentProcessor:
             Número de tokens
         """
         return len(self.encoding.encode(text))
+
+    def token_byte_offsets(self, text: str) -> List[int]:
+        """
+        Codifica `text` una sola vez y devuelve, para cada token, el offset
+        en bytes (UTF-8) de `text` donde empieza — misma longitud que la
+        lista de tokens, así que len(resultado) == count_tokens(text).
+        Permite contar los tokens de un tramo del texto con búsqueda binaria
+        sobre estos offsets en vez de volver a codificarlo. En bytes y no en
+        caracteres porque tiktoken los da gratis (decode_with_offsets, que
+        los pasa a caracteres, cuesta más que volver a codificar).
+        """
+        if not text:
+            return []
+        tokens = self.encoding.encode(text)
+        offsets = list(accumulate(map(len, self.encoding.decode_tokens_bytes(tokens)), initial=0))
+        offsets.pop()
+        return offsets
     
-    def split_by_token_limit(self, text: str, max_tokens: int = 4000) -> List[str]:
+    def token_byte_offsets_many(self, texts: List[str]) -> List[List[int]]:
+        """
+        token_byte_offsets para varios textos (ej. los capítulos elegidos
+        para generar), codificados en una sola llamada a encode_batch.
+        """
+        return [
+            list(accumulate(map(len, self.encoding.decode_tokens_bytes(tokens)), initial=0))[:-1]
+            for tokens in self.encoding.encode_batch(list(texts))
+        ]
+
+    def split_by_token_limit(self, text: str, max_tokens: int = 4000,
+                             overlap: int = 0,
+                             snap_window: Optional[int] = None) -> List[str]:
         """
         Divide texto en chunks que no excedan el límite de tokens.
         Útil para enviar a IA con ventana de contexto limitada.
-        
+
+        El texto se codifica una vez y se corta sobre el arreglo de tokens
+        (ver _split_encoded): cada corte se corre hacia atrás, dentro de
+        `snap_window` tokens, al mejor límite natural que encuentre —
+        párrafo, después fin de oración/línea, después espacio entre
+        palabras — y nunca cae en medio de un carácter UTF-8.
+
         Args:
             text: Texto a dividir
             max_tokens: Límite de tokens por chunk
-        
+            overlap: Tokens del final de cada chunk que se repiten al
+                principio del siguiente (contexto compartido entre chunks).
+                0 = sin solapamiento: unir los chunks devuelve el texto.
+            snap_window: Cuántos tokens hacia atrás se puede correr un corte
+                buscando un límite natural. None = 10% de max_tokens; 0 =
+                cortar justo en max_tokens, como antes.
+
         Returns:
             Lista de chunks de texto
         """
-        # Tokenizar
-        tokens = self.encoding.encode(text)
-        
-        # Dividir en chunks
+        return self._split_encoded(self.encoding.encode(text), max_tokens, overlap, snap_window)
+
+    def split_many_by_token_limit(self, texts: List[str], max_tokens: int = 4000,
+                                  overlap: int = 0,
+                                  snap_window: Optional[int] = None) -> List[List[str]]:
+        """
+        Igual que split_by_token_limit para varios textos a la vez (ej.
+        varios capítulos seleccionados): los codifica todos en una sola
+        llamada a encode_batch, que tiktoken reparte entre threads.
+
+        Returns:
+            Una lista de chunks por cada texto, en el mismo orden.
+        """
+        return [
+            self._split_encoded(tokens, max_tokens, overlap, snap_window)
+            for tokens in self.encoding.encode_batch(texts)
+        ]
+
+    # Calidad de cada posible punto de corte (más alto = mejor).
+    _CUT_PARAGRAPH, _CUT_SENTENCE, _CUT_WORD, _CUT_ANY = 3, 2, 1, 0
+    _SENTENCE_END_BYTES = frozenset(b'.?!:;')
+    _WHITESPACE_BYTES = frozenset(b' \t\r\n')
+
+    def _split_encoded(self, tokens: List[int], max_tokens: int,
+                       overlap: int = 0,
+                       snap_window: Optional[int] = None) -> List[str]:
+        if max_tokens < 1:
+            raise ValueError('max_tokens debe ser al menos 1')
+        if not tokens:
+            return []
+        if len(tokens) <= max_tokens:
+            return [self.encoding.decode(tokens)]
+
+        overlap = max(0, min(overlap, max_tokens - 1))
+        if snap_window is None:
+            snap_window = max_tokens // 10
+        snap_window = max(0, min(snap_window, max_tokens - 1))
+
+        # Bytes del texto y offset (en bytes) donde empieza cada token: los
+        # chunks salen de cortar este buffer, sin decodificar token por token.
+        token_bytes = self.encoding.decode_tokens_bytes(tokens)
+        data = b''.join(token_bytes)
+        starts = list(accumulate(map(len, token_bytes), initial=0))
+        n_tokens = len(tokens)
+
         chunks = []
-        current_chunk = []
-        
-        for token in tokens:
-            current_chunk.append(token)
-            
-            if len(current_chunk) >= max_tokens:
-                # Decodificar chunk actual
-                chunk_text = self.encoding.decode(current_chunk)
-                chunks.append(chunk_text)
-                current_chunk = []
-        
-        # Añadir último chunk si quedó algo
-        if current_chunk:
-            chunks.append(self.encoding.decode(current_chunk))
-        
+        start = 0
+        while start < n_tokens:
+            target = start + max_tokens
+            if target >= n_tokens:
+                cut = n_tokens
+            else:
+                cut = self._best_cut(data, starts, start, target, snap_window)
+            chunks.append(data[starts[start]:starts[cut]].decode('utf-8', errors='replace'))
+            if cut >= n_tokens:
+                break
+            next_start = max(start + 1, cut - overlap)
+            # El solapamiento tampoco puede empezar en medio de un carácter.
+            while next_start < cut and not self._utf8_safe_cut(data, starts, next_start):
+                next_start += 1
+            start = next_start
+
         return chunks
+
+    @staticmethod
+    def _utf8_safe_cut(data: bytes, starts: List[int], idx: int) -> bool:
+        """True si cortar antes del token `idx` no parte un carácter UTF-8
+        (el byte siguiente no es un byte de continuación 10xxxxxx)."""
+        offset = starts[idx]
+        return offset >= len(data) or (data[offset] & 0xC0) != 0x80
+
+    def _cut_quality(self, data: bytes, offset: int) -> int:
+        before = data[max(0, offset - 2):offset]
+        after = data[offset:offset + 1]
+        if before.endswith(b'\n\n'):
+            return self._CUT_PARAGRAPH
+        if before.endswith(b'\n') or (
+            before and before[-1] in self._SENTENCE_END_BYTES
+            and after and after[0] in self._WHITESPACE_BYTES
+        ):
+            return self._CUT_SENTENCE
+        if (after and after[0] in self._WHITESPACE_BYTES) or (before and before[-1] in self._WHITESPACE_BYTES):
+            return self._CUT_WORD
+        return self._CUT_ANY
+
+    def _best_cut(self, data: bytes, starts: List[int], start: int,
+                  target: int, snap_window: int) -> int:
+        """
+        Índice de token donde cortar el chunk que empieza en `start`: el
+        mejor límite natural en (target - snap_window, target], y entre los
+        de igual calidad el más cercano a target. Si ninguno es seguro para
+        UTF-8, se retrocede hasta uno que lo sea; y si tampoco lo hay (un
+        solo carácter ocupa más tokens que max_tokens, ej. un emoji con
+        max_tokens=1), se avanza: ese chunk se pasa del límite antes que
+        partir el carácter.
+        """
+        best_cut = None
+        best_quality = -1
+        lowest = max(start + 1, target - snap_window)
+        for idx in range(target, lowest - 1, -1):
+            if not self._utf8_safe_cut(data, starts, idx):
+                continue
+            quality = self._cut_quality(data, starts[idx])
+            if quality > best_quality:
+                best_cut, best_quality = idx, quality
+                if quality == self._CUT_PARAGRAPH:
+                    break
+        if best_cut is not None:
+            return best_cut
+        for idx in range(lowest - 1, start, -1):
+            if self._utf8_safe_cut(data, starts, idx):
+                return idx
+        idx = target + 1
+        while not self._utf8_safe_cut(data, starts, idx):
+            idx += 1
+        return idx
     
     def optimize_for_ai(self, text: str, 
                        remove_extra_whitespace: bool = True,
@@ -814,6 +1293,231 @@ class DocumentProcessor:
         return '\n'.join(summary)
 
 
+# ============================================================================
+# TABLA DE PÁGINAS A DEMANDA
+# ============================================================================
+
+class _LazyPageTable:
+    """
+    Misma interfaz que la lista de _extract_page_table (len + índice
+    0-based → (número impreso, texto limpio)), pero extrae cada página
+    recién la primera vez que se la pide. Lo usa iter_pdf_chapters en modo
+    serie para poder entregar el primer capítulo sin haber leído el resto
+    del libro, y release_before() suelta las páginas ya entregadas para no
+    retener el texto del documento entero.
+    """
+
+    def __init__(self, doc: fitz.Document, headers: List[str], footers: List[str],
+                 raw_texts: Optional[Dict[int, str]] = None):
+        self._doc = doc
+        self._is_repetitive_line = DocumentProcessor._compile_line_filter(headers, footers)
+        # Texto crudo ya leído por _detect_repetitive_text: se usa (y se
+        # suelta) la primera vez que se pide esa página.
+        self._raw_texts = raw_texts if raw_texts is not None else {}
+        self._pages: Dict[int, Tuple[Optional[int], str]] = {}
+
+    def __len__(self) -> int:
+        return self._doc.page_count
+
+    def __getitem__(self, page_num: int) -> Tuple[Optional[int], str]:
+        page = self._pages.get(page_num)
+        if page is None:
+            raw_text = self._raw_texts.pop(page_num, None)
+            if raw_text is None:
+                raw_text = self._doc[page_num].get_text()
+            page = DocumentProcessor._process_page_text(raw_text, self._is_repetitive_line)
+            self._pages[page_num] = page
+        return page
+
+    def release_before(self, page_num: int) -> None:
+        for cached in [p for p in self._pages if p < page_num]:
+            del self._pages[cached]
+        for cached in [p for p in self._raw_texts if p < page_num]:
+            del self._raw_texts[cached]
+
+
+# ============================================================================
+# WORKERS DE EXTRACCIÓN PARALELA
+# ============================================================================
+
+def _extract_page_range(file_path: str, start: int, end: int,
+                        headers: List[str], footers: List[str]) -> List[Tuple[Optional[int], str]]:
+    """
+    Corre en un proceso aparte (ver DocumentProcessor._extract_page_table):
+    abre su propia copia del PDF y procesa las páginas [start, end). Función
+    de módulo (no método) para que ProcessPoolExecutor la pueda serializar.
+    """
+    is_repetitive_line = DocumentProcessor._compile_line_filter(headers, footers)
+    doc = fitz.open(file_path)
+    try:
+        return [
+            DocumentProcessor._process_page_text(doc[page_num].get_text(), is_repetitive_line)
+            for page_num in range(start, end)
+        ]
+    finally:
+        doc.close()
+
+
+# ============================================================================
+# LECTURA DE DOCX EN STREAMING
+# ============================================================================
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_PACKAGE_RELS = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+_RT_OFFICE_DOCUMENT = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+_RT_STYLES = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles'
+_RT_CORE_PROPERTIES = 'http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties'
+_ON_VALUES = ('1', 'true', 'on')
+
+_DOCX_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
+# Mismos alias que python-docx (BabelFish): en styles.xml los estilos
+# integrados se llaman en minúscula ("heading 1") y python-docx los expone
+# con el nombre de la interfaz ("Heading 1").
+_BUILTIN_STYLE_UI_NAMES = {
+    'caption': 'Caption',
+    'footer': 'Footer',
+    'header': 'Header',
+    **{f'heading {level}': f'Heading {level}' for level in range(1, 10)},
+}
+
+
+def _docx_rel_target(zf: zipfile.ZipFile, source_part: str, rel_type: str) -> Optional[str]:
+    """Nombre (dentro del zip) de la parte relacionada con `source_part`
+    ('' = el paquete) por una relación de tipo `rel_type`, o None."""
+    source_dir, source_name = posixpath.split(source_part)
+    rels_name = posixpath.join(source_dir, '_rels', f'{source_name}.rels')
+    try:
+        with zf.open(rels_name) as f:
+            rels = etree.parse(f, _DOCX_XML_PARSER).getroot()
+    except KeyError:
+        return None
+    for rel in rels.iter(_PACKAGE_RELS):
+        if rel.get('Type') == rel_type and rel.get('TargetMode') != 'External':
+            target = rel.get('Target', '')
+            if target.startswith('/'):
+                return target.lstrip('/')
+            return posixpath.normpath(posixpath.join(source_dir, target))
+    return None
+
+
+def _docx_paragraph_styles(zf: zipfile.ZipFile, styles_part: str) -> Tuple[Dict[str, Optional[str]], Optional[str]]:
+    """({styleId: nombre} de los estilos de párrafo, nombre del estilo de
+    párrafo por defecto). Resuelve igual que python-docx: un styleId que no
+    existe o que no es de párrafo vale como el estilo por defecto."""
+    with zf.open(styles_part) as f:
+        styles = etree.parse(f, _DOCX_XML_PARSER).getroot()
+
+    names: Dict[str, Optional[str]] = {}
+    not_paragraph = set()
+    default_name = None
+    for style in styles.iterchildren(_W + 'style'):
+        name_element = style.find(_W + 'name')
+        name = name_element.get(_W + 'val') if name_element is not None else None
+        if name is not None:
+            name = _BUILTIN_STYLE_UI_NAMES.get(name, name)
+        style_id = style.get(_W + 'styleId')
+        is_paragraph = style.get(_W + 'type') == 'paragraph'
+        # python-docx toma el primero con ese styleId.
+        if style_id is not None and style_id not in names and style_id not in not_paragraph:
+            if is_paragraph:
+                names[style_id] = name
+            else:
+                not_paragraph.add(style_id)
+        # ...y el último marcado como default.
+        if is_paragraph and style.get(_W + 'default') in _ON_VALUES:
+            default_name = name
+    return names, default_name
+
+
+def _docx_paragraph_text(paragraph) -> str:
+    """Texto de un <w:p>, igual que Paragraph.text de python-docx 0.8:
+    solo los runs hijos directos, con <w:tab/> -> \\t y <w:br/>/<w:cr/> -> \\n."""
+    parts = []
+    for run in paragraph.iterchildren(_W + 'r'):
+        for child in run:
+            tag = child.tag
+            if tag == _W + 't':
+                parts.append(child.text or '')
+            elif tag == _W + 'tab':
+                parts.append('\t')
+            elif tag == _W + 'br' or tag == _W + 'cr':
+                parts.append('\n')
+    return ''.join(parts)
+
+
+def iter_docx_paragraphs(file_path: str) -> Iterator[Tuple[Optional[str], str]]:
+    """
+    (nombre del estilo, texto) de cada párrafo del cuerpo de un DOCX, en
+    orden — lo mismo que `[(p.style.name, p.text) for p in
+    Document(file_path).paragraphs]`, sin armar el árbol entero.
+
+    `word/document.xml` se recorre con iterparse directo desde el zip: cada
+    párrafo se suelta apenas se leyó, así la memoria no crece con el largo
+    del documento (solo la tabla más grande, que se suelta entera al
+    terminar). Como python-docx, cuenta solo los párrafos hijos directos
+    del cuerpo — no los de tablas, cuadros de texto ni controles de
+    contenido.
+
+    Levanta ValueError si el paquete no tiene las partes esperadas (quien
+    llama puede caer a python-docx, ver process_docx).
+    """
+    with zipfile.ZipFile(file_path) as zf:
+        main_part = _docx_rel_target(zf, '', _RT_OFFICE_DOCUMENT)
+        if main_part is None:
+            raise ValueError('sin documento principal')
+        styles_part = _docx_rel_target(zf, main_part, _RT_STYLES)
+        if styles_part is None:
+            # python-docx usa sus estilos de plantilla en este caso.
+            raise ValueError('sin styles.xml')
+        style_names, default_style = _docx_paragraph_styles(zf, styles_part)
+
+        with zf.open(main_part) as f:
+            for _event, paragraph in etree.iterparse(
+                f, events=('end',), tag=_W + 'p',
+                resolve_entities=False, no_network=True, huge_tree=True,
+            ):
+                body = paragraph.getparent()
+                if body is None or body.tag != _W + 'body':
+                    continue  # párrafo de una tabla: se suelta con la tabla
+
+                style_id = None
+                properties = paragraph.find(_W + 'pPr')
+                if properties is not None:
+                    style = properties.find(_W + 'pStyle')
+                    if style is not None:
+                        style_id = style.get(_W + 'val')
+                style_name = style_names.get(style_id, default_style) if style_id is not None else default_style
+
+                yield style_name, _docx_paragraph_text(paragraph)
+
+                paragraph.clear()
+                while paragraph.getprevious() is not None:
+                    del body[0]
+
+
+def read_docx_core_properties(file_path: str) -> Dict[str, str]:
+    """title/author/subject de docProps/core.xml, con los mismos valores
+    que doc.core_properties de python-docx ('' si falta el dato)."""
+    with zipfile.ZipFile(file_path) as zf:
+        core_part = _docx_rel_target(zf, '', _RT_CORE_PROPERTIES)
+        if core_part is None:
+            # python-docx inventa unas propiedades por defecto.
+            return {'title': 'Word Document', 'author': '', 'subject': ''}
+        with zf.open(core_part) as f:
+            core = etree.parse(f, _DOCX_XML_PARSER).getroot()
+
+    def text_of(tag):
+        element = core.find(tag)
+        return (element.text or '') if element is not None else ''
+
+    return {
+        'title': text_of('{http://purl.org/dc/elements/1.1/}title'),
+        'author': text_of('{http://purl.org/dc/elements/1.1/}creator'),
+        'subject': text_of('{http://purl.org/dc/elements/1.1/}subject'),
+    }
+
+
 # ============================================================================
 # FUNCIONES DE CONVENIENCIA
 # ============================================================================
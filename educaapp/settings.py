@@ -149,6 +149,65 @@ CONTENIDO_MAX_TOTAL_TOKENS = 50_000   # aviso: documento entero muy extenso, mej
 CONTENIDO_MAX_RUN_TOKENS = 45_000     # tope duro por corrida de generación (~15 chunks de 3000 tokens)
 CONTENIDO_MAX_PAGES = 2000            # techo de sanity (PDF corrupto/patológico), no un límite de "tamaño de libro"
 CONTENIDO_PAGES_PER_CHAPTER_BLOCK = 40  # sin TOC: partir el libro en bloques de esta cantidad de páginas
+# Extracción de PDFs en paralelo (procesos): 0/1 = en serie. El plan gratuito
+# de Render tiene una fracción de CPU, ahí no conviene; en un servidor con
+# varios núcleos, 2-4 baja mucho el tiempo de libros escaneados grandes.
+CONTENIDO_PDF_PARALLEL_WORKERS = int(os.environ.get('CONTENIDO_PDF_PARALLEL_WORKERS', '0'))
+CONTENIDO_PDF_PARALLEL_MIN_PAGES = 150  # por debajo, siempre en serie
+# Auditar el clasificador de páginas escaneadas (PyMuPDF) contra pdf-inspector:
+# loguea las diferencias, a costa de leer cada PDF una vez más.
+CONTENIDO_VERIFY_SCANNED_PAGES = os.environ.get('CONTENIDO_VERIFY_SCANNED_PAGES', 'False') == 'True'
+CONTENIDO_EXTRACTION_CACHE_MAX_MB = 200  # caché en disco de extracciones (var/extraction_cache), desalojo LRU
+CONTENIDO_PAGE_STORE_MAX_MB = 200  # texto por página para el selector del dashboard (var/page_store), desalojo LRU
+# Imágenes que se mandan a la IA con visión (ver material/image_pipeline.py):
+# se achican a este lado máximo, se recodifican y se descartan las casi-duplicadas.
+CONTENIDO_VISION_IMAGE_MAX_EDGE = 1024  # px
+CONTENIDO_VISION_IMAGE_FORMAT = 'JPEG'  # o 'WEBP'
+CONTENIDO_VISION_IMAGE_QUALITY = 80
+CONTENIDO_VISION_IMAGE_DEDUP_DISTANCE = 6  # bits de diferencia entre hashes perceptuales (de 64)
+CONTENIDO_IMAGE_CACHE_MAX_MB = 100  # imágenes ya procesadas (var/image_cache), desalojo LRU
+# Generación por fragmentos (ver material/generation_engine.py): cuántos
+# fragmentos se le piden a la IA a la vez, y el RPM con el que arranca el
+# limitador (el TPM lo aprende de los headers del proveedor).
+CONTENIDO_GENERATION_CONCURRENCY = int(os.environ.get('CONTENIDO_GENERATION_CONCURRENCY', '3'))
+CONTENIDO_GENERATION_RPM = 30  # RPM del plan gratuito de Groq; los headers solo traen requests por día
+# Presupuesto compartido de llamadas al fallback de demo (GlobalAIConfig), ver
+# material/shared_rate_limit.py: 'memory' (un solo worker, como en Render),
+# 'file' (varios workers en la misma máquina) o 'db' (varias máquinas).
+CONTENIDO_SHARED_RATE_LIMIT_BACKEND = os.environ.get('CONTENIDO_SHARED_RATE_LIMIT_BACKEND', 'memory')
+CONTENIDO_SHARED_RATE_LIMIT_MAX_WAIT = 30  # segundos; si el cupo tarda más en liberarse, la llamada ni sale
+CONTENIDO_FAIR_SHARE_WEIGHTS = {'teacher': 4, 'monitor': 2, 'training': 1}  # turnos del pool compartido por clase (ver material/fair_share.py)
+CONTENIDO_FAIR_SHARE_RPM = 30  # requests por minuto del pool, para el costo de cada llamada
+CONTENIDO_FAIR_SHARE_MAX_WAIT_SECONDS = 120  # espera máxima del turno; después la llamada se trata como sin cupo
+CONTENIDO_DEMO_HEDGING = os.environ.get('CONTENIDO_DEMO_HEDGING', 'False') == 'True'  # Groq lento (más que su p95) → misma llamada también a Gemini
+CONTENIDO_DEMO_HEDGE_MIN_SECONDS = 8  # nunca se cubre una llamada a Groq antes de esto
+# Sesiones HTTP keep-alive de los backends de IA (ver material/http_sessions.py).
+CONTENIDO_HTTP_POOL_CONNECTIONS = 4   # hosts distintos con pool propio, por sesión
+CONTENIDO_HTTP_POOL_MAXSIZE = 10      # conexiones abiertas por host (threads x fragmentos en paralelo)
+CONTENIDO_HTTP_RETRIES = 2            # solo errores de conexión y 502/503/504; el 429 lo manejan los backends
+CONTENIDO_HTTP_RETRY_BACKOFF = 0.5    # segundos, se duplica en cada reintento
+# Caché de respuestas de la IA por prompt idéntico (ver material/generation_cache.py),
+# opt-in: ahorra cupo compartido (RPD) al regenerar lo mismo, sobre todo en demos.
+CONTENIDO_GENERATION_CACHE_ENABLED = os.environ.get('CONTENIDO_GENERATION_CACHE_ENABLED', 'False') == 'True'
+CONTENIDO_GENERATION_CACHE_TTL_HOURS = 24
+CONTENIDO_GENERATION_CACHE_MAX_MB = 50  # var/generation_cache, desalojo LRU
+CONTENIDO_AI_BACKEND_CACHE_TTL_SECONDS = 300  # backend de IA resuelto por usuario (ver ai_router); 0 = sin caché
+CONTENIDO_PROVIDER_HEALTH_INTERVAL_SECONDS = 60  # chequeo en segundo plano del proveedor de IA (ver material/provider_health.py)
+CONTENIDO_DEMO_QUOTA_FLUSH_SECONDS = 30  # cada cuánto se escribe a GlobalAIConfig el cupo en memoria del fallback de demo (ver material/demo_quota.py)
+CONTENIDO_GENERATION_JOB_TTL_HOURS = 24  # jobs de generación (GenerationJob) que se pueden retomar
+# Dónde se generan los jobs (ver material/generation_worker.py): "thread" = threads
+# en el proceso web; "external" = `manage.py run_generation_worker` aparte.
+CONTENIDO_GENERATION_WORKER = os.environ.get('CONTENIDO_GENERATION_WORKER', 'thread')
+CONTENIDO_GENERATION_WORKER_THREADS = 2  # jobs a la vez por proceso
+CONTENIDO_GENERATION_JOB_ABANDON_SECONDS = 120  # sin conexión SSE por más que esto, el job se pausa
+CONTENIDO_GENERATION_SSE_MAX_SECONDS = 25  # duración de cada conexión SSE (el cliente reconecta solo)
+# Bloque "no repetir" del prompt (ver material/question_index.py): de las preguntas
+# ya guardadas del Contenido, solo las más parecidas al texto de cada fragmento.
+CONTENIDO_EXISTING_QUESTIONS_TOP_K = 15
+CONTENIDO_EXISTING_QUESTIONS_TOKEN_BUDGET = 600  # tokens de prompt por llamada
+# Dedup de preguntas generadas por similitud (MinHash/LSH, ver material/near_duplicates.py):
+# Jaccard estimada sobre palabras y pares de palabras; 0 lo apaga (queda solo el dedup por prefijo).
+CONTENIDO_NEAR_DUPLICATE_THRESHOLD = float(os.environ.get('CONTENIDO_NEAR_DUPLICATE_THRESHOLD', '0.7'))
 
 # Default primary key field
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
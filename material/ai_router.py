@@ -11,14 +11,17 @@ Interfaz común de todos los backends:
     backend.is_available() -> bool
     backend.generate(prompt, max_tokens, temperature, **kwargs) -> dict
     backend.get_status() -> dict
+    backend.health_key() -> tuple   (ver provider_health.py)
 """
 
-import requests
+import json
 import logging
+import threading
 import time
-from datetime import timedelta
 from typing import Optional, Dict, Any
 
+from .http_sessions import get_session
+
 logger = logging.getLogger(__name__)
 
 
@@ -50,6 +53,9 @@ class OllamaBackend:
         status['backend'] = 'ollama_local'
         return status
 
+    def health_key(self):
+        return ('ollama', self._client.base_url, '', '')
+
 
 # ---------------------------------------------------------------------------
 # Backend: OpenAI y compatibles (Groq, Mistral, OpenRouter, vLLM, LM Studio…)
@@ -78,6 +84,7 @@ class OpenAICompatibleBackend:
         if provider == 'gemini' and raw_model and raw_model.startswith('models/'):
             raw_model = raw_model[len('models/'):]
         self.model = raw_model
+        self._http = get_session(provider, self.base_url)
 
     def _headers(self):
         return {
@@ -87,14 +94,14 @@ class OpenAICompatibleBackend:
 
     def is_available(self) -> bool:
         try:
-            r = requests.get(f'{self.base_url}/models', headers=self._headers(), timeout=5)
+            r = self._http.get(f'{self.base_url}/models', headers=self._headers(), timeout=5)
             return r.status_code == 200
         except Exception:
             return False
 
     def generate(self, prompt: str, max_tokens: int = 1000, temperature: float = 0.7,
                  images: Optional[list] = None, reasoning_effort: Optional[str] = None,
-                 json_mode: bool = False, **kwargs) -> Dict[str, Any]:
+                 json_mode: bool = False, on_delta=None, **kwargs) -> Dict[str, Any]:
         """
         images: lista opcional de data-URIs ("data:image/png;base64,...") para
         modelos con visión (formato "image_url" de la API de Chat Completions,
@@ -109,6 +116,10 @@ class OpenAICompatibleBackend:
         json_mode: si True, pide response_format={"type": "json_object"} —
         enforcement real de JSON por la API en vez de depender solo de la
         instrucción en el prompt.
+        on_delta: si se pasa, la respuesta se pide con `stream: true` y se
+        llama on_delta(texto) con cada pedazo a medida que llega (ver
+        question_stream.py). El dict que se devuelve es el mismo que sin
+        streaming, con el texto completo.
         """
         if images:
             content = [{'type': 'text', 'text': prompt}]
@@ -126,14 +137,17 @@ class OpenAICompatibleBackend:
             payload['reasoning_effort'] = reasoning_effort
         if json_mode:
             payload['response_format'] = {'type': 'json_object'}
+        if on_delta is not None:
+            payload['stream'] = True
         max_retries = 2
         for attempt in range(max_retries + 1):
             try:
-                r = requests.post(
+                r = self._http.post(
                     f'{self.base_url}/chat/completions',
                     headers=self._headers(),
                     json=payload,
                     timeout=120,
+                    stream=on_delta is not None,
                 )
                 rate_limit = self._parse_rate_limit_headers(r.headers)
                 if r.status_code == 429 and attempt < max_retries:
@@ -143,6 +157,7 @@ class OpenAICompatibleBackend:
                         f'{self.provider} rate limit (429) en intento {attempt + 1}/{max_retries + 1}, '
                         f'reintentando en {wait}s...'
                     )
+                    r.close()
                     time.sleep(wait)
                     continue
                 if not r.ok:
@@ -156,6 +171,8 @@ class OpenAICompatibleBackend:
                         'text': None,
                         'rate_limit': rate_limit,
                     }
+                if on_delta is not None:
+                    return self._read_stream(r, on_delta, rate_limit)
                 data = r.json()
                 choice = data['choices'][0]
                 text = choice['message']['content'].strip()
@@ -173,6 +190,51 @@ class OpenAICompatibleBackend:
                 return {'success': False, 'error': str(e), 'text': None}
         return {'success': False, 'error': f'Límite de solicitudes de {self.provider} alcanzado (429) tras reintentar.', 'text': None}
 
+    def _read_stream(self, r, on_delta, rate_limit) -> Dict[str, Any]:
+        """Lee una respuesta `stream: true` (server-sent events, un
+        `data: {...}` por pedazo y `data: [DONE]` al final) y arma el mismo
+        dict que generate() sin streaming. Los headers de cupo ya llegaron
+        con el status, antes del primer pedazo."""
+        parts = []
+        finish_reason = None
+        usage = {}
+        try:
+            for line in r.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                event = json.loads(data)
+                if event.get('error'):
+                    # Error a mitad de la generación (el status ya había sido 200).
+                    error = event['error']
+                    return {
+                        'success': False,
+                        'error': error.get('message') if isinstance(error, dict) else str(error),
+                        'text': None,
+                        'rate_limit': rate_limit,
+                    }
+                # Groq manda el uso en x_groq.usage del último pedazo; OpenAI en usage.
+                usage = event.get('usage') or (event.get('x_groq') or {}).get('usage') or usage
+                for choice in event.get('choices') or []:
+                    piece = (choice.get('delta') or {}).get('content')
+                    if piece:
+                        parts.append(piece)
+                        on_delta(piece)
+                    if choice.get('finish_reason'):
+                        finish_reason = choice['finish_reason']
+        finally:
+            r.close()
+        return {
+            'success': True,
+            'text': ''.join(parts).strip(),
+            'tokens': usage.get('total_tokens', 0),
+            'model': self.model,
+            'rate_limit': rate_limit,
+            'truncated': finish_reason == 'length',
+        }
+
     @staticmethod
     def _parse_rate_limit_headers(headers) -> Optional[Dict[str, Any]]:
         """Extrae cupo restante de los headers estilo x-ratelimit-* (Groq, OpenAI,
@@ -202,11 +264,13 @@ class OpenAICompatibleBackend:
         }
 
     def get_status(self) -> Dict[str, Any]:
-        ready = self.connected_and_ready()
+        # Un solo GET /models: antes se hacía una vez acá y otra dentro de
+        # connected_and_ready().
+        connected = self.is_available()
         return {
             'backend': 'openai_compatible',
-            'connected': self.is_available(),
-            'ready_for_generation': ready,
+            'connected': connected,
+            'ready_for_generation': connected and bool(self.model),
             'provider': self.provider,
             'model': self.model,
             'base_url': self.base_url,
@@ -217,6 +281,10 @@ class OpenAICompatibleBackend:
             return False
         return bool(self.model)
 
+    def health_key(self):
+        from .provider_health import key_fingerprint
+        return (self.provider, self.base_url, key_fingerprint(self.api_key), self.model)
+
 
 # ---------------------------------------------------------------------------
 # Backend: Gemini nativo
@@ -232,13 +300,14 @@ class GeminiBackend:
         self._last_error = ''
         if self.model.startswith('models/'):
             self.model = self.model[len('models/'):]
+        self._http = get_session('gemini', self.BASE_URL)
 
     def _params(self):
         return {'key': self.api_key}
 
     def _list_models(self):
         try:
-            r = requests.get(
+            r = self._http.get(
                 f'{self.BASE_URL}/models',
                 params=self._params(),
                 timeout=8,
@@ -340,7 +409,7 @@ class GeminiBackend:
         max_retries = 2
         for attempt in range(max_retries + 1):
             try:
-                r = requests.post(
+                r = self._http.post(
                     f'{self.BASE_URL}/models/{self.model}:generateContent',
                     params=self._params(),
                     json=payload,
@@ -415,6 +484,10 @@ class GeminiBackend:
             'base_url': self.BASE_URL,
         }
 
+    def health_key(self):
+        from .provider_health import key_fingerprint
+        return ('gemini', self.BASE_URL, key_fingerprint(self.api_key), self.model)
+
 
 # ---------------------------------------------------------------------------
 # Backend: Anthropic (Claude)
@@ -428,6 +501,7 @@ class AnthropicBackend:
     def __init__(self, api_key: str, model: str = ''):
         self.api_key = api_key
         self.model = model or ''
+        self._http = get_session('anthropic', self.BASE_URL)
 
     def _headers(self):
         return {
@@ -439,7 +513,7 @@ class AnthropicBackend:
     def is_available(self) -> bool:
         # GET /models existe en la API v1; un 401 indicaría key inválida
         try:
-            r = requests.get(f'{self.BASE_URL}/models', headers=self._headers(), timeout=5)
+            r = self._http.get(f'{self.BASE_URL}/models', headers=self._headers(), timeout=5)
             return r.status_code in (200, 404)  # 404 = autenticado pero endpoint inexistente en versión antigua
         except Exception:
             return False
@@ -452,7 +526,7 @@ class AnthropicBackend:
                 'temperature': temperature,
                 'messages': [{'role': 'user', 'content': prompt}],
             }
-            r = requests.post(
+            r = self._http.post(
                 f'{self.BASE_URL}/messages',
                 headers=self._headers(),
                 json=payload,
@@ -480,6 +554,10 @@ class AnthropicBackend:
             'model': self.model,
         }
 
+    def health_key(self):
+        from .provider_health import key_fingerprint
+        return ('anthropic', self.BASE_URL, key_fingerprint(self.api_key), self.model)
+
 
 # ---------------------------------------------------------------------------
 # Listado dinámico de modelos disponibles por proveedor
@@ -495,7 +573,7 @@ def list_models_for_provider(provider: str, api_key: str, base_url: Optional[str
 
     try:
         if provider == 'gemini':
-            r = requests.get(
+            r = get_session('gemini', GeminiBackend.BASE_URL).get(
                 f'{GeminiBackend.BASE_URL}/models',
                 params={'key': api_key},
                 timeout=10,
@@ -516,7 +594,7 @@ def list_models_for_provider(provider: str, api_key: str, base_url: Optional[str
             return True, sorted(set(models)), ''
 
         if provider == 'anthropic':
-            r = requests.get(
+            r = get_session('anthropic', AnthropicBackend.BASE_URL).get(
                 f'{AnthropicBackend.BASE_URL}/models',
                 headers={
                     'x-api-key': api_key,
@@ -533,7 +611,7 @@ def list_models_for_provider(provider: str, api_key: str, base_url: Optional[str
         # OpenAI y compatibles (Groq, Mistral, OpenRouter, Together, endpoints propios)
         preset = OpenAICompatibleBackend.PRESET_URLS.get(provider)
         resolved_base_url = (base_url or preset or 'https://api.openai.com/v1').rstrip('/')
-        r = requests.get(
+        r = get_session(provider, resolved_base_url).get(
             f'{resolved_base_url}/models',
             headers={'Authorization': f'Bearer {api_key}'},
             timeout=10,
@@ -604,6 +682,7 @@ class GlobalFallbackBackend(SharedDemoBackend):
     def __init__(self, inner, config_id):
         self._inner = inner
         self._config_id = config_id
+        self.provider = inner.health_key()[0]
 
     def is_available(self):
         return self._inner.is_available()
@@ -611,13 +690,56 @@ class GlobalFallbackBackend(SharedDemoBackend):
     def get_status(self):
         return self._inner.get_status()
 
-    def generate(self, *args, **kwargs):
-        result = self._inner.generate(*args, **kwargs)
-        rate_limit = result.get('rate_limit') if isinstance(result, dict) else None
+    def health_key(self):
+        return self._inner.health_key()
+
+    def generate(self, *args, on_admitted=None, **kwargs):
+        # Todas las llamadas con esta key (de cualquier thread o worker)
+        # pasan por un presupuesto común armado con el cupo de los últimos
+        # headers — ver shared_rate_limit.py. Sin esto, varios docentes a
+        # la vez solo se enteraban del límite por un 429, y cada reintento
+        # gastaba una request del cupo diario.
+        # Antes de pedir cupo, el turno del usuario frente a los demás
+        # (fair_share.py): sin competencia no espera nada. on_admitted se
+        # llama cuando la llamada ya tiene turno y cupo, justo antes de
+        # mandarla (ver DemoRoutingBackend._generate_hedged).
+        from . import fair_share, shared_rate_limit
+        tokens = self._estimate_tokens(*args, **kwargs)
+        try:
+            with fair_share.turn(self._config_id, tokens):
+                lease_id = shared_rate_limit.acquire(self._config_id, tokens)
+        except shared_rate_limit.QuotaWaitTooLong as e:
+            logger.info(f'Fallback global sin cupo por {e.wait_seconds:.0f}s: la llamada no se manda.')
+            return {
+                'success': False,
+                'error': f'Límite de solicitudes del proveedor compartido alcanzado (429); se libera en {e.wait_seconds:.0f}s.',
+                'text': None,
+                'status_code': 429,
+            }
+
+        result = None
+        started = time.monotonic()
+        try:
+            if on_admitted is not None:
+                on_admitted()
+            result = self._inner.generate(*args, **kwargs)
+        finally:
+            rate_limit = result.get('rate_limit') if isinstance(result, dict) else None
+            shared_rate_limit.release(self._config_id, lease_id, rate_limit)
+        if isinstance(result, dict) and result.get('success'):
+            from . import provider_latency
+            provider_latency.record(self.provider, time.monotonic() - started)
         if rate_limit:
             self._save_quota_snapshot(rate_limit)
         return result
 
+    @staticmethod
+    def _estimate_tokens(prompt='', max_tokens=1000, *args, **kwargs):
+        """Lo que la llamada descuenta del TPM al llegar al proveedor:
+        prompt + max_tokens de salida reservados (ver _chunking_budget)."""
+        from .ia_processor import count_tokens
+        return count_tokens(prompt or '') + (max_tokens or 0)
+
     def refresh_quota(self):
         """Pide un mínimo indispensable (1 token de salida, prompt de una letra)
         solo para leer los headers de cupo de la respuesta — no genera preguntas.
@@ -632,19 +754,10 @@ class GlobalFallbackBackend(SharedDemoBackend):
             logger.warning(f'No se pudo refrescar el cupo del fallback global: {e}')
 
     def _save_quota_snapshot(self, rate_limit):
+        # En memoria; a GlobalAIConfig se escribe agrupado (ver demo_quota.py).
+        from . import demo_quota
         try:
-            from django.utils import timezone
-            from .models import GlobalAIConfig
-            now = timezone.now()
-            reset_seconds = _parse_duration_to_seconds(rate_limit.get('reset_requests_raw'))
-            GlobalAIConfig.objects.filter(pk=self._config_id).update(
-                quota_checked_at=now,
-                quota_remaining_requests=rate_limit.get('remaining_requests'),
-                quota_limit_requests=rate_limit.get('limit_requests'),
-                quota_requests_reset_at=(now + timedelta(seconds=reset_seconds)) if reset_seconds else None,
-                quota_remaining_tokens=rate_limit.get('remaining_tokens'),
-                quota_limit_tokens=rate_limit.get('limit_tokens'),
-            )
+            demo_quota.observe(self._config_id, rate_limit)
         except Exception as e:
             logger.warning(f'No se pudo guardar el snapshot de cupo del fallback global: {e}')
 
@@ -674,6 +787,8 @@ def _build_demo_fallback(cfg):
             model=cfg.model,
             base_url=None,
         )
+        from . import demo_quota
+        demo_quota.register(cfg)
         return GlobalFallbackBackend(backend, cfg.id)
     except Exception:
         return None
@@ -685,7 +800,8 @@ class DemoRoutingBackend(SharedDemoBackend):
     lo que Groq no puede hacer — imágenes (Groq no tiene modelos con
     visión) y como respaldo si Groq ya gastó su cupo del día. Gemini nunca
     recibe texto mientras Groq tenga margen: no es un segundo default, es
-    el "de más".
+    el "de más". La excepción, opcional (CONTENIDO_DEMO_HEDGING), es una
+    llamada a Groq que tarda más que su p95: ver _generate_hedged.
 
     Si un fragmento trae texto E imágenes a la vez, quien llama (ver
     generate_questions_from_chapters en views_document_processor.py) hace
@@ -710,6 +826,10 @@ class DemoRoutingBackend(SharedDemoBackend):
         primary = self._groq or self._gemini
         return primary.get_status() if primary else {'connected': False, 'backend': 'none'}
 
+    def health_key(self):
+        primary = self._groq or self._gemini
+        return primary.health_key() if primary else ('none', '', '', '')
+
     def refresh_quota(self):
         if self._groq:
             self._groq.refresh_quota()
@@ -721,16 +841,14 @@ class DemoRoutingBackend(SharedDemoBackend):
         a que este chequeo decía que había margen."""
         if not self._groq:
             return True
-        try:
-            from .models import GlobalAIConfig
-            cfg = GlobalAIConfig.objects.filter(pk=self._groq._config_id).first()
-        except Exception:
+        # De memoria (demo_quota.py): antes era una consulta por llamada.
+        from . import demo_quota
+        quota = demo_quota.get(self._groq._config_id)
+        if quota is None:
             return False
-        if cfg is None:
-            return False
-        if cfg.quota_remaining_requests is not None and cfg.quota_remaining_requests <= 0:
+        if quota['remaining_requests'] is not None and quota['remaining_requests'] <= 0:
             return True
-        if cfg.quota_remaining_tokens is not None and cfg.quota_limit_tokens and cfg.quota_remaining_tokens <= 0:
+        if quota['remaining_tokens'] is not None and quota['limit_tokens'] and quota['remaining_tokens'] <= 0:
             return True
         return False
 
@@ -743,6 +861,90 @@ class DemoRoutingBackend(SharedDemoBackend):
         error = (result.get('error') or '').lower()
         return '429' in error or 'límite' in error or 'limit' in error or 'quota' in error
 
+    def _generate_hedged(self, args, kwargs):
+        """
+        Groq, y si no respondió para su p95 reciente (provider_latency.
+        hedge_deadline), la misma llamada también a Gemini: gana la primera
+        que termine bien. La otra no se puede cortar (requests no cancela
+        una llamada en curso): sigue en su thread, su resultado se descarta
+        y su cupo igual se gasta — por eso es opcional
+        (CONTENIDO_DEMO_HEDGING) y solo para la cola lenta, no cada llamada.
+
+        El plazo corre desde que la llamada a Groq tiene turno y cupo
+        (on_admitted de GlobalFallbackBackend.generate), no desde que se
+        pide: esperando en fair_share o shared_rate_limit no está lenta, y
+        el p95 mide solo la llamada al proveedor. Si Groq ya empezó a
+        mandar texto (on_delta) para el plazo, se lo espera: está
+        generando, no colgado. Una vez mandada la de Gemini,
+        las preguntas adelantadas de Groq dejan de pasar a on_delta, porque
+        el resultado que se devuelva puede ser el de Gemini.
+        """
+        import contextvars
+        import queue as queue_module
+        from . import provider_latency
+
+        results = queue_module.Queue()
+        hedged = threading.Event()
+        streaming = threading.Event()
+        admitted = threading.Event()
+        on_delta = kwargs.get('on_delta')
+        primary_kwargs = dict(kwargs, on_admitted=admitted.set)
+        if on_delta is not None:
+            def primary_delta(*delta_args, **delta_kwargs):
+                streaming.set()
+                if not hedged.is_set():
+                    on_delta(*delta_args, **delta_kwargs)
+            primary_kwargs['on_delta'] = primary_delta
+        secondary_kwargs = {k: v for k, v in kwargs.items() if k != 'on_delta'}
+
+        def run(name, backend, call_kwargs):
+            from django.db import connections
+            try:
+                result = backend.generate(*args, **call_kwargs)
+            except Exception as e:
+                result = {'success': False, 'error': str(e), 'text': None}
+            finally:
+                # shared_rate_limit ('db'), demo_quota y provider_latency
+                # pueden abrir la conexión de este thread: nadie más la cierra.
+                connections.close_all()
+            results.put((name, result))
+            admitted.set()  # terminó sin mandarse (sin cupo): no esperar más
+
+        def start(name, backend, call_kwargs):
+            # copy_context: el turno en el pool (fair_share) es del usuario
+            # que hizo la llamada, no del thread.
+            context = contextvars.copy_context()
+            threading.Thread(
+                target=context.run, args=(run, name, backend, call_kwargs),
+                name=f'demo-hedge-{name}', daemon=True,
+            ).start()
+
+        start('groq', self._groq, primary_kwargs)
+        # fair_share y shared_rate_limit tienen su propio tope de espera.
+        admitted.wait()
+        try:
+            return results.get(timeout=provider_latency.hedge_deadline(self._groq.provider))[1]
+        except queue_module.Empty:
+            pass
+        if streaming.is_set():
+            return results.get()[1]
+
+        hedged.set()
+        provider_latency.count_hedge('hedged')
+        logger.info('Groq tarda más que su p95: se manda la misma llamada también a Gemini.')
+        start('gemini', self._gemini, secondary_kwargs)
+        finished = dict([results.get()])
+        if not any(r.get('success') for r in finished.values()):
+            # La primera en terminar falló: queda la otra.
+            finished.update([results.get()])
+        for name, result in finished.items():
+            if result.get('success'):
+                provider_latency.count_hedge('secondary_won' if name == 'gemini' else 'primary_won')
+                return result
+        # Fallaron las dos: lo de Groq, para que generate() decida como sin
+        # cobertura (error de cupo → Gemini).
+        return finished['groq']
+
     def generate(self, *args, images=None, **kwargs):
         # Imágenes: Groq no tiene modelos con visión — van directo a Gemini,
         # y (por diseño) nada que no sea una llamada con imágenes usa Gemini.
@@ -757,7 +959,11 @@ class DemoRoutingBackend(SharedDemoBackend):
 
         # Texto: Groq primero, siempre que se pueda.
         if self._groq and not self._groq_quota_exhausted():
-            result = self._groq.generate(*args, **kwargs)
+            from django.conf import settings
+            if self._gemini and getattr(settings, 'CONTENIDO_DEMO_HEDGING', False):
+                result = self._generate_hedged(args, kwargs)
+            else:
+                result = self._groq.generate(*args, **kwargs)
             if result.get('success') or not self._looks_like_quota_error(result):
                 return result
             logger.info('Groq sin cupo pese al chequeo previo (error de cupo en caliente) — reintentando con Gemini.')
@@ -794,20 +1000,14 @@ def get_global_demo_quota():
     """Último cupo conocido de Groq (el proveedor default del fallback de
     demo — ver DemoRoutingBackend), tomado de la última llamada real
     (generación de preguntas o ping de refresco vía `ensure_fresh_demo_quota`)
-    que se haya hecho con esa key. Devuelve None si Groq no está configurado
+    que se haya hecho con esa key, en este proceso o (vía GlobalAIConfig) en
+    otro — ver demo_quota.py. Devuelve None si Groq no está configurado
     como fallback de demo o todavía no se registró ningún cupo."""
-    cfg = _demo_config_for('groq')
-    if cfg is None or cfg.quota_checked_at is None:
+    from . import demo_quota
+    quota = demo_quota.get_for_provider('groq')
+    if quota is None:
         return None
-    return {
-        'provider': cfg.provider,
-        'checked_at': cfg.quota_checked_at,
-        'remaining_requests': cfg.quota_remaining_requests,
-        'limit_requests': cfg.quota_limit_requests,
-        'requests_reset_at': cfg.quota_requests_reset_at,
-        'remaining_tokens': cfg.quota_remaining_tokens,
-        'limit_tokens': cfg.quota_limit_tokens,
-    }
+    return {'provider': 'groq', **quota}
 
 
 def ensure_fresh_demo_quota(max_age_seconds=3600):
@@ -824,13 +1024,12 @@ def ensure_fresh_demo_quota(max_age_seconds=3600):
     en cualquier vista que muestre el cupo.
     """
     from django.utils import timezone
+    quota = get_global_demo_quota()
+    if quota is not None and (timezone.now() - quota['checked_at']).total_seconds() < max_age_seconds:
+        return
     cfg = _demo_config_for('groq')
     if cfg is None or not cfg.api_key_encrypted:
         return
-    if cfg.quota_checked_at is not None:
-        age = (timezone.now() - cfg.quota_checked_at).total_seconds()
-        if age < max_age_seconds:
-            return
     backend = _build_demo_fallback(cfg)
     if backend is not None:
         backend.refresh_quota()
@@ -855,6 +1054,9 @@ class TrainingQuotaGuardBackend(SharedDemoBackend):
     def get_status(self):
         return self._inner.get_status()
 
+    def health_key(self):
+        return self._inner.health_key()
+
     def refresh_quota(self):
         self._inner.refresh_quota()
 
@@ -886,84 +1088,196 @@ class TrainingQuotaGuardBackend(SharedDemoBackend):
         return self._inner.generate(*args, **kwargs)
 
 
+class FairShareBackend(SharedDemoBackend):
+    """Marca las llamadas al fallback compartido de demo con quién las hace
+    (usuario y clase de prioridad), para que GlobalFallbackBackend les dé
+    turno frente a las de los demás usuarios — ver fair_share.py."""
+
+    def __init__(self, inner, priority_class, owner):
+        self._inner = inner
+        self.priority_class = priority_class
+        self.owner = owner
+
+    def is_available(self):
+        return self._inner.is_available()
+
+    def get_status(self):
+        return self._inner.get_status()
+
+    def health_key(self):
+        return self._inner.health_key()
+
+    def refresh_quota(self):
+        self._inner.refresh_quota()
+
+    def generate(self, *args, **kwargs):
+        from . import fair_share
+        with fair_share.as_flow(self.priority_class, self.owner):
+            return self._inner.generate(*args, **kwargs)
+
+
 # ---------------------------------------------------------------------------
 # API pública
 # ---------------------------------------------------------------------------
 def get_backend_for_user(user) -> 'OllamaBackend | OpenAICompatibleBackend | AnthropicBackend':
     """
-    Devuelve el backend de IA configurado para el usuario. Si el usuario es
-    una cuenta del Área de Pruebas y el backend resuelto es el fallback
-    compartido de demo, se envuelve con TrainingQuotaGuardBackend (ver
-    arriba) — en cualquier otro caso (BYOK, institucional, Ollama local)
-    no aplica, esos no tocan el pool compartido.
+    Devuelve el backend de IA configurado para el usuario. Si el backend
+    resuelto es el fallback compartido de demo, se envuelve con
+    FairShareBackend (turnos frente a los demás usuarios del pool) y, si el
+    usuario es una cuenta del Área de Pruebas, además con
+    TrainingQuotaGuardBackend (ver arriba) — en cualquier otro caso (BYOK,
+    institucional, Ollama local) no aplica, esos no tocan el pool compartido.
     Si no tiene configuración o la configuración está incompleta,
     cae de vuelta a OllamaBackend.
     """
-    backend = _resolve_backend_for_user(user)
+    from . import fair_share
+
+    backend = _cached_backend_for_user(user)
     if isinstance(backend, SharedDemoBackend):
         try:
-            if user.profile.is_training_account:
-                return TrainingQuotaGuardBackend(backend)
+            is_training = user.profile.is_training_account
         except Exception:
-            pass
+            is_training = False
+        owner = fair_share.owner_for_user(user)
+        if is_training:
+            return TrainingQuotaGuardBackend(FairShareBackend(backend, fair_share.CLASS_TRAINING, owner))
+        return FairShareBackend(backend, fair_share.CLASS_TEACHER, owner)
     return backend
 
 
+# ---------------------------------------------------------------------------
+# Caché de backends resueltos por usuario
+# ---------------------------------------------------------------------------
+# Resolver el backend es un get_or_create de UserAIConfig, una o dos
+# búsquedas de GlobalAIConfig, descifrar la key (Fernet) y armar los
+# objetos — en cada carga del dashboard, cada generación y cada job. Se
+# guarda lo resuelto por usuario en este proceso; las señales de
+# material/signals.py lo invalidan al guardar o borrar UserAIConfig (ese
+# usuario), InstitutionAIConfig o GlobalAIConfig (todos: subir la versión).
+# El TTL (CONTENIDO_AI_BACKEND_CACHE_TTL_SECONDS) cubre lo que las señales
+# no ven: cambios hechos desde otro proceso (el worker externo, otro
+# gunicorn) o por queryset.update().
+_DEFAULT_BACKEND_CACHE_TTL = 300
+_backend_cache = {}  # user_id -> (versión, vence (monotonic), backend)
+_backend_cache_version = 0
+_backend_cache_epoch = 0  # sube con cada invalidación, global o de un usuario
+_backend_cache_lock = threading.Lock()
+_backend_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def _backend_cache_ttl():
+    from django.conf import settings
+    return float(getattr(settings, 'CONTENIDO_AI_BACKEND_CACHE_TTL_SECONDS', _DEFAULT_BACKEND_CACHE_TTL))
+
+
+def _cached_backend_for_user(user):
+    user_id = getattr(user, 'pk', None)
+    ttl = _backend_cache_ttl()
+    if user_id is None or ttl <= 0:
+        return _resolve_backend_for_user(user)[0]
+
+    now = time.monotonic()
+    with _backend_cache_lock:
+        entry = _backend_cache.get(user_id)
+        if entry is not None and entry[0] == _backend_cache_version and entry[1] > now:
+            _backend_cache_stats['hits'] += 1
+            return entry[2]
+        _backend_cache_stats['misses'] += 1
+        version, epoch = _backend_cache_version, _backend_cache_epoch
+
+    backend, cacheable = _resolve_backend_for_user(user)
+    if cacheable:
+        with _backend_cache_lock:
+            # Si llegó una invalidación mientras se resolvía, lo resuelto
+            # puede ser viejo: se devuelve pero no se guarda.
+            if epoch == _backend_cache_epoch:
+                _backend_cache[user_id] = (version, now + ttl, backend)
+    return backend
+
+
+def invalidate_backend_cache(user_id=None):
+    """Descarta el backend guardado de `user_id`, o el de todos si es None
+    (cambió una configuración institucional o la global de demo)."""
+    global _backend_cache_version, _backend_cache_epoch
+    with _backend_cache_lock:
+        _backend_cache_stats['invalidations'] += 1
+        _backend_cache_epoch += 1
+        if user_id is None:
+            _backend_cache_version += 1
+            _backend_cache.clear()
+        else:
+            _backend_cache.pop(user_id, None)
+
+
+def get_backend_cache_stats():
+    """Contadores del proceso actual (ver ai_config_status, solo admins)."""
+    with _backend_cache_lock:
+        stats = dict(_backend_cache_stats)
+        stats['entries'] = len(_backend_cache)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+    stats['ttl_seconds'] = _backend_cache_ttl()
+    return stats
+
+
 def _resolve_backend_for_user(user):
+    """(backend, se puede guardar en la caché). No se guarda lo que depende
+    de algo más que la configuración: si Ollama responde en este momento, o
+    el Ollama de emergencia cuando falló la base."""
     try:
         from .models import UserAIConfig
         config, _ = UserAIConfig.objects.get_or_create(user=user)
     except Exception:
-        return OllamaBackend()
+        return OllamaBackend(), False
 
     source = config.source
 
     if source == 'shared_demo':
         fallback = _global_demo_backend()
         if fallback is not None:
-            return fallback
+            return fallback, True
         logger.warning('shared_demo seleccionado pero no hay GlobalAIConfig activa con key. Usando Ollama.')
-        return OllamaBackend()
+        return OllamaBackend(), True
 
     if source == 'ollama_local':
         ollama = OllamaBackend(ollama_url=config.ollama_url or None)
         if ollama.is_available():
-            return ollama
+            return ollama, False
         fallback = _global_demo_backend()
         if fallback is not None:
             logger.info('Ollama no disponible, usando fallback de demo global.')
-            return fallback
-        return ollama
+            return fallback, False
+        return ollama, False
 
     if source == 'byok':
         if not config.api_key_encrypted:
             logger.warning('BYOK seleccionado pero sin API key. Usando Ollama.')
-            return OllamaBackend()
+            return OllamaBackend(), True
         return _build_external_backend(
             provider=config.provider or 'openai',
             api_key=config.api_key,
             model=config.model,
             base_url=config.base_url or None,
-        )
+        ), True
 
     if source == 'institutional':
         institution = config.institution
         if institution is None:
             logger.warning('Configuración institucional seleccionada pero sin institución asignada.')
-            return OllamaBackend()
+            return OllamaBackend(), True
         try:
             inst_cfg = institution.ai_config
         except Exception:
             logger.warning(f'Institución {institution.name} sin configuración IA. Usando Ollama.')
-            return OllamaBackend()
+            return OllamaBackend(), True
         if not inst_cfg.is_active or not inst_cfg.api_key_encrypted:
             logger.warning(f'Configuración institucional de {institution.name} inactiva o sin key.')
-            return OllamaBackend()
+            return OllamaBackend(), True
         return _build_external_backend(
             provider=inst_cfg.provider,
             api_key=inst_cfg.api_key,
             model=inst_cfg.model,
             base_url=inst_cfg.base_url or None,
-        )
+        ), True
 
-    return OllamaBackend()
+    return OllamaBackend(), True
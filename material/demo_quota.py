@@ -0,0 +1,265 @@
+"""
+Último cupo conocido del fallback compartido de demo (GlobalAIConfig), en
+memoria del proceso.
+
+Antes cada llamada de generación hacía un UPDATE de GlobalAIConfig con los
+headers de la respuesta (GlobalFallbackBackend._save_quota_snapshot), y
+DemoRoutingBackend leía la fila antes de cada llamada de texto para decidir
+entre Groq y Gemini: dos round-trips a Neon por fragmento, y la compute
+despierta todo el tiempo. Ahora:
+
+- observe() actualiza el cupo en memoria con los headers de cada respuesta;
+- get() lo lee de memoria. A la base solo va para sembrarlo (la primera vez
+  en el proceso) o si este proceso no vio ninguna respuesta en el último
+  CONTENIDO_DEMO_QUOTA_FLUSH_SECONDS (otro proceso puede tener datos más
+  nuevos);
+- a la fila se escribe agrupado: como mucho cada
+  CONTENIDO_DEMO_QUOTA_FLUSH_SECONDS, salvo un cambio que otros procesos
+  tienen que ver ya (cupo agotado, límite distinto, un salto grande), y con
+  una escritura final programada para que lo último no se pierda.
+
+La fila sigue siendo la fuente para otros procesos y para después de un
+reinicio; este módulo solo evita ir a buscarla y escribirla en cada llamada.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_FLUSH_SECONDS = 30
+# Cambio de requests restantes (fracción del límite) que se escribe ya.
+_SIGNIFICANT_REQUESTS_DROP = 0.05
+
+_lock = threading.Lock()
+_quotas = {}    # config_id -> _Quota
+_providers = {}  # proveedor ('groq', 'gemini') -> config_id activo
+_stats = {'observed': 0, 'flushes': 0, 'db_reads': 0}
+
+
+def _flush_seconds():
+    return float(getattr(settings, 'CONTENIDO_DEMO_QUOTA_FLUSH_SECONDS', _DEFAULT_FLUSH_SECONDS))
+
+
+class _Quota:
+    def __init__(self, config_id, provider):
+        self.config_id = config_id
+        self.provider = provider
+        self.snapshot = None        # dict como el de get(), o None si nunca se registró cupo
+        self.updated_mono = None    # último observe() o carga desde la base
+        self.flushed = None         # snapshot tal como quedó en la fila
+        self.flushed_mono = None
+        self.timer = None
+
+
+def _from_row(cfg):
+    if cfg.quota_checked_at is None:
+        return None
+    return {
+        'checked_at': cfg.quota_checked_at,
+        'remaining_requests': cfg.quota_remaining_requests,
+        'limit_requests': cfg.quota_limit_requests,
+        'requests_reset_at': cfg.quota_requests_reset_at,
+        'remaining_tokens': cfg.quota_remaining_tokens,
+        'limit_tokens': cfg.quota_limit_tokens,
+    }
+
+
+def register(cfg):
+    """Siembra el cupo de una fila de GlobalAIConfig ya leída (ver
+    ai_router._build_demo_fallback), sin otra consulta. Si este proceso ya
+    lo tenía, se queda con lo suyo salvo que la fila sea más nueva."""
+    row = _from_row(cfg)
+    now = time.monotonic()
+    with _lock:
+        if cfg.is_active:
+            _providers[cfg.provider] = cfg.id
+        elif _providers.get(cfg.provider) == cfg.id:
+            del _providers[cfg.provider]
+        quota = _quotas.get(cfg.id)
+        if quota is None:
+            quota = _quotas[cfg.id] = _Quota(cfg.id, cfg.provider)
+        if row is not None and (quota.snapshot is None or row['checked_at'] > quota.snapshot['checked_at']):
+            quota.snapshot = row
+            quota.flushed = dict(row)
+        quota.updated_mono = now
+
+
+def forget():
+    """Se cambió o borró una fila de GlobalAIConfig (ver signals.py): la
+    próxima lectura vuelve a la base. Lo pendiente de escribir se escribe."""
+    flush_all()
+    with _lock:
+        for quota in _quotas.values():
+            if quota.timer is not None:
+                quota.timer.cancel()
+        _quotas.clear()
+        _providers.clear()
+
+
+def _load(config_id=None, provider=None):
+    from .models import GlobalAIConfig
+    with _lock:
+        _stats['db_reads'] += 1
+    try:
+        if config_id is not None:
+            cfg = GlobalAIConfig.objects.filter(pk=config_id).first()
+        else:
+            cfg = GlobalAIConfig.objects.filter(provider=provider, is_active=True).first()
+    except Exception:
+        return None
+    if cfg is None:
+        return None
+    register(cfg)
+    return cfg.id
+
+
+def get(config_id):
+    """Último cupo conocido de una fila (dict con checked_at,
+    remaining_requests, limit_requests, requests_reset_at,
+    remaining_tokens, limit_tokens), o None si nunca se registró."""
+    with _lock:
+        quota = _quotas.get(config_id)
+        fresh = (
+            quota is not None and quota.updated_mono is not None
+            and time.monotonic() - quota.updated_mono < _flush_seconds()
+        )
+        if fresh:
+            return dict(quota.snapshot) if quota.snapshot else None
+    # Sin datos propios recientes: lo que haya escrito cualquier proceso.
+    if _load(config_id=config_id) is None:
+        return None
+    with _lock:
+        quota = _quotas.get(config_id)
+        return dict(quota.snapshot) if quota is not None and quota.snapshot else None
+
+
+def get_for_provider(provider):
+    """get() de la fila activa de ese proveedor del fallback de demo. La
+    fila se busca en la base solo si este proceso todavía no la conoce."""
+    with _lock:
+        config_id = _providers.get(provider)
+    if config_id is None:
+        config_id = _load(provider=provider)
+        if config_id is None:
+            return None
+    return get(config_id)
+
+
+def _significant(old, new):
+    if old is None:
+        return True
+    if new['limit_requests'] != old.get('limit_requests') or new['limit_tokens'] != old.get('limit_tokens'):
+        return True
+    for field in ('remaining_requests', 'remaining_tokens'):
+        # Agotado (o recuperado de agotado): otros procesos lo usan para
+        # enrutar a Gemini.
+        if (new[field] is not None and new[field] <= 0) != (old.get(field) is not None and old[field] <= 0):
+            return True
+    limit = new['limit_requests']
+    if limit and new['remaining_requests'] is not None and old.get('remaining_requests') is not None:
+        if abs(old['remaining_requests'] - new['remaining_requests']) >= limit * _SIGNIFICANT_REQUESTS_DROP:
+            return True
+    return False
+
+
+def observe(config_id, rate_limit, provider=''):
+    """Cupo informado en los headers de una respuesta (ver
+    OpenAICompatibleBackend._parse_rate_limit_headers)."""
+    from django.utils import timezone
+    from .ai_router import _parse_duration_to_seconds
+
+    now = timezone.now()
+    reset_seconds = _parse_duration_to_seconds(rate_limit.get('reset_requests_raw'))
+    snapshot = {
+        'checked_at': now,
+        'remaining_requests': rate_limit.get('remaining_requests'),
+        'limit_requests': rate_limit.get('limit_requests'),
+        'requests_reset_at': (now + timedelta(seconds=reset_seconds)) if reset_seconds else None,
+        'remaining_tokens': rate_limit.get('remaining_tokens'),
+        'limit_tokens': rate_limit.get('limit_tokens'),
+    }
+    mono = time.monotonic()
+    flush_now = False
+    with _lock:
+        quota = _quotas.get(config_id)
+        if quota is None:
+            quota = _quotas[config_id] = _Quota(config_id, provider)
+        quota.snapshot = snapshot
+        quota.updated_mono = mono
+        _stats['observed'] += 1
+        interval = _flush_seconds()
+        if (
+            quota.flushed_mono is None or mono - quota.flushed_mono >= interval
+            or _significant(quota.flushed, snapshot)
+        ):
+            flush_now = True
+        elif quota.timer is None:
+            # Escritura final: si no llegan más respuestas, lo último igual
+            # queda en la fila a lo sumo `interval` segundos después.
+            delay = max(0.0, interval - (mono - quota.flushed_mono))
+            quota.timer = threading.Timer(delay, _flush_from_timer, args=(config_id,))
+            quota.timer.name = 'demo-quota-flush'
+            quota.timer.daemon = True
+            quota.timer.start()
+    if flush_now:
+        _flush(config_id)
+
+
+def _flush(config_id):
+    with _lock:
+        quota = _quotas.get(config_id)
+        if quota is None:
+            return
+        if quota.timer is not None:
+            quota.timer.cancel()
+            quota.timer = None
+        snapshot = quota.snapshot
+        if snapshot is None or snapshot == quota.flushed:
+            return
+        quota.flushed = dict(snapshot)
+        quota.flushed_mono = time.monotonic()
+        _stats['flushes'] += 1
+    try:
+        from .models import GlobalAIConfig
+        GlobalAIConfig.objects.filter(pk=config_id).update(
+            quota_checked_at=snapshot['checked_at'],
+            quota_remaining_requests=snapshot['remaining_requests'],
+            quota_limit_requests=snapshot['limit_requests'],
+            quota_requests_reset_at=snapshot['requests_reset_at'],
+            quota_remaining_tokens=snapshot['remaining_tokens'],
+            quota_limit_tokens=snapshot['limit_tokens'],
+        )
+    except Exception as e:
+        logger.warning(f'No se pudo guardar el cupo del fallback global: {e}')
+
+
+def _flush_from_timer(config_id):
+    from django.db import connection
+    try:
+        _flush(config_id)
+    finally:
+        # La conexión de este thread no la cierra nadie más.
+        connection.close()
+
+
+def flush_all():
+    with _lock:
+        config_ids = list(_quotas)
+    for config_id in config_ids:
+        _flush(config_id)
+
+
+def get_stats():
+    """Respuestas observadas contra escrituras y lecturas de GlobalAIConfig
+    en este proceso (diagnóstico para admins)."""
+    with _lock:
+        stats = dict(_stats)
+        stats['providers'] = {
+            provider: (_quotas[config_id].snapshot or {}).get('remaining_requests') if config_id in _quotas else None
+            for provider, config_id in _providers.items()
+        }
+    return stats
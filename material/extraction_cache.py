@@ -0,0 +1,174 @@
+"""
+Caché en disco del resultado de extraer un documento (capítulos, TOC,
+páginas escaneadas, mapa de páginas impresas — ver
+ia_processor.extract_text_advanced).
+
+El mismo archivo se extraía de cero hasta tres veces por flujo: al subirlo,
+al reabrirlo desde "Mis Contenidos" (process_contenido_by_id) y otra vez en
+cada generación de preguntas (stream_questions / generate_questions_from_
+chapters). Con libros de 300-600 páginas eso son varios segundos de CPU por
+request en el único worker de gunicorn. Con esta caché, la primera pasada
+extrae y guarda el resultado, y las siguientes cuestan solo leer un archivo.
+
+La clave es el contenido del archivo (SHA-256, el mismo Contenido.file_hash
+que ya se usa para deduplicar subidas — ver cleanup.compute_file_hash), no
+su ruta: un mismo libro subido dos veces, o restaurado tras expirar, reusa
+el mismo resultado. Además entran en la clave las opciones que cambian la
+salida (remove_headers/remove_footers, pages_per_block) y
+EXTRACTOR_VERSION de document_processor.py — subir ese número invalida de
+un saque todo lo extraído con la lógica anterior.
+
+Archivos JSON sueltos en `var/` (igual que el buffer de groq_monitor), sin
+modelo Django ni migración: es un artefacto derivado, si se pierde (redeploy,
+disco efímero de Render) se vuelve a generar solo. El tamaño total está
+acotado por CONTENIDO_EXTRACTION_CACHE_MAX_MB con desalojo LRU (la fecha de
+modificación de cada archivo se actualiza en cada acierto).
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_MAX_MB = 200
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+
+def _cache_dir():
+    return Path(getattr(
+        settings, 'CONTENIDO_EXTRACTION_CACHE_DIR',
+        Path(settings.BASE_DIR) / 'var' / 'extraction_cache',
+    ))
+
+
+def _max_bytes():
+    return int(getattr(settings, 'CONTENIDO_EXTRACTION_CACHE_MAX_MB', _DEFAULT_MAX_MB)) * 1024 * 1024
+
+
+def _bump(counter, amount=1):
+    with _lock:
+        _stats[counter] += amount
+
+
+def make_key(file_hash, file_extension, remove_headers, remove_footers, pages_per_block, extractor_version):
+    """Clave estable para un resultado de extracción. `file_hash` es el
+    SHA-256 del archivo; el resto son las opciones que cambian la salida."""
+    raw = '|'.join(str(part) for part in (
+        file_hash, file_extension.lower(), bool(remove_headers), bool(remove_footers),
+        pages_per_block, extractor_version,
+    ))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def get(key):
+    """Devuelve el resultado guardado para `key`, o None. Nunca levanta
+    excepción: un archivo corrupto o ilegible cuenta como fallo de caché
+    (y se borra para no volver a tropezar con él)."""
+    path = _cache_dir() / f'{key}.json'
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            result = json.load(f)
+    except FileNotFoundError:
+        _bump('misses')
+        return None
+    except (OSError, ValueError) as exc:
+        logger.warning(f'Caché de extracción ilegible ({path.name}): {exc} — se descarta.')
+        try:
+            path.unlink()
+        except OSError:
+            pass
+        _bump('misses')
+        return None
+
+    try:
+        os.utime(path)  # LRU: marcar como recién usado
+    except OSError:
+        pass
+    _bump('hits')
+    return result
+
+
+def put(key, result):
+    """Guarda `result` bajo `key` (escritura atómica: archivo temporal +
+    rename, así un lector concurrente nunca ve un JSON a medio escribir) y
+    desaloja lo menos usado si se pasó del tamaño máximo. Best-effort: un
+    error de disco solo se loguea, la extracción ya está hecha igual."""
+    cache_dir = _cache_dir()
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False)
+            os.replace(tmp_path, cache_dir / f'{key}.json')
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    except Exception as exc:
+        logger.warning(f'No se pudo guardar la caché de extracción: {exc}')
+        return
+    _bump('writes')
+    _evict_if_needed(cache_dir)
+
+
+def _evict_if_needed(cache_dir):
+    max_bytes = _max_bytes()
+    entries = []
+    total = 0
+    for path in cache_dir.glob('*.json'):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if total <= max_bytes:
+        return
+
+    entries.sort()  # más viejo (menos usado) primero
+    evicted = 0
+    for _mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    if evicted:
+        _bump('evictions', evicted)
+        logger.info(f'Caché de extracción: {evicted} entrada(s) desalojada(s) por tamaño.')
+
+
+def get_stats():
+    """Contadores del proceso actual (se reinician con cada reinicio del
+    worker) más el tamaño actual en disco."""
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+
+    entries = 0
+    size = 0
+    for path in _cache_dir().glob('*.json'):
+        try:
+            size += path.stat().st_size
+        except OSError:
+            continue
+        entries += 1
+    stats['entries'] = entries
+    stats['size_bytes'] = size
+    stats['max_bytes'] = _max_bytes()
+    return stats
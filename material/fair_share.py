@@ -0,0 +1,305 @@
+"""
+Turnos justos entre usuarios para el fallback compartido de demo.
+
+Todos los docentes con source='shared_demo' gastan del mismo cupo de
+GlobalAIConfig, y shared_rate_limit.acquire lo reparte por orden de llegada
+(en realidad, por quién pregunta primero después de cada reinicio de
+ventana): un docente generando 45k tokens de capítulos, con varios
+fragmentos en paralelo, se quedaba con el minuto — o el día — y el resto
+esperaba detrás. TrainingQuotaGuardBackend solo corta a las cuentas del
+Área de Pruebas cuando el cupo baja del 50%; entre docentes reales no había
+nada.
+
+Acá cada llamada al pool (una fila de GlobalAIConfig) espera su turno antes
+de pedir cupo a shared_rate_limit. Hay una cola por usuario ("flujo") y los
+turnos se reparten con deficit round-robin ponderado: en cada vuelta un
+flujo suma `peso x _QUANTUM_MINUTES` de crédito y pasa las llamadas que le
+alcancen. El costo de una llamada es lo que consume del pool medido en
+minutos: el mayor entre tokens / TPM y 1 / RPM (así un fragmento grande
+cuesta más que uno chico, y muchas llamadas chicas igual pagan por
+request). El peso sale de la clase (CONTENIDO_FAIR_SHARE_WEIGHTS): docentes
+reales, el monitoreo de Groq y las cuentas de prueba.
+
+Solo una llamada por pool está a la vez "pidiendo cupo" (dentro de turn()):
+cuando shared_rate_limit no tiene margen, la que espera el reinicio de la
+ventana es la que eligió el round-robin, no la que tuvo suerte en el
+sondeo. Sin competencia, turn() no espera nada.
+
+El estado es del proceso: con el worker de generación en el mismo proceso
+que la web (CONTENIDO_GENERATION_WORKER='thread', el default) las colas y
+estimate() ven todo. Con varios procesos cada uno reparte lo suyo, y entre
+procesos coordina shared_rate_limit como antes.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CLASS_TEACHER = 'teacher'
+CLASS_MONITOR = 'monitor'
+CLASS_TRAINING = 'training'
+
+_DEFAULT_WEIGHTS = {CLASS_TEACHER: 4, CLASS_MONITOR: 2, CLASS_TRAINING: 1}
+_MIN_WEIGHT = 0.1
+# Crédito por vuelta y por unidad de peso, en minutos del pool: con un TPM
+# de 6000, 600 tokens para una cuenta de prueba y 2400 para un docente.
+_QUANTUM_MINUTES = 0.1
+# Límites que se suponen cuando el proveedor todavía no informó el TPM
+# (ver demo_quota.py) — los del plan gratis de Groq.
+_DEFAULT_TPM = 6000
+_DEFAULT_RPM = 30
+_DEFAULT_MAX_WAIT = 120
+
+# Quién hace la llamada en curso (lo pone FairShareBackend, ver ai_router).
+_current_flow = contextvars.ContextVar('fair_share_flow', default=None)
+_ANONYMOUS_FLOW = (CLASS_TEACHER, 'anon')
+
+
+@contextmanager
+def as_flow(priority_class, owner):
+    """Las llamadas al pool dentro del bloque son de `owner` (clave de la
+    cola, p. ej. 'user-12') con la prioridad de `priority_class`."""
+    token = _current_flow.set((priority_class, owner))
+    try:
+        yield
+    finally:
+        _current_flow.reset(token)
+
+
+def owner_for_user(user):
+    """Clave de la cola de un usuario (la que reciben as_flow y estimate)."""
+    return f'user-{user.pk}'
+
+
+def _weight(priority_class):
+    weights = getattr(settings, 'CONTENIDO_FAIR_SHARE_WEIGHTS', None) or _DEFAULT_WEIGHTS
+    weight = weights.get(priority_class, _DEFAULT_WEIGHTS.get(priority_class, 1))
+    return max(float(weight), _MIN_WEIGHT)
+
+
+def _cost(pool_id, tokens):
+    """Minutos del pool que consume una llamada de ~`tokens` tokens."""
+    from . import demo_quota
+
+    quota = demo_quota.get(pool_id) or {}
+    tpm = quota.get('limit_tokens') or _DEFAULT_TPM
+    rpm = float(getattr(settings, 'CONTENIDO_FAIR_SHARE_RPM', _DEFAULT_RPM)) or _DEFAULT_RPM
+    return max((tokens or 0) / tpm, 1.0 / rpm)
+
+
+class _Request:
+    __slots__ = ('flow', 'cost', 'granted', 'event', 'enqueued')
+
+    def __init__(self, flow, cost):
+        self.flow = flow
+        self.cost = cost
+        self.granted = False
+        self.event = threading.Event()
+        self.enqueued = time.monotonic()
+
+
+class _Flow:
+    def __init__(self, key):
+        self.key = key
+        self.quantum = _weight(key[0]) * _QUANTUM_MINUTES
+        self.queue = deque()
+        self.deficit = 0.0
+        self.visiting = False  # ya sumó el crédito de esta vuelta
+
+    def pending_cost(self):
+        return sum(request.cost for request in self.queue)
+
+
+class _Pool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flows = {}        # solo los que tienen llamadas esperando
+        self.active = deque()  # orden del round-robin
+        self.busy = False      # hay una llamada con el turno
+        self.stats = {}        # clase -> {'granted', 'queued', 'wait_seconds', 'timeouts'}
+
+    def _count(self, priority_class, field, amount=1):
+        stats = self.stats.setdefault(priority_class, {'granted': 0, 'queued': 0, 'wait_seconds': 0.0, 'timeouts': 0})
+        stats[field] += amount
+
+    def _drop_flow(self, flow):
+        flow.deficit = 0.0
+        flow.visiting = False
+        self.flows.pop(flow.key, None)
+        try:
+            self.active.remove(flow)
+        except ValueError:
+            pass
+
+    def _next(self):
+        """Deficit round-robin: la próxima llamada que pasa, o None."""
+        while self.active:
+            flow = self.active[0]
+            if not flow.visiting:
+                flow.deficit += flow.quantum
+                flow.visiting = True
+            head = flow.queue[0]
+            if head.cost <= flow.deficit:
+                flow.queue.popleft()
+                flow.deficit -= head.cost
+                if not flow.queue:
+                    # Un flujo que se vacía no guarda crédito para después.
+                    self._drop_flow(flow)
+                return head
+            flow.visiting = False
+            self.active.rotate(-1)
+        return None
+
+    def _grant(self, request):
+        """Con self.lock tomado."""
+        self.busy = True
+        request.granted = True
+        waited = time.monotonic() - request.enqueued
+        self._count(request.flow[0], 'granted')
+        self._count(request.flow[0], 'wait_seconds', waited)
+        request.event.set()
+
+    def enqueue(self, flow_key, cost):
+        request = _Request(flow_key, cost)
+        with self.lock:
+            if not self.busy and not self.active:
+                self._grant(request)
+                return request
+            flow = self.flows.get(flow_key)
+            if flow is None:
+                flow = self.flows[flow_key] = _Flow(flow_key)
+                self.active.append(flow)
+            flow.queue.append(request)
+            self._count(flow_key[0], 'queued')
+            if not self.busy:
+                self._grant(self._next())
+        return request
+
+    def cancel(self, request):
+        """Saca de la cola una llamada que se cansó de esperar. False si en
+        el medio le tocó el turno (hay que usarlo y pasarlo)."""
+        with self.lock:
+            if request.granted:
+                return False
+            flow = self.flows.get(request.flow)
+            if flow is not None:
+                try:
+                    flow.queue.remove(request)
+                except ValueError:
+                    pass
+                if not flow.queue:
+                    self._drop_flow(flow)
+            self._count(request.flow[0], 'timeouts')
+            return True
+
+    def pass_turn(self):
+        with self.lock:
+            self.busy = False
+            request = self._next()
+            if request is not None:
+                self._grant(request)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(pool_id):
+    with _pools_lock:
+        pool = _pools.get(pool_id)
+        if pool is None:
+            pool = _pools[pool_id] = _Pool()
+        return pool
+
+
+@contextmanager
+def turn(pool_id, tokens, max_wait=None):
+    """
+    Espera el turno de la llamada en curso (del flujo de as_flow, o uno
+    anónimo con prioridad de docente) para el pool `pool_id` (id de
+    GlobalAIConfig). Adentro del bloque va el pedido de cupo a
+    shared_rate_limit; al salir, el turno pasa al siguiente.
+
+    Lanza shared_rate_limit.QuotaWaitTooLong si el turno no llega en
+    `max_wait` segundos (default: CONTENIDO_FAIR_SHARE_MAX_WAIT_SECONDS):
+    para quien llama es lo mismo que un pool sin cupo.
+    """
+    from .shared_rate_limit import QuotaWaitTooLong
+
+    if max_wait is None:
+        max_wait = float(getattr(settings, 'CONTENIDO_FAIR_SHARE_MAX_WAIT_SECONDS', _DEFAULT_MAX_WAIT))
+    pool = _pool(pool_id)
+    flow_key = _current_flow.get() or _ANONYMOUS_FLOW
+    request = pool.enqueue(flow_key, _cost(pool_id, tokens))
+    if not request.event.wait(max_wait) and pool.cancel(request):
+        raise QuotaWaitTooLong(max_wait)
+    try:
+        yield
+    finally:
+        pool.pass_turn()
+
+
+def wait_turn(pool_id, tokens, max_wait=None):
+    """turn() sin nada adentro, para llamadas con la key del pool que no
+    pasan por shared_rate_limit (el monitoreo de Groq): esperan su turno
+    como las demás y lo pasan apenas salen."""
+    with turn(pool_id, tokens, max_wait):
+        pass
+
+
+def estimate(owner):
+    """
+    Cola del pool compartido vista por `owner` (p. ej. 'user-12'), para el
+    evento 'start' del SSE: llamadas esperando turno ('queue_depth'),
+    usuarios con llamadas esperando ('active_users') y cuánto tendría que
+    esperar una llamada nueva suya ('estimated_wait_seconds'): una vuelta
+    del round-robin, lo que cada otro flujo puede pasar antes (su crédito
+    por vuelta, o lo que tenga en cola si es menos), más lo que ya tiene
+    encolado el mismo `owner`. Con el pool sin cupo eso es lo que dura;
+    con margen, es una cota de arriba.
+    """
+    depth, users, wait_minutes = 0, set(), 0.0
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool_wait = 0.0
+        with pool.lock:
+            for flow in pool.active:
+                depth += len(flow.queue)
+                users.add(flow.key[1])
+                if flow.key[1] == owner:
+                    pool_wait += flow.pending_cost()
+                else:
+                    pool_wait += min(flow.pending_cost(), flow.quantum)
+        wait_minutes = max(wait_minutes, pool_wait)
+    return {
+        'queue_depth': depth,
+        'active_users': len(users),
+        'estimated_wait_seconds': int(round(wait_minutes * 60)),
+    }
+
+
+def get_stats():
+    """Por pool: llamadas esperando y, por clase, turnos dados, tiempo
+    total esperado y esperas vencidas en este proceso (diagnóstico para
+    admins)."""
+    with _pools_lock:
+        pools = list(_pools.items())
+    result = {}
+    for pool_id, pool in pools:
+        with pool.lock:
+            result[pool_id] = {
+                'waiting': sum(len(flow.queue) for flow in pool.active),
+                'busy': pool.busy,
+                'classes': {
+                    priority_class: dict(stats, wait_seconds=round(stats['wait_seconds'], 1))
+                    for priority_class, stats in pool.stats.items()
+                },
+            }
+    return result
@@ -0,0 +1,223 @@
+"""
+Caché opcional de respuestas de la IA para la generación de preguntas (ver
+_generate_questions_for_chunk en views_document_processor.py).
+
+Regenerar el mismo capítulo (un corte de red a mitad de la corrida, reabrir
+el dashboard y volver a pedir lo mismo) mandaba exactamente el mismo prompt
+otra vez y se volvía a pagar entero — en las demos, contra el cupo diario
+(RPD) del fallback compartido. Con CONTENIDO_GENERATION_CACHE_ENABLED, una
+respuesta que ya se pudo parsear se guarda bajo un hash de todo lo que
+determina la llamada: el prompt ya armado, el backend y modelo, temperatura,
+max_tokens y el resto de opciones (json_mode, reasoning_effort...), con las
+imágenes representadas por el SHA-256 de su data-URI.
+
+Igual que la caché de extracción (extraction_cache.py): archivos JSON
+sueltos en `var/`, con vencimiento (CONTENIDO_GENERATION_CACHE_TTL_HOURS) y
+tamaño acotado por CONTENIDO_GENERATION_CACHE_MAX_MB con desalojo LRU. Quien
+quiera una respuesta nueva sí o sí (o el monitoreo de Groq, que mide al
+proveedor) pasa bypass_cache.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Subir si cambia qué entra en la clave o qué se guarda.
+GENERATION_CACHE_VERSION = 1
+
+_DEFAULT_TTL_HOURS = 24
+_DEFAULT_MAX_MB = 50
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+
+def is_enabled():
+    return bool(getattr(settings, 'CONTENIDO_GENERATION_CACHE_ENABLED', False))
+
+
+def _cache_dir():
+    return Path(getattr(
+        settings, 'CONTENIDO_GENERATION_CACHE_DIR',
+        Path(settings.BASE_DIR) / 'var' / 'generation_cache',
+    ))
+
+
+def _max_bytes():
+    return int(getattr(settings, 'CONTENIDO_GENERATION_CACHE_MAX_MB', _DEFAULT_MAX_MB)) * 1024 * 1024
+
+
+def _ttl_seconds():
+    return float(getattr(settings, 'CONTENIDO_GENERATION_CACHE_TTL_HOURS', _DEFAULT_TTL_HOURS)) * 3600
+
+
+def _bump(counter, amount=1):
+    with _lock:
+        _stats[counter] += amount
+
+
+def backend_fingerprint(backend):
+    """Qué backend y modelo responderían, sin llamar a get_status() (que en
+    varios backends hace una request de red): clase, proveedor, modelo y
+    URL de cada backend real, atravesando los envoltorios del fallback de
+    demo (GlobalFallbackBackend, DemoRoutingBackend, TrainingQuotaGuardBackend)
+    y OllamaBackend."""
+    parts = []
+
+    def walk(obj):
+        if obj is None:
+            return
+        wrapped = [getattr(obj, attr, None) for attr in ('_inner', '_groq', '_gemini', '_client')]
+        if any(w is not None for w in wrapped):
+            for w in wrapped:
+                walk(w)
+            return
+        parts.append('/'.join(str(part or '') for part in (
+            type(obj).__name__,
+            getattr(obj, 'provider', ''),
+            getattr(obj, 'model', None) or getattr(obj, 'selected_model', ''),
+            getattr(obj, 'base_url', None) or getattr(obj, 'BASE_URL', ''),
+        )))
+
+    walk(backend)
+    return '|'.join(parts)
+
+
+def make_key(prompt, fingerprint, temperature, max_tokens, generate_kwargs=None):
+    """Clave para una llamada a backend.generate(). Las imágenes de
+    `generate_kwargs` entran por su hash, no enteras."""
+    options = dict(generate_kwargs or {})
+    if options.get('images'):
+        options['images'] = [hashlib.sha256(img.encode('utf-8')).hexdigest() for img in options['images']]
+    raw = json.dumps(
+        [prompt, fingerprint, temperature, max_tokens, options, GENERATION_CACHE_VERSION],
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def get(key):
+    """Respuesta guardada para `key` (dict con 'text', 'truncated',
+    'model'), o None si no hay, venció o no se puede leer."""
+    path = _cache_dir() / f'{key}.json'
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        _bump('misses')
+        return None
+    except (OSError, ValueError) as exc:
+        logger.warning(f'Caché de generación ilegible ({path.name}): {exc} — se descarta.')
+        _discard(path)
+        _bump('misses')
+        return None
+
+    if time.time() - entry.get('created_at', 0) > _ttl_seconds():
+        _discard(path)
+        _bump('misses')
+        return None
+
+    try:
+        os.utime(path)  # LRU: marcar como recién usado
+    except OSError:
+        pass
+    _bump('hits')
+    return entry
+
+
+def put(key, result):
+    """Guarda lo necesario de un resultado de backend.generate() (solo
+    llamar con respuestas exitosas y parseables). Best-effort, igual que
+    extraction_cache.put."""
+    entry = {
+        'text': result.get('text'),
+        'truncated': bool(result.get('truncated')),
+        'model': result.get('model'),
+        'tokens': result.get('tokens', 0),
+        'created_at': time.time(),
+    }
+    cache_dir = _cache_dir()
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, cache_dir / f'{key}.json')
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    except Exception as exc:
+        logger.warning(f'No se pudo guardar la caché de generación: {exc}')
+        return
+    _bump('writes')
+    _evict_if_needed(cache_dir)
+
+
+def _discard(path):
+    try:
+        path.unlink()
+    except OSError:
+        pass
+
+
+def _evict_if_needed(cache_dir):
+    max_bytes = _max_bytes()
+    entries = []
+    total = 0
+    for path in cache_dir.glob('*.json'):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if total <= max_bytes:
+        return
+
+    entries.sort()  # más viejo (menos usado) primero
+    evicted = 0
+    for _mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    if evicted:
+        _bump('evictions', evicted)
+        logger.info(f'Caché de generación: {evicted} entrada(s) desalojada(s) por tamaño.')
+
+
+def get_stats():
+    """Contadores del proceso actual más el tamaño actual en disco."""
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+
+    entries = 0
+    size = 0
+    for path in _cache_dir().glob('*.json'):
+        try:
+            size += path.stat().st_size
+        except OSError:
+            continue
+        entries += 1
+    stats['entries'] = entries
+    stats['size_bytes'] = size
+    stats['max_bytes'] = _max_bytes()
+    return stats
@@ -0,0 +1,217 @@
+"""
+Generación de preguntas por fragmentos con concurrencia acotada (ver
+stream_questions en views_document_processor.py).
+
+Antes cada fragmento esperaba al anterior y, entre uno y otro, había un
+`time.sleep(2)` fijo "para no pasarse del TPM/RPM de Groq": una corrida de
+15 fragmentos eran 15 idas y vueltas completas al proveedor más ~28 s de
+pausas, fuera cual fuera el límite real de la key. Ahora:
+
+- Hasta CONTENIDO_GENERATION_CONCURRENCY fragmentos se piden a la vez, en
+  un pool de threads chico (la llamada al proveedor es casi toda espera de
+  red, el GIL no molesta).
+- Cada llamada pasa antes por un token bucket (RateLimiter) con dos baldes:
+  requests por minuto y tokens por minuto. El de tokens toma su capacidad
+  del `limit_tokens` que ya parsea
+  OpenAICompatibleBackend._parse_rate_limit_headers, y el nivel de los dos
+  se sincroniza con el `remaining_*` de cada respuesta — el proveedor es
+  quien sabe cuánto queda de verdad (la key del fallback de demo la
+  comparten todos los docentes).
+- Los resultados se entregan en el orden de los fragmentos (iter_in_order),
+  así los eventos SSE salen igual que antes y el tope de "cantidad de
+  preguntas" se aplica sobre la misma secuencia. Lo mismo vale para los
+  adelantos que cada fragmento emite mientras la IA escribe (preguntas
+  sueltas, con streaming del proveedor).
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_CONCURRENCY = 3
+# RPM del plan gratuito de Groq (el proveedor default del fallback de demo).
+# No viene en los headers — ahí Groq manda requests por DÍA, no por minuto.
+_DEFAULT_RPM = 30
+# Nunca dormir más que esto de una sola vez esperando cupo: si el reloj del
+# balde se desfasa con el del proveedor, mejor reintentar el cálculo seguido.
+_MAX_WAIT_SECONDS = 5.0
+
+
+def get_concurrency():
+    """Fragmentos en vuelo a la vez (1 = de a uno, como antes)."""
+    return max(1, int(getattr(settings, 'CONTENIDO_GENERATION_CONCURRENCY', _DEFAULT_CONCURRENCY)))
+
+
+class _Bucket:
+    """Un balde: `capacity` unidades que se rellenan a capacity/60 por
+    segundo. capacity None = sin límite conocido."""
+
+    def __init__(self, capacity=None):
+        self.capacity = None
+        self.level = 0.0
+        self.updated_at = time.monotonic()
+        self.set_capacity(capacity)
+
+    def set_capacity(self, capacity):
+        if not capacity or capacity <= 0:
+            self.capacity = None
+            return
+        if self.capacity is None:
+            self.level = float(capacity)  # arranca lleno
+        else:
+            self.level = min(self.level, float(capacity))
+        self.capacity = float(capacity)
+
+    def refill(self, now):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60.0)
+        self.updated_at = now
+
+    def clamp(self, cost):
+        # Una sola request más grande que todo el balde nunca entraría:
+        # se la deja pasar con el balde lleno (el proveedor dirá si no).
+        return cost if self.capacity is None else min(cost, self.capacity)
+
+    def wait_for(self, cost):
+        """Segundos hasta tener `cost` unidades (0 si ya están)."""
+        if self.capacity is None or self.level >= cost:
+            return 0.0
+        return (cost - self.level) * 60.0 / self.capacity
+
+
+class RateLimiter:
+    """
+    Token bucket por requests y por tokens por minuto, compartido por los
+    threads de una misma corrida.
+
+    acquire(tokens) bloquea hasta que haya cupo para una request de ese
+    tamaño estimado; observe(rate_limit) ajusta los baldes con lo que
+    informó el proveedor en la respuesta.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self._lock = threading.Lock()
+        self._requests = _Bucket(rpm)
+        self._tokens = _Bucket(tpm)
+
+    @classmethod
+    def for_backend(cls, backend):
+        """Limitador inicial para un backend: RPM según settings y, con el
+        fallback compartido de demo, el TPM y el cupo restante del último
+        snapshot de Groq (GlobalAIConfig). Con BYOK arranca sin TPM y lo
+        aprende de los headers de la primera respuesta."""
+        from .ai_router import SharedDemoBackend, get_global_demo_quota
+
+        limiter = cls(rpm=int(getattr(settings, 'CONTENIDO_GENERATION_RPM', _DEFAULT_RPM)))
+        if isinstance(backend, SharedDemoBackend):
+            quota = get_global_demo_quota()
+            if quota:
+                limiter.observe({
+                    'limit_tokens': quota.get('limit_tokens'),
+                    'remaining_tokens': quota.get('remaining_tokens'),
+                })
+        return limiter
+
+    def acquire(self, tokens=0):
+        """Bloquea hasta poder mandar una request de ~`tokens` tokens
+        (prompt + max_tokens de salida, que es lo que Groq descuenta del TPM
+        al recibirla). Devuelve los segundos esperados."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._requests.refill(now)
+                self._tokens.refill(now)
+                token_cost = self._tokens.clamp(tokens)
+                wait = max(self._requests.wait_for(1), self._tokens.wait_for(token_cost))
+                if wait <= 0:
+                    if self._requests.capacity is not None:
+                        self._requests.level -= 1
+                    if self._tokens.capacity is not None:
+                        self._tokens.level -= token_cost
+                    return waited
+            wait = min(wait, _MAX_WAIT_SECONDS)
+            time.sleep(wait)
+            waited += wait
+
+    def observe(self, rate_limit):
+        """Ajusta los baldes con el dict de _parse_rate_limit_headers (o
+        None si el proveedor no manda esos headers). limit_requests no se
+        usa como RPM: en Groq es por día."""
+        if not rate_limit:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            limit_tokens = rate_limit.get('limit_tokens')
+            if limit_tokens:
+                self._tokens.set_capacity(limit_tokens)
+            # Solo hacia abajo: las requests propias que siguen en vuelo ya
+            # se descontaron acá pero todavía no en el número del proveedor.
+            remaining_tokens = rate_limit.get('remaining_tokens')
+            if remaining_tokens is not None and self._tokens.capacity is not None:
+                self._tokens.level = min(self._tokens.level, float(remaining_tokens))
+            remaining_requests = rate_limit.get('remaining_requests')
+            if remaining_requests is not None and self._requests.capacity is not None:
+                self._requests.level = min(self._requests.level, float(remaining_requests))
+
+
+def iter_in_order(items, fn, max_workers=None):
+    """
+    Aplica fn(item, emit) en un pool de hasta `max_workers` threads y va
+    devolviendo, en el orden de `items`, tuplas (item, tipo, valor):
+
+    - ('partial', x) por cada emit(x) que haga fn mientras corre (ej. cada
+      pregunta apenas la IA la termina de escribir, ver question_stream.py);
+    - al final, ('result', resultado) o ('error', excepción).
+
+    Los parciales del item que se está entregando salen apenas se emiten; los
+    de items que van por delante quedan en su cola hasta que les toque, así
+    el orden de los eventos no depende de qué thread termina primero.
+
+    Nunca hay más de `max_workers` items despachados por delante del que se
+    está entregando: si quien consume corta la iteración (tope de preguntas
+    alcanzado, cliente SSE que se desconecta), los que no arrancaron se
+    cancelan y como mucho se pierden las llamadas que ya estaban en vuelo.
+    """
+    from django.db import connections
+
+    max_workers = max_workers or get_concurrency()
+    items = list(items)
+
+    def run(item, events):
+        try:
+            events.put(('result', fn(item, lambda value: events.put(('partial', value)))))
+        except Exception as exc:
+            events.put(('error', exc))
+        finally:
+            # Cada thread del pool abre su propia conexión a la BD (prompt
+            # configurado, snapshot de cupo...): cerrarla al terminar, Django
+            # solo cierra solo las de los threads de request.
+            connections.close_all()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='questions-gen')
+    pending = []
+    next_idx = 0
+    try:
+        for item in items:
+            while next_idx < len(items) and len(pending) < max_workers:
+                events = queue.SimpleQueue()
+                pending.append((executor.submit(run, items[next_idx], events), events))
+                next_idx += 1
+            _future, events = pending.pop(0)
+            while True:
+                kind, value = events.get()
+                yield item, kind, value
+                if kind != 'partial':
+                    break
+    finally:
+        for future, _events in pending:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,343 @@
+"""
+Jobs de generación de preguntas persistidos en la base (GenerationJob y
+GenerationJobChunk en models.py).
+
+El POST de generate_questions_from_chapters crea el job. Lo genera un
+worker (generation_worker.py: threads del mismo proceso o el comando
+run_generation_worker), que lo reclama con claim_next() y va guardando cada
+fragmento terminado, y las preguntas que la IA adelanta del fragmento en
+curso, antes de seguir. stream_questions solo lee: cada conexión SSE (con el
+Last-Event-ID que manda solo el navegador al reconectarse = último fragmento
+recibido) reenvía lo guardado posterior a ese id y sigue lo nuevo (tail()).
+
+Si el worker que lo generaba muere (reinicio, deploy), su reclamo deja de
+renovarse y pasado _CLAIM_STALE_SECONDS otro lo retoma desde el primer
+fragmento pendiente. Como todo pasa por la base, cualquier worker de
+gunicorn puede atender cualquier conexión.
+"""
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import F, FilteredRelation, Q
+from django.utils import timezone
+
+from .models import GenerationJob, GenerationJobChunk
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_TTL_HOURS = 24
+_DEFAULT_ABANDON_SECONDS = 120
+# Sin heartbeat por más que esto, el worker que generaba se da por muerto.
+# Mientras corre, keep_claimed() lo renueva cada _HEARTBEAT_SECONDS aunque
+# un paso (extraer el documento, una llamada lenta, esperar turno o cupo)
+# tarde minutos sin guardar nada: solo vence si el proceso murió.
+_CLAIM_STALE_SECONDS = 180
+_HEARTBEAT_SECONDS = 30
+# Espera entre lecturas de tail(): arranca en el mínimo y, mientras no haya
+# nada nuevo, se estira hasta el máximo (cada lectura es una consulta a
+# Neon por conexión SSE abierta, y la mantiene despierta).
+_TAIL_POLL_MIN_SECONDS = 1.0
+_TAIL_POLL_MAX_SECONDS = 5.0
+_TAIL_POLL_BACKOFF = 1.5
+# Cada cuánto, sin novedades, se manda un comentario SSE: mantiene viva la
+# conexión en proxies y hace que se note si el cliente se fue.
+_TAIL_KEEPALIVE_SECONDS = 10
+# Cada cuánto una conexión SSE abierta marca el job como mirado (bien por
+# debajo de CONTENIDO_GENERATION_JOB_ABANDON_SECONDS).
+_TOUCH_EVERY_SECONDS = 30
+
+
+def new_token():
+    return uuid.uuid4().hex
+
+
+def create(user, params):
+    """Crea el job y devuelve su id (str). De paso borra los vencidos
+    (CONTENIDO_GENERATION_JOB_TTL_HOURS), salvo los que se están generando o
+    alguien está mirando: esos siguen en uso aunque sean viejos."""
+    ttl_hours = float(getattr(settings, 'CONTENIDO_GENERATION_JOB_TTL_HOURS', _DEFAULT_TTL_HOURS))
+    now = timezone.now()
+    (
+        GenerationJob.objects.filter(created_at__lt=now - timedelta(hours=ttl_hours))
+        .exclude(status=GenerationJob.STATUS_RUNNING)
+        .exclude(viewed_at__gte=now - timedelta(seconds=_abandon_seconds()))
+        .delete()
+    )
+    job = GenerationJob.objects.create(user=user, params=params, viewed_at=timezone.now())
+    return str(job.pk)
+
+
+def get_for_user(job_id, user):
+    """El job si existe y es de `user`; None si no (id mal formado incluido)."""
+    try:
+        return GenerationJob.objects.get(pk=job_id, user=user)
+    except (GenerationJob.DoesNotExist, ValidationError, ValueError):
+        return None
+
+
+def _abandon_seconds():
+    return float(getattr(settings, 'CONTENIDO_GENERATION_JOB_ABANDON_SECONDS', _DEFAULT_ABANDON_SECONDS))
+
+
+def _claimable():
+    """Jobs sin terminar que nadie está generando (o cuyo worker dejó de dar
+    señales) y que alguien está mirando."""
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=_CLAIM_STALE_SECONDS)
+    return (
+        Q(status__in=(GenerationJob.STATUS_PENDING, GenerationJob.STATUS_RUNNING))
+        & (Q(claimed_by='') | Q(heartbeat_at__lt=stale_before) | Q(heartbeat_at__isnull=True))
+        & Q(viewed_at__gte=now - timedelta(seconds=_abandon_seconds()))
+    )
+
+
+@contextmanager
+def _claim_lock():
+    """
+    Serializa la búsqueda del próximo job entre workers cuando la base no
+    tiene SELECT ... FOR UPDATE SKIP LOCKED (SQLite): flock sobre
+    var/generation_jobs.lock. El UPDATE condicional de claim_next igual
+    impide que dos workers se queden con el mismo job; esto solo evita que
+    todos peleen por la misma fila.
+    """
+    if connection.features.has_select_for_update_skip_locked:
+        yield
+        return
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    lock_dir = Path(settings.BASE_DIR) / 'var'
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with open(lock_dir / 'generation_jobs.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def claim_next(token):
+    """Reclama para `token` el job reclamable más viejo y lo devuelve, o None
+    si no hay ninguno. En Postgres los workers se saltean las filas que otro
+    está reclamando (SKIP LOCKED) en vez de esperarlas."""
+    with _claim_lock(), transaction.atomic():
+        candidates = GenerationJob.objects.filter(_claimable()).order_by('created_at')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        job = candidates.first()
+        if job is None:
+            return None
+        claimed = GenerationJob.objects.filter(pk=job.pk).filter(_claimable()).update(
+            claimed_by=token, heartbeat_at=timezone.now(), status=GenerationJob.STATUS_RUNNING,
+        )
+    if not claimed:
+        return None
+    job.refresh_from_db()
+    return job
+
+
+def heartbeat(job_id, token):
+    """Renueva el reclamo. False si se perdió (otro worker lo retomó)."""
+    return GenerationJob.objects.filter(pk=job_id, claimed_by=token).update(heartbeat_at=timezone.now()) == 1
+
+
+@contextmanager
+def keep_claimed(job_id, token):
+    """
+    Renueva el reclamo cada _HEARTBEAT_SECONDS desde un thread aparte
+    mientras dura el bloque (todo _run_generation_job, ver
+    generation_worker.run_once). _save() también lo renueva, pero solo
+    cuando hay algo que guardar: sin esto, un fragmento que tarda más que
+    _CLAIM_STALE_SECONDS dejaba que otro worker retomara el job desde el
+    principio mientras este seguía gastando cupo. Si el reclamo se pierde
+    igual, el thread para y el próximo _save() devuelve False.
+    """
+    stop = threading.Event()
+
+    def tick():
+        try:
+            while not stop.wait(_HEARTBEAT_SECONDS):
+                try:
+                    if not heartbeat(job_id, token):
+                        return
+                except Exception as exc:
+                    logger.warning(f'Job {job_id}: no se pudo renovar el reclamo: {exc}')
+        finally:
+            # `connection` es por thread: cierra la de este.
+            connection.close()
+
+    ticker = threading.Thread(target=tick, name=f'generation-heartbeat-{job_id}', daemon=True)
+    ticker.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        ticker.join(timeout=5)
+
+
+def release(job_id, token):
+    GenerationJob.objects.filter(pk=job_id, claimed_by=token).update(claimed_by='', heartbeat_at=None)
+
+
+def set_total_chunks(job_id, total_chunks):
+    GenerationJob.objects.filter(pk=job_id).update(total_chunks=total_chunks)
+
+
+def _save(job_id, token, chunk, event, final):
+    with transaction.atomic():
+        if not heartbeat(job_id, token):
+            return False
+        previous = GenerationJobChunk.objects.filter(job_id=job_id, chunk=chunk).values_list('event', flat=True).first()
+        GenerationJobChunk.objects.update_or_create(
+            job_id=job_id, chunk=chunk, defaults={'event': event, 'final': final},
+        )
+        added = len(event.get('questions') or []) - len((previous or {}).get('questions') or [])
+        if added:
+            GenerationJob.objects.filter(pk=job_id).update(total_generated=F('total_generated') + added)
+    return True
+
+
+def save_partial(job_id, token, chunk, event):
+    """Guarda las preguntas adelantadas del fragmento en curso (evento
+    'partial', se reemplaza en cada llamada). False si se perdió el reclamo."""
+    return _save(job_id, token, chunk, event, final=False)
+
+
+def save_chunk(job_id, token, chunk, event):
+    """Guarda el evento de un fragmento terminado y renueva el reclamo. False
+    si el reclamo se perdió: no se guarda y quien genera tiene que cortar."""
+    return _save(job_id, token, chunk, event, final=True)
+
+
+def finish(job_id, token, status, error=''):
+    GenerationJob.objects.filter(pk=job_id, claimed_by=token).update(
+        status=status, error=error, claimed_by='', heartbeat_at=None,
+    )
+
+
+def touch(job_id):
+    """Marca el job como mirado por una conexión SSE abierta."""
+    GenerationJob.objects.filter(pk=job_id).update(viewed_at=timezone.now())
+
+
+def is_watched(job_id):
+    """False si ninguna conexión SSE lo pidió en los últimos
+    CONTENIDO_GENERATION_JOB_ABANDON_SECONDS (pestaña cerrada): el worker lo
+    pausa en vez de seguir gastando cupo, y lo retoma si vuelve a conectarse."""
+    since = timezone.now() - timedelta(seconds=_abandon_seconds())
+    return GenerationJob.objects.filter(pk=job_id, viewed_at__gte=since).exists()
+
+
+def chunk_events(job_id, after=0):
+    """[(chunk, evento)] de los fragmentos terminados con chunk > after, en orden."""
+    return list(
+        GenerationJobChunk.objects.filter(job_id=job_id, chunk__gt=after, final=True)
+        .order_by('chunk').values_list('chunk', 'event')
+    )
+
+
+def partial_events(job_id):
+    """[(chunk, evento 'partial')] de los fragmentos que se estaban
+    generando y no terminaron (worker reiniciado a mitad de uno), en orden."""
+    return list(
+        GenerationJobChunk.objects.filter(job_id=job_id, final=False)
+        .order_by('chunk').values_list('chunk', 'event')
+    )
+
+
+def _poll(job_id, after):
+    """Estado del job y sus fragmentos posteriores a `after` (terminados y,
+    si hay, el que se está generando), en una sola consulta: LEFT JOIN con
+    los fragmentos filtrados, así el job viene aunque no haya ninguno.
+    (None, []) si el job ya no existe."""
+    rows = list(
+        GenerationJob.objects.filter(pk=job_id)
+        .annotate(pending=FilteredRelation('chunks', condition=Q(chunks__chunk__gt=after)))
+        .order_by('pending__chunk')
+        .values_list(
+            'status', 'total_chunks', 'total_generated', 'error',
+            'pending__chunk', 'pending__event', 'pending__final',
+        )
+    )
+    if not rows:
+        return None, []
+    status, total_chunks, total_generated, error = rows[0][:4]
+    job = GenerationJob(
+        pk=job_id, status=status, total_chunks=total_chunks,
+        total_generated=total_generated, error=error,
+    )
+    return job, [(chunk, event, final) for *_job, chunk, event, final in rows if chunk is not None]
+
+
+def tail(job_id, state, deadline):
+    """
+    Sigue un job mientras lo genera el worker. Genera tuplas:
+
+    - ('start', job) una vez, cuando ya se conoce el total de fragmentos;
+    - ('event', (chunk, evento)) con cada fragmento terminado;
+    - ('partial', (evento, preguntas nuevas)) con lo que se adelantó del
+      fragmento siguiente;
+    - ('keepalive', None) de tanto en tanto.
+
+    Devuelve el job cuando terminó, o None al llegar a `deadline`
+    (time.monotonic()) o si el job dejó de existir (el cliente reconecta y
+    recibe "Job no encontrado"). `state` guarda 'after' (último fragmento
+    entregado), 'start_sent' y 'partial_sent' (preguntas adelantadas ya
+    entregadas, por fragmento).
+    """
+    poll = _TAIL_POLL_MIN_SECONDS
+    last_touch = last_sent = time.monotonic()
+    while True:
+        job, chunks = _poll(job_id, state['after'])
+        if job is None:
+            logger.info(f'Job {job_id}: ya no existe, se corta la transmisión.')
+            return None
+        if not state['start_sent'] and job.total_chunks is not None:
+            state['start_sent'] = True
+            # El 'start' necesita los parámetros (nombre de archivo, etc.):
+            # se leen una sola vez por conexión.
+            try:
+                yield 'start', GenerationJob.objects.get(pk=job_id)
+            except GenerationJob.DoesNotExist:
+                return None
+        delivered = False
+        for chunk, event, final in chunks:
+            if final:
+                state['after'] = chunk
+                delivered = True
+                yield 'event', (chunk, event)
+            elif chunk == state['after'] + 1:
+                questions = event.get('questions') or []
+                sent = state['partial_sent'].get(chunk, 0)
+                if len(questions) > sent:
+                    state['partial_sent'][chunk] = len(questions)
+                    delivered = True
+                    yield 'partial', (event, questions[sent:])
+        if job.status in (GenerationJob.STATUS_DONE, GenerationJob.STATUS_ERROR):
+            return job
+
+        now = time.monotonic()
+        if now >= deadline:
+            return None
+        if now - last_touch >= _TOUCH_EVERY_SECONDS:
+            touch(job_id)
+            last_touch = now
+        if delivered:
+            last_sent = now
+            poll = _TAIL_POLL_MIN_SECONDS
+        else:
+            if now - last_sent >= _TAIL_KEEPALIVE_SECONDS:
+                last_sent = now
+                yield 'keepalive', None
+            poll = min(poll * _TAIL_POLL_BACKOFF, _TAIL_POLL_MAX_SECONDS)
+        time.sleep(min(poll, max(0.0, deadline - now)))
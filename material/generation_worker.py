@@ -0,0 +1,100 @@
+"""
+Worker de los jobs de generación de preguntas (GenerationJob, ver
+generation_jobs.py): toma jobs de la cola en la base y corre el pipeline de
+fragmentos (views_document_processor._run_generation_job) fuera de la request
+HTTP. Antes la generación corría dentro del StreamingHttpResponse de
+stream_questions: un job largo tenía tomado uno de los 4 threads de gunicorn
+durante minutos, y seguía sujeto a --timeout 120.
+
+Dónde corre (CONTENIDO_GENERATION_WORKER):
+- 'thread' (default): CONTENIDO_GENERATION_WORKER_THREADS threads daemon en
+  cada proceso web, que arrancan con el primer job (ensure_started). Con
+  varios procesos, cada uno tiene los suyos y se reparten la misma cola.
+- 'external': la web no genera nada; los jobs los toma
+  `python manage.py run_generation_worker` corriendo aparte.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from . import generation_jobs
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_THREADS = 2
+# Sin jobs, cada cuánto se vuelve a mirar la cola: un job creado en otro
+# proceso no despierta a los threads de este.
+_IDLE_POLL_SECONDS = 2.0
+
+_started = False
+_start_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+def _mode():
+    return str(getattr(settings, 'CONTENIDO_GENERATION_WORKER', 'thread')).lower()
+
+
+def ensure_started():
+    """Arranca los threads del worker en este proceso (una sola vez), salvo
+    con CONTENIDO_GENERATION_WORKER='external'."""
+    global _started
+    if _mode() != 'thread':
+        return
+    if not _started:
+        with _start_lock:
+            if not _started:
+                threads = max(1, int(getattr(settings, 'CONTENIDO_GENERATION_WORKER_THREADS', _DEFAULT_THREADS)))
+                for i in range(threads):
+                    threading.Thread(
+                        target=run_forever, name=f'generation-worker-{i + 1}', daemon=True,
+                    ).start()
+                _started = True
+                logger.info(f'Worker de generación: {threads} thread(s) en este proceso.')
+    notify()
+
+
+def notify():
+    """Avisa a los threads de este proceso que hay un job nuevo."""
+    _wakeup.set()
+
+
+def run_once():
+    """Toma un job de la cola y lo corre hasta que termine o se pause.
+    False si no había ninguno."""
+    from .models import GenerationJob
+    from .views_document_processor import _run_generation_job
+
+    close_old_connections()
+    token = generation_jobs.new_token()
+    job = generation_jobs.claim_next(token)
+    if job is None:
+        return False
+    logger.info(f'Worker de generación: job {job.pk} ({job.params.get("filename", "")}).')
+    try:
+        with generation_jobs.keep_claimed(job.pk, token):
+            _run_generation_job(job, token)
+    except Exception as exc:
+        logger.exception(f'Job de generación {job.pk} falló')
+        generation_jobs.finish(job.pk, token, GenerationJob.STATUS_ERROR, f'Error inesperado al generar: {exc}')
+    finally:
+        # Si salió sin terminar (pausado, reclamo perdido), queda libre para
+        # que lo retome el próximo que lo reclame.
+        generation_jobs.release(job.pk, token)
+        connections.close_all()
+    return True
+
+
+def run_forever(stop_event=None):
+    while stop_event is None or not stop_event.is_set():
+        try:
+            worked = run_once()
+        except Exception:
+            # Base caída, por ejemplo: no matar el thread, reintentar.
+            logger.exception('Worker de generación: error tomando jobs de la cola')
+            worked = False
+        if not worked:
+            _wakeup.wait(_IDLE_POLL_SECONDS)
+            _wakeup.clear()
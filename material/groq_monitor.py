@@ -310,8 +310,10 @@ def run_test(fixture_key=None, persist='db'):
     candidatos con datos reales sin tocar cuál es el modelo activo en
     producción."""
     from django.contrib.auth.models import User
+    from . import fair_share, provider_latency
     from .models import GroqMonitorRun, GlobalAIConfig
     from .ai_router import _build_external_backend
+    from .ia_processor import count_tokens
     from .views_document_processor import _generate_questions_for_chunk, _split_into_chunks
 
     t0 = time.time()
@@ -327,7 +329,10 @@ def run_test(fixture_key=None, persist='db'):
 
     def save(**kwargs):
         elapsed = round(time.time() - t0, 1)
-        payload = dict(elapsed_seconds=elapsed, fixture=fixture_key, model_name=model_name, **kwargs)
+        payload = dict(
+            elapsed_seconds=elapsed, fixture=fixture_key, model_name=model_name,
+            latency_histograms=provider_latency.snapshot(), **kwargs,
+        )
         if persist == 'buffer':
             _buffer_append('text', payload)
         else:
@@ -381,10 +386,16 @@ def run_test(fixture_key=None, persist='db'):
         if i > 0:
             time.sleep(2)
         try:
+            # Mismo pool que los docentes: el monitoreo espera su turno con
+            # su propia prioridad (ver fair_share.py).
+            with fair_share.as_flow(fair_share.CLASS_MONITOR, 'groq-monitor'):
+                fair_share.wait_turn(cfg.id, count_tokens(chunk) + TEXT_TEST_OUTPUT_CEILING)
             raw = _generate_questions_for_chunk(
                 chunk, chapter_title, per_chunk, i, total_chunks,
                 backend=backend, output_tokens_ceiling=TEXT_TEST_OUTPUT_CEILING,
                 generate_kwargs=generate_kwargs,
+                # El monitoreo mide al proveedor: nunca responder desde la caché.
+                bypass_cache=True,
             )
         except Exception as e:
             failed_chunks += 1
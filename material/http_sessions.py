@@ -0,0 +1,123 @@
+"""
+Sesiones HTTP compartidas para los backends de IA (ai_router.py y
+local_ai_client.py).
+
+Con `requests.post(...)` a nivel módulo cada llamada abre su propia conexión
+TCP + TLS contra el proveedor y la tira al terminar: en una corrida de 15
+fragmentos son 15 handshakes (unos cientos de ms cada uno contra Groq o
+Gemini) que no aportan nada. Acá hay un `requests.Session` por proveedor y
+host, con su pool de conexiones keep-alive, compartido por todos los threads
+del proceso (requests/urllib3 son thread-safe a nivel pool).
+
+Cada sesión monta además un urllib3 `Retry` para lo que un reintento
+automático sí arregla sin riesgo: no poder conectarse, y 502/503/504 del
+gateway del proveedor (la request no llegó al modelo), con backoff
+exponencial y respetando Retry-After si viene. El 429 queda a propósito
+afuera: lo manejan los backends (OpenAICompatibleBackend, GeminiBackend),
+porque los headers de cupo de cada 429 tienen que llegar hasta
+_parse_rate_limit_headers y el limitador compartido (shared_rate_limit.py),
+y el Retry de urllib3 se los tragaría. Tampoco se reintenta un timeout de
+lectura: una generación de 120 s repetida no entra en el timeout del worker.
+"""
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_DEFAULT_POOL_CONNECTIONS = 4
+_DEFAULT_POOL_MAXSIZE = 10
+_DEFAULT_RETRIES = 2
+_DEFAULT_BACKOFF = 0.5
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _setting(name, default):
+    # local_ai_client también se usa desde scripts sueltos sin django.setup()
+    # (ej. test_connection_now.py): ahí valen los defaults.
+    return getattr(settings, name, default) if settings.configured else default
+
+
+def _origin(base_url):
+    parts = urlsplit(base_url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+def _build_retry():
+    retries = int(_setting('CONTENIDO_HTTP_RETRIES', _DEFAULT_RETRIES))
+    return Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        other=0,
+        status_forcelist=(502, 503, 504),
+        # POST incluido: con 502/503/504 el proveedor no llegó a procesarla.
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'},
+        backoff_factor=float(_setting('CONTENIDO_HTTP_RETRY_BACKOFF', _DEFAULT_BACKOFF)),
+        respect_retry_after_header=True,
+        # Agotados los reintentos se devuelve la última respuesta tal cual:
+        # los backends ya saben armar el error a partir del status.
+        raise_on_status=False,
+    )
+
+
+def get_session(provider, base_url):
+    """Sesión compartida para (proveedor, origen de base_url). Se crea la
+    primera vez que se pide y vive lo que vive el proceso."""
+    key = (provider, _origin(base_url))
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            adapter = HTTPAdapter(
+                pool_connections=int(_setting('CONTENIDO_HTTP_POOL_CONNECTIONS', _DEFAULT_POOL_CONNECTIONS)),
+                pool_maxsize=int(_setting('CONTENIDO_HTTP_POOL_MAXSIZE', _DEFAULT_POOL_MAXSIZE)),
+                max_retries=_build_retry(),
+            )
+            session = requests.Session()
+            # La sesión la comparten todos los usuarios (y sus keys): que no
+            # guarde cookies que mande el proveedor, ni de una llamada a otra.
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[key] = session
+    return session
+
+
+def get_stats():
+    """
+    Reuso de conexiones por sesión: cuántas requests salieron y cuántas
+    conexiones nuevas hubo que abrir para eso (el resto reusó una abierta).
+    Contadores de urllib3 desde que se creó cada pool.
+    """
+    with _sessions_lock:
+        items = list(_sessions.items())
+    stats = []
+    for (provider, origin), session in items:
+        adapter = session.get_adapter(origin)
+        pools = adapter.poolmanager.pools
+        total_requests = 0
+        new_connections = 0
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            total_requests += pool.num_requests
+            new_connections += pool.num_connections
+        stats.append({
+            'provider': provider,
+            'origin': origin,
+            'requests': total_requests,
+            'new_connections': new_connections,
+            'reused': max(0, total_requests - new_connections),
+            'reuse_ratio': round(1 - new_connections / total_requests, 3) if total_requests else None,
+        })
+    return stats
@@ -77,14 +77,20 @@ def extract_page_images(file_path, pages=None, max_images=4, min_bytes=4000):
     fuente más común para este caso de uso; se puede sumar después si hace
     falta).
 
+    Cada imagen pasa por image_pipeline.process: se achica, se recodifica
+    a JPEG/WebP y se descartan las casi-duplicadas (mismo hash perceptual,
+    ej. un logo repetido en cada página), con caché en disco por contenido.
+
     Args:
         file_path: ruta al archivo.
         pages: lista opcional de números de página (1-based) a considerar;
             None = todo el documento.
         max_images: tope de imágenes a devolver (controla costo/latencia de
             la llamada a la IA — cada imagen se manda entera en el prompt).
+            Las casi-duplicadas descartadas no cuentan para el tope.
         min_bytes: descarta imágenes muy chicas (íconos, viñetas, líneas
-            decorativas del layout) que no aportan contenido real.
+            decorativas del layout) que no aportan contenido real. Se mide
+            sobre la imagen original, antes de recodificar.
 
     Returns:
         Lista de dicts {page, mime, data_uri}, como mucho `max_images`,
@@ -92,16 +98,19 @@ def extract_page_images(file_path, pages=None, max_images=4, min_bytes=4000):
         de lectura devuelve lista vacía (la generación de preguntas sigue
         funcionando solo con texto).
     """
-    import base64
+    from . import image_pipeline
 
     if os.path.splitext(file_path)[1].lower() != '.pdf':
         return []
 
     results = []
+    kept_hashes = []
+    max_distance = image_pipeline.dedup_distance()
     try:
         doc = fitz.open(file_path)
         try:
             page_range = range(len(doc)) if not pages else [p - 1 for p in pages if 0 < p <= len(doc)]
+            seen_xrefs = set()
             for page_idx in page_range:
                 if len(results) >= max_images:
                     break
@@ -110,22 +119,31 @@ def extract_page_images(file_path, pages=None, max_images=4, min_bytes=4000):
                     if len(results) >= max_images:
                         break
                     xref = img[0]
+                    # La misma imagen (mismo xref) dibujada en varias
+                    # páginas: ni hace falta extraerla de nuevo.
+                    if xref in seen_xrefs:
+                        continue
+                    seen_xrefs.add(xref)
                     try:
                         extracted = doc.extract_image(xref)
                     except Exception:
                         continue
                     image_bytes = extracted.get('image')
-                    ext = (extracted.get('ext') or 'png').lower()
                     if not image_bytes or len(image_bytes) < min_bytes:
                         continue
-                    if ext not in ('png', 'jpg', 'jpeg', 'webp'):
+                    processed = image_pipeline.process(image_bytes)
+                    if processed is None:
                         continue
-                    mime = 'image/jpeg' if ext in ('jpg', 'jpeg') else f'image/{ext}'
-                    b64 = base64.b64encode(image_bytes).decode('utf-8')
+                    if any(
+                        image_pipeline.hamming_distance(processed['phash'], kept) <= max_distance
+                        for kept in kept_hashes
+                    ):
+                        continue
+                    kept_hashes.append(processed['phash'])
                     results.append({
                         'page': page_idx + 1,
-                        'mime': mime,
-                        'data_uri': f'data:{mime};base64,{b64}',
+                        'mime': processed['mime'],
+                        'data_uri': f"data:{processed['mime']};base64,{processed['data_b64']}",
                     })
         finally:
             doc.close()
@@ -135,23 +153,156 @@ def extract_page_images(file_path, pages=None, max_images=4, min_bytes=4000):
     return results
 
 
-def extract_text_advanced(file_path, remove_headers=True, remove_footers=True):
+def extract_text_advanced(file_path, remove_headers=True, remove_footers=True, file_hash=None):
     """
     NUEVA FUNCIÓN: Extracción avanzada con limpieza de headers/footers.
     Usa el DocumentProcessor completo.
-    
+
+    El resultado se guarda en la caché de extracción en disco (ver
+    material/extraction_cache.py), con clave por contenido del archivo: la
+    segunda pasada sobre el mismo documento (reabrirlo, generar preguntas)
+    cuesta solo leer un archivo en vez de volver a extraer todo el libro.
+
     Args:
         file_path: Ruta al archivo
         remove_headers: Eliminar headers repetitivos (PDFs)
         remove_footers: Eliminar footers repetitivos (PDFs)
-    
+        file_hash: SHA-256 del archivo si quien llama ya lo tiene (ej.
+            Contenido.file_hash) — si no, se calcula acá leyendo el archivo.
+
     Returns:
         Dict con estructura completa del documento
     """
     from django.conf import settings
+    from . import extraction_cache, page_store
+
+    _, file_extension = os.path.splitext(file_path)
+    file_extension = file_extension.lower()
+    pages_per_block = getattr(settings, 'CONTENIDO_PAGES_PER_CHAPTER_BLOCK', 40)
+
+    cache_key, file_hash, cached = _extraction_cache_lookup(
+        file_path, file_extension, remove_headers, remove_footers, pages_per_block, file_hash,
+    )
+    if cached is not None:
+        page_store.ensure(file_path, file_hash, cached)
+        return cached
+
+    result = _extract_text_advanced_uncached(
+        file_path, file_extension, remove_headers, remove_footers, pages_per_block,
+    )
+    if cache_key:
+        extraction_cache.put(cache_key, result)
+    # Texto por página para el selector del dashboard, armado una sola vez
+    # acá en vez de en cada apertura del visor, con las páginas que la
+    # extracción ya sacó (ver material/page_store.py).
+    page_store.ensure(file_path, file_hash, result)
+    return result
+
+
+def iter_extract_text_advanced(file_path, remove_headers=True, remove_footers=True, file_hash=None):
+    """
+    Variante generadora de extract_text_advanced para mostrar progreso
+    durante la subida (ver upload_and_process_document_stream): entrega los
+    mismos eventos que DocumentProcessor.iter_pdf_chapters —
+    'metadata', un 'chapter' por capítulo, 'stats' — y al final uno
+    {'type': 'result', 'result': {...}} con el dict completo, idéntico al
+    que devolvería extract_text_advanced.
+
+    Solo un PDF que no está en la caché de extracción se extrae de verdad
+    de a capítulos; un acierto de caché o un DOCX/PPTX/TXT (que se procesan
+    de una) se extraen completos y después se reproducen como eventos.
+    Misma caché y mismo almacén de páginas que extract_text_advanced.
+    """
+    from django.conf import settings
+    from . import extraction_cache, page_store
 
     _, file_extension = os.path.splitext(file_path)
     file_extension = file_extension.lower()
+    pages_per_block = getattr(settings, 'CONTENIDO_PAGES_PER_CHAPTER_BLOCK', 40)
+
+    cache_key, file_hash, result = _extraction_cache_lookup(
+        file_path, file_extension, remove_headers, remove_footers, pages_per_block, file_hash,
+    )
+
+    if result is None and file_extension == '.pdf':
+        result = {
+            'metadata': {},
+            'toc': [],
+            'chapters': [],
+            'full_text': '',
+            'scanned_pages': [],
+            'stats': {}
+        }
+        for event in _processor.iter_pdf_chapters(
+            file_path,
+            remove_headers=remove_headers,
+            remove_footers=remove_footers,
+            extract_toc=True,
+            max_pages=getattr(settings, 'CONTENIDO_MAX_PAGES', None),
+            pages_per_block=pages_per_block,
+            parallel_workers=getattr(settings, 'CONTENIDO_PDF_PARALLEL_WORKERS', 0),
+            parallel_min_pages=getattr(settings, 'CONTENIDO_PDF_PARALLEL_MIN_PAGES', 150),
+            verify_scanned_pages=getattr(settings, 'CONTENIDO_VERIFY_SCANNED_PAGES', False),
+        ):
+            if event['type'] == 'metadata':
+                result['metadata'] = event['metadata']
+                result['toc'] = event['toc']
+                result['scanned_pages'] = event['scanned_pages']
+            elif event['type'] == 'chapter':
+                result['chapters'].append(event['chapter'])
+            elif event['type'] == 'stats':
+                result['stats'] = event['stats']
+            yield event
+        if cache_key:
+            extraction_cache.put(cache_key, result)
+    else:
+        if result is None:
+            result = _extract_text_advanced_uncached(
+                file_path, file_extension, remove_headers, remove_footers, pages_per_block,
+            )
+            if cache_key:
+                extraction_cache.put(cache_key, result)
+        yield {
+            'type': 'metadata',
+            'metadata': result.get('metadata', {}),
+            'toc': result.get('toc', []),
+            'scanned_pages': result.get('scanned_pages', []),
+        }
+        pages_done = 0
+        for chapter in result.get('chapters', []):
+            pages = chapter.get('pages') or []
+            pages_done = max(pages_done, pages[-1] if pages else 0)
+            yield {'type': 'chapter', 'chapter': chapter, 'pages_done': pages_done}
+        yield {'type': 'stats', 'stats': result.get('stats', {})}
+
+    page_store.ensure(file_path, file_hash, result)
+    yield {'type': 'result', 'result': result}
+
+
+def _extraction_cache_lookup(file_path, file_extension, remove_headers, remove_footers, pages_per_block, file_hash):
+    """(clave de caché, file_hash, resultado cacheado o None). La clave es
+    None si no se pudo leer el archivo para hashearlo."""
+    from document_processor import EXTRACTOR_VERSION
+    from . import extraction_cache
+
+    try:
+        if not file_hash:
+            from .cleanup import compute_file_hash
+            with open(file_path, 'rb') as f:
+                file_hash = compute_file_hash(f)
+        cache_key = extraction_cache.make_key(
+            file_hash, file_extension, remove_headers, remove_footers,
+            pages_per_block, EXTRACTOR_VERSION,
+        )
+    except OSError:
+        # Sin poder leer el archivo para hashearlo, la extracción va a
+        # fallar con el error real — no taparlo acá.
+        return None, file_hash, None
+    return cache_key, file_hash, extraction_cache.get(cache_key)
+
+
+def _extract_text_advanced_uncached(file_path, file_extension, remove_headers, remove_footers, pages_per_block):
+    from django.conf import settings
 
     if file_extension == '.pdf':
         return _processor.process_pdf(
@@ -160,7 +311,10 @@ def extract_text_advanced(file_path, remove_headers=True, remove_footers=True):
             remove_footers=remove_footers,
             extract_toc=True,
             max_pages=getattr(settings, 'CONTENIDO_MAX_PAGES', None),
-            pages_per_block=getattr(settings, 'CONTENIDO_PAGES_PER_CHAPTER_BLOCK', 40),
+            pages_per_block=pages_per_block,
+            parallel_workers=getattr(settings, 'CONTENIDO_PDF_PARALLEL_WORKERS', 0),
+            parallel_min_pages=getattr(settings, 'CONTENIDO_PDF_PARALLEL_MIN_PAGES', 150),
+            verify_scanned_pages=getattr(settings, 'CONTENIDO_VERIFY_SCANNED_PAGES', False),
         )
     elif file_extension == '.docx':
         return _processor.process_docx(file_path)
@@ -193,18 +347,46 @@ def count_tokens(text):
     return _processor.count_tokens(text)
 
 
-def split_text_by_tokens(text, max_tokens=4000):
+def token_byte_offsets(text):
+    """
+    Offset en bytes (UTF-8) donde empieza cada token de `text`, codificado
+    una sola vez — ver DocumentProcessor.token_byte_offsets.
+    """
+    return _processor.token_byte_offsets(text)
+
+
+def token_byte_offsets_many(texts):
+    """
+    token_byte_offsets de varios textos (ej. capítulos) de una vez — se
+    codifican todos juntos con encode_batch.
+    """
+    return _processor.token_byte_offsets_many(texts)
+
+
+def split_text_by_tokens(text, max_tokens=4000, overlap=0):
     """
     NUEVA FUNCIÓN: Divide texto en chunks que no excedan límite de tokens.
     
     Args:
         text: Texto a dividir
         max_tokens: Límite de tokens por chunk
+        overlap: Tokens que se repiten entre un chunk y el siguiente
     
     Returns:
         Lista de chunks de texto
     """
-    return _processor.split_by_token_limit(text, max_tokens=max_tokens)
+    return _processor.split_by_token_limit(text, max_tokens=max_tokens, overlap=overlap)
+
+
+def split_texts_by_tokens(texts, max_tokens=4000, overlap=0):
+    """
+    Como split_text_by_tokens, para varios textos (ej. capítulos) de una
+    vez — se codifican todos juntos con encode_batch.
+
+    Returns:
+        Una lista de chunks por texto, en el mismo orden.
+    """
+    return _processor.split_many_by_token_limit(texts, max_tokens=max_tokens, overlap=overlap)
 
 
 def optimize_text_for_ai(text, remove_extra_whitespace=True):
@@ -0,0 +1,223 @@
+"""
+Preparación de las imágenes de un documento para la IA con visión (ver
+ia_processor.extract_page_images).
+
+Antes cada imagen embebida del PDF se mandaba tal cual, en base64 y a
+resolución completa: un diagrama escaneado a 2400px o un PNG sin comprimir
+de 1-2 MB viajaban enteros en cada llamada a Gemini, aunque el modelo los
+reescala igual del lado del proveedor. Acá cada imagen:
+
+1. se achica (con Pillow, que ya usan los renderers) para que su lado más
+   largo no pase de CONTENIDO_VISION_IMAGE_MAX_EDGE,
+2. se vuelve a codificar como JPEG o WebP (CONTENIDO_VISION_IMAGE_FORMAT)
+   a CONTENIDO_VISION_IMAGE_QUALITY, y
+3. se le calcula un hash perceptual (dHash de 64 bits) para descartar
+   casi-duplicados: el mismo logo o la misma figura repetidos en varias
+   páginas, o exportados dos veces con distinta compresión.
+
+El resultado se guarda en disco bajo una clave que sale del contenido de la
+imagen original (SHA-256 de sus bytes) más los parámetros de arriba: la
+segunda generación sobre el mismo Contenido — o la misma imagen en otro
+documento — no vuelve a decodificar ni a recodificar nada. Archivos JSON
+sueltos en `var/`, con tamaño acotado por CONTENIDO_IMAGE_CACHE_MAX_MB y
+desalojo LRU, igual que la caché de extracción (ver extraction_cache.py).
+"""
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Subir si cambia cómo se procesa una imagen (filtro de reescalado, cálculo
+# del hash...) para no seguir sirviendo resultados viejos de la caché.
+IMAGE_PIPELINE_VERSION = 1
+
+_DEFAULT_MAX_EDGE = 1024
+_DEFAULT_FORMAT = 'JPEG'
+_DEFAULT_QUALITY = 80
+_DEFAULT_DEDUP_DISTANCE = 6
+_DEFAULT_MAX_MB = 100
+
+_MIME_BY_FORMAT = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+
+def _cache_dir():
+    return Path(getattr(
+        settings, 'CONTENIDO_IMAGE_CACHE_DIR',
+        Path(settings.BASE_DIR) / 'var' / 'image_cache',
+    ))
+
+
+def _max_bytes():
+    return int(getattr(settings, 'CONTENIDO_IMAGE_CACHE_MAX_MB', _DEFAULT_MAX_MB)) * 1024 * 1024
+
+
+def get_params():
+    """(lado máximo en px, formato, calidad) según settings. El formato cae
+    a JPEG si el configurado no es uno de los soportados."""
+    max_edge = int(getattr(settings, 'CONTENIDO_VISION_IMAGE_MAX_EDGE', _DEFAULT_MAX_EDGE))
+    image_format = str(getattr(settings, 'CONTENIDO_VISION_IMAGE_FORMAT', _DEFAULT_FORMAT)).upper()
+    if image_format not in _MIME_BY_FORMAT:
+        image_format = _DEFAULT_FORMAT
+    quality = int(getattr(settings, 'CONTENIDO_VISION_IMAGE_QUALITY', _DEFAULT_QUALITY))
+    return max_edge, image_format, quality
+
+
+def dedup_distance():
+    """Distancia de Hamming máxima entre dos dHash para considerar las
+    imágenes casi iguales (0 = solo idénticas a nivel de hash)."""
+    return int(getattr(settings, 'CONTENIDO_VISION_IMAGE_DEDUP_DISTANCE', _DEFAULT_DEDUP_DISTANCE))
+
+
+def make_key(image_bytes, max_edge, image_format, quality):
+    raw = '|'.join(str(part) for part in (
+        hashlib.sha256(image_bytes).hexdigest(), max_edge, image_format, quality,
+        IMAGE_PIPELINE_VERSION,
+    ))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def _dhash(image):
+    """Difference hash: la imagen en grises a 9x8 y un bit por cada par de
+    píxeles vecinos (¿el de la izquierda es más claro?). Sobrevive a
+    reescalados y recompresión, que es lo que distingue a dos copias de la
+    misma figura."""
+    from PIL import Image
+
+    small = image.convert('L').resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _encode(image_bytes, max_edge, image_format, quality):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.load()
+        phash = _dhash(image)
+        width, height = image.size
+
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            # Transparencia sobre blanco: así se ven en la página, y JPEG
+            # no tiene canal alfa.
+            rgba = image.convert('RGBA')
+            flattened = Image.new('RGB', rgba.size, (255, 255, 255))
+            flattened.paste(rgba, mask=rgba.getchannel('A'))
+            image = flattened
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        if max(width, height) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        out = io.BytesIO()
+        image.save(out, format=image_format, quality=quality, optimize=image_format == 'JPEG')
+        return {
+            'mime': _MIME_BY_FORMAT[image_format],
+            'data_b64': base64.b64encode(out.getvalue()).decode('ascii'),
+            'phash': f'{phash:016x}',
+            'width': image.size[0],
+            'height': image.size[1],
+            'original_width': width,
+            'original_height': height,
+            'original_bytes': len(image_bytes),
+        }
+
+
+def process(image_bytes):
+    """
+    Achica y recodifica una imagen según settings, usando la caché.
+
+    Returns:
+        dict {mime, data_b64, phash (int), width, height, original_width,
+        original_height, original_bytes}, o None si Pillow no la puede
+        abrir (formato raro, datos corruptos) — quien llama la descarta.
+    """
+    max_edge, image_format, quality = get_params()
+    key = make_key(image_bytes, max_edge, image_format, quality)
+    path = _cache_dir() / f'{key}.json'
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        try:
+            os.utime(path)  # LRU: marcar como recién usado
+        except OSError:
+            pass
+    except (OSError, ValueError):
+        try:
+            entry = _encode(image_bytes, max_edge, image_format, quality)
+        except Exception as exc:
+            logger.debug(f'Imagen descartada, Pillow no la pudo procesar: {exc}')
+            return None
+        _put(path, entry)
+
+    return dict(entry, phash=int(entry['phash'], 16))
+
+
+def _put(path, entry):
+    """Escritura atómica (temporal + rename). Best-effort: un error de disco
+    solo se loguea, la imagen ya está procesada igual."""
+    cache_dir = path.parent
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    except Exception as exc:
+        logger.warning(f'No se pudo guardar la caché de imágenes: {exc}')
+        return
+    _evict_if_needed(cache_dir)
+
+
+def _evict_if_needed(cache_dir):
+    max_bytes = _max_bytes()
+    entries = []
+    total = 0
+    for path in cache_dir.glob('*.json'):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if total <= max_bytes:
+        return
+
+    entries.sort()  # más viejo (menos usado) primero
+    evicted = 0
+    for _mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    if evicted:
+        logger.info(f'Caché de imágenes: {evicted} entrada(s) desalojada(s) por tamaño.')
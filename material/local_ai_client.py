@@ -5,13 +5,15 @@ Conexión al servidor intranet para procesamiento de documentos sin límite de t
 Basado en ejemplos de integración del proyecto.
 """
 
-import requests
+import json
 import threading
 import time
 from typing import List, Dict, Optional, Any
 from datetime import datetime
 import logging
 
+from .http_sessions import get_session
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,6 +27,13 @@ class LocalAIClient:
         self._is_available = False
         self.default_model = 'llama3.1:8b'
         self.selected_model = 'llama3.1:8b'  # Modelo actualmente seleccionado
+
+    @property
+    def _http(self):
+        # Sesión keep-alive compartida por host (ver http_sessions.py); se
+        # resuelve en cada uso porque la instancia global `local_ai` se crea
+        # al importar el módulo, antes de que haga falta.
+        return get_session('ollama', self.base_url)
         
     def check_connection(self) -> bool:
         """
@@ -35,7 +44,7 @@ class LocalAIClient:
         """
         try:
             # Usar el endpoint de tags de Ollama
-            response = requests.get(
+            response = self._http.get(
                 f"{self.base_url}/api/tags",
                 timeout=self.timeout
             )
@@ -59,7 +68,7 @@ class LocalAIClient:
             return []
         
         try:
-            response = requests.get(
+            response = self._http.get(
                 f"{self.base_url}/api/tags",
                 timeout=self.timeout
             )
@@ -166,6 +175,7 @@ class LocalAIClient:
         max_tokens: int = 150,
         top_p: float = 0.9,
         stream: bool = False,
+        on_delta=None,
         **kwargs
     ) -> Dict[str, Any]:
         """
@@ -178,6 +188,8 @@ class LocalAIClient:
             max_tokens: Máximo de tokens a generar
             top_p: Nucleus sampling
             stream: Si usar streaming o no
+            on_delta: Si se pasa, se usa streaming y se llama on_delta(texto)
+                con cada pedazo a medida que Ollama lo genera
         
         Returns:
             Dict con texto, tokens y metadata
@@ -193,7 +205,7 @@ class LocalAIClient:
             payload = {
                 'model': model or self.selected_model,  # Usar modelo seleccionado si no se especifica
                 'prompt': prompt,
-                'stream': stream,
+                'stream': stream or on_delta is not None,
                 'options': {
                     'temperature': temperature,
                     'num_predict': max_tokens,
@@ -201,14 +213,38 @@ class LocalAIClient:
                 }
             }
             
-            response = requests.post(
+            response = self._http.post(
                 f"{self.base_url}/api/generate",
                 json=payload,
-                timeout=120  # Timeout extendido para generaciones complejas
+                timeout=120,  # Timeout extendido para generaciones complejas
+                stream=payload['stream'],
             )
             response.raise_for_status()
             
-            data = response.json()
+            if payload['stream']:
+                # Con streaming Ollama manda un JSON por línea con un pedazo
+                # en 'response'; el último (done=true) trae las métricas.
+                parts = []
+                data = {}
+                try:
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not line:
+                            continue
+                        data = json.loads(line)
+                        if data.get('error'):
+                            raise RuntimeError(data['error'])
+                        piece = data.get('response', '')
+                        if piece:
+                            parts.append(piece)
+                            if on_delta is not None:
+                                on_delta(piece)
+                        if data.get('done'):
+                            break
+                finally:
+                    response.close()
+                data['response'] = ''.join(parts)
+            else:
+                data = response.json()
             
             return {
                 'success': True,
@@ -250,7 +286,7 @@ class LocalAIClient:
                     'num_predict': 1,   # generar mínimo posible
                 }
             }
-            response = requests.post(
+            response = self._http.post(
                 f"{self.base_url}/api/generate",
                 json=payload,
                 timeout=60,
@@ -0,0 +1,47 @@
+"""
+Worker de generación de preguntas como proceso aparte (ver
+material/generation_worker.py), para CONTENIDO_GENERATION_WORKER='external':
+la web solo encola jobs y transmite lo que este proceso va guardando. Se
+pueden correr varios a la vez (en Postgres se reparten la cola con
+SELECT ... FOR UPDATE SKIP LOCKED).
+"""
+import threading
+
+from django.core.management.base import BaseCommand
+
+from material.generation_worker import run_forever, run_once
+
+
+class Command(BaseCommand):
+    help = 'Toma jobs de generación de preguntas de la cola en la base y los genera.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=2, help='Jobs a la vez (default: 2).')
+        parser.add_argument('--once', action='store_true', help='Procesar la cola pendiente y salir.')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            processed = 0
+            while run_once():
+                processed += 1
+            self.stdout.write(f'Jobs procesados: {processed}.')
+            return
+
+        threads = max(1, options['threads'])
+        self.stdout.write(f'Worker de generación: {threads} thread(s). Ctrl+C para salir.')
+        stop = threading.Event()
+        workers = [
+            threading.Thread(target=run_forever, args=(stop,), name=f'generation-worker-{i + 1}', daemon=True)
+            for i in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(timeout=1.0)
+        except KeyboardInterrupt:
+            stop.set()
+            self.stdout.write('Saliendo: se esperan los jobs en curso (Ctrl+C otra vez para cortar ya).')
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.20 on 2026-10-18 09:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('material', '0080_groqmonitorrun_model_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedRateLimitState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.JSONField(blank=True, default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('config', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rate_limit_state', to='material.globalaiconfig')),
+            ],
+            options={
+                'verbose_name': 'Limitador compartido (demo)',
+                'verbose_name_plural': 'Limitador compartido (demo)',
+            },
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.20 on 2026-10-18 09:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('material', '0081_sharedratelimitstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pendiente'), ('running', 'Generando'), ('done', 'Terminado'), ('error', 'Error')], db_index=True, default='pending', max_length=20)),
+                ('total_chunks', models.PositiveIntegerField(blank=True, null=True)),
+                ('total_generated', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('claimed_by', models.CharField(blank=True, max_length=64)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='generation_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Generación de preguntas (job)',
+                'verbose_name_plural': 'Generación de preguntas (jobs)',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='GenerationJobChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunk', models.PositiveIntegerField()),
+                ('event', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='material.generationjob')),
+            ],
+            options={
+                'verbose_name': 'Generación de preguntas (fragmento)',
+                'verbose_name_plural': 'Generación de preguntas (fragmentos)',
+                'ordering': ['job', 'chunk'],
+                'unique_together': {('job', 'chunk')},
+            },
+        ),
+    ]
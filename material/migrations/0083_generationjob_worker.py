@@ -0,0 +1,23 @@
+# Generated by Django 4.2.20 on 2026-10-18 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('material', '0082_generationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationjob',
+            name='viewed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='generationjobchunk',
+            name='final',
+            field=models.BooleanField(default=True),
+        ),
+    ]
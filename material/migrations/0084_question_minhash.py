@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-18 09:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('material', '0083_generationjob_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='minhash',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-18 09:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('material', '0084_question_minhash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groqmonitorrun',
+            name='latency_histograms',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Latencias por proveedor'),
+        ),
+    ]
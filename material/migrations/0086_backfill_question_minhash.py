@@ -0,0 +1,38 @@
+from django.db import migrations
+
+
+def backfill_question_minhash(apps, schema_editor):
+    """
+    Calcula Question.minhash de las preguntas guardadas antes de 0084, así
+    la primera generación de cada usuario no tiene que calcular y guardar
+    de una vez las firmas de todo su banco (ver NearDuplicateIndex.for_user).
+    Usa la firma de material/near_duplicates.py: depende solo del texto.
+    """
+    from material.near_duplicates import pack, signature
+
+    Question = apps.get_model('material', 'Question')
+    pending = Question.objects.filter(minhash__isnull=True).only('pk', 'question_text').order_by('pk')
+    last_pk = 0
+    while True:
+        rows = list(pending.filter(pk__gt=last_pk)[:500])
+        if not rows:
+            break
+        for row in rows:
+            row.minhash = pack(signature(row.question_text))
+        Question.objects.bulk_update(rows, ['minhash'])
+        last_pk = rows[-1].pk
+
+
+def noop_reverse(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('material', '0085_groqmonitorrun_latency_histograms'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_question_minhash, noop_reverse),
+    ]
@@ -7,6 +7,7 @@ from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericForeignKey
 import json
+import uuid
 
 # --- MODELOS V2 PRIMERO (para evitar referencias circulares) ---
 
@@ -683,6 +684,10 @@ class Question(models.Model):
         verbose_name='Capítulos fuente (JSON)',
         help_text='JSON con información de los capítulos de donde se generó'
     )
+    # Firma MinHash de question_text para detectar casi duplicadas al generar
+    # (ver material/near_duplicates.py). Se recalcula en save() cuando cambia
+    # question_text.
+    minhash = models.BinaryField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -759,6 +764,15 @@ class Question(models.Model):
 
         return book
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'question_text' in update_fields:
+            from .near_duplicates import pack, signature
+            self.minhash = pack(signature(self.question_text))
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'minhash'}
+        super().save(*args, **kwargs)
+
     def clean(self):
         super().clean()
         for field_name in ['question_image', 'answer_image']:
@@ -2260,6 +2274,97 @@ class GlobalAIConfig(models.Model):
         self.api_key_encrypted = encrypt_api_key(value) if value else ''
 
 
+class SharedRateLimitState(models.Model):
+    """
+    Presupuesto compartido de llamadas de una fila de GlobalAIConfig (cupo
+    informado por el proveedor + reservas de las llamadas en vuelo), para
+    cuando el limitador de material/shared_rate_limit.py usa la base
+    (CONTENIDO_SHARED_RATE_LIMIT_BACKEND='db'): así lo ven igual todos los
+    workers, aunque corran en máquinas distintas. Se lee y escribe siempre
+    con select_for_update — no editar a mano.
+    """
+    config = models.OneToOneField(GlobalAIConfig, on_delete=models.CASCADE, related_name='rate_limit_state')
+    state = models.JSONField(default=dict, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Limitador compartido (demo)"
+        verbose_name_plural = "Limitador compartido (demo)"
+
+    def __str__(self):
+        return f"Limitador → {self.config}"
+
+
+class GenerationJob(models.Model):
+    """
+    Una corrida de generación de preguntas por streaming (ver
+    stream_questions en views_document_processor.py y
+    material/generation_jobs.py). Antes los parámetros vivían en un dict en
+    memoria que se vaciaba al primer connect: si el EventSource se cortaba, o
+    el worker se reiniciaba, se perdía todo lo ya generado (y pagado). Acá
+    quedan los parámetros y, en GenerationJobChunk, el resultado de cada
+    fragmento terminado, así una reconexión (Last-Event-ID) reenvía lo hecho
+    y sigue desde el próximo fragmento pendiente.
+
+    `claimed_by`/`heartbeat_at`: qué worker lo está generando (ver
+    generation_worker.py); si deja de dar señales, otro lo retoma.
+    `viewed_at`: última vez que una conexión SSE lo pidió — sin nadie
+    mirando, el worker lo pausa.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_ERROR = 'error'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pendiente'),
+        (STATUS_RUNNING, 'Generando'),
+        (STATUS_DONE, 'Terminado'),
+        (STATUS_ERROR, 'Error'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='generation_jobs')
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    total_chunks = models.PositiveIntegerField(null=True, blank=True)
+    total_generated = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    viewed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "Generación de preguntas (job)"
+        verbose_name_plural = "Generación de preguntas (jobs)"
+
+    def __str__(self):
+        return f"{self.params.get('filename', '')} — {self.get_status_display()} ({self.total_generated} preguntas)"
+
+
+class GenerationJobChunk(models.Model):
+    """Resultado de un fragmento de un GenerationJob: el evento SSE tal como
+    se manda ('questions' con todas las preguntas aceptadas del fragmento, o
+    'chunk_error'), o — mientras el fragmento se sigue generando
+    (final=False) — las preguntas que la IA ya adelantó ('partial')."""
+    job = models.ForeignKey(GenerationJob, on_delete=models.CASCADE, related_name='chunks')
+    chunk = models.PositiveIntegerField()  # índice global, 1-based (= id del evento SSE)
+    event = models.JSONField(default=dict)
+    final = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['job', 'chunk']
+        unique_together = [('job', 'chunk')]
+        verbose_name = "Generación de preguntas (fragmento)"
+        verbose_name_plural = "Generación de preguntas (fragmentos)"
+
+    def __str__(self):
+        return f"{self.job_id} — fragmento {self.chunk}"
+
+
 # ---------------------------------------------------------------------------
 # Monitoreo del fallback compartido de Groq (test de carga programado)
 # ---------------------------------------------------------------------------
@@ -2311,6 +2416,10 @@ class GroqMonitorRun(models.Model):
     quota_limit_requests = models.IntegerField(null=True, blank=True)
     quota_remaining_tokens = models.IntegerField(null=True, blank=True)
     quota_limit_tokens = models.IntegerField(null=True, blank=True)
+    # Histogramas de latencia por proveedor del proceso al momento de la
+    # corrida (ver material/provider_latency.py): la evolución en el tiempo
+    # y con qué arranca el proceso después de un reinicio.
+    latency_histograms = models.JSONField(default=dict, blank=True, verbose_name="Latencias por proveedor")
 
     class Meta:
         ordering = ['-created_at']
@@ -0,0 +1,199 @@
+"""
+Detección de preguntas casi duplicadas con MinHash + LSH.
+
+El dedup de la generación (_deduplicate_questions y seen_keys en
+_run_generation_job, views_document_processor.py) compara los primeros
+80/120 caracteres en minúscula: una pregunta parafraseada, o la misma con
+otra primera palabra ("¿Cuál es..." / "Indicá cuál es..."), pasaba como
+nueva. Acá cada pregunta se reduce al conjunto de sus shingles de palabras
+(palabras con contenido, sin tildes ni mayúsculas, sueltas y de a pares) y
+se compara por similitud de Jaccard estimada con una firma MinHash de
+_NUM_PERM valores.
+
+Para no comparar cada candidata contra todo el banco del usuario, las
+firmas se indexan por bandas (LSH): solo se comparan las preguntas que
+coinciden entera en al menos una banda con la candidata. La cantidad y el
+ancho de las bandas salen del umbral (CONTENIDO_NEAR_DUPLICATE_THRESHOLD),
+de forma que un par justo en el umbral sea candidato casi siempre.
+
+Las firmas de las preguntas guardadas se persisten en Question.minhash (se
+calculan en Question.save()): armar el índice de un usuario con decenas de
+miles de preguntas es leer las firmas, no recalcularlas. Las anteriores
+al campo las completa la migración 0086; las que igual falten (guardadas con
+otra versión de la firma) se calculan y guardan la primera vez que se arma
+el índice. Una pregunta sin palabras con contenido guarda solo el byte de
+versión (firma vacía), para no recalcularla en cada corrida.
+"""
+import hashlib
+import logging
+import random
+import struct
+
+from django.conf import settings
+
+from .question_index import _terms
+
+logger = logging.getLogger(__name__)
+
+# Subir si cambia cómo se calcula la firma (shingles, hash, permutaciones):
+# las guardadas con otra versión se recalculan solas (ver for_user).
+SIGNATURE_VERSION = 1
+
+_DEFAULT_THRESHOLD = 0.7
+_NUM_PERM = 128
+# Probabilidad mínima de que un par con similitud igual al umbral quede
+# como candidato (ver _band_layout).
+_MIN_RECALL = 0.95
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(20261018)  # fijo: las firmas guardadas dependen de esto
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(_NUM_PERM)]
+_VALUES = struct.Struct(f'<{_NUM_PERM}I')
+
+
+def _shingles(text):
+    words = _terms(text)
+    shingles = set(words)
+    shingles.update(f'{a} {b}' for a, b in zip(words, words[1:]))
+    return shingles
+
+
+def _hash(shingle):
+    return int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def signature(text):
+    """Firma MinHash de una pregunta: _NUM_PERM enteros de 32 bits, como
+    bytes (así se indexa y se guarda sin convertir). None si no tiene
+    ninguna palabra con contenido."""
+    hashes = [_hash(s) for s in _shingles(text)]
+    if not hashes:
+        return None
+    return _VALUES.pack(*(
+        min((a * h + b) % _PRIME for h in hashes) & _MAX_HASH
+        for a, b in _PERMUTATIONS
+    ))
+
+
+def pack(sig):
+    """Firma → bytes para Question.minhash (con la versión adelante). Sin
+    firma (signature() dio None) queda solo la versión."""
+    return bytes([SIGNATURE_VERSION]) + (sig or b'')
+
+
+def unpack(raw):
+    """bytes de Question.minhash → firma; b'' si la pregunta no tiene firma
+    (ya calculada, no hay nada que indexar). None si falta o es de otra
+    versión."""
+    if not raw or raw[0] != SIGNATURE_VERSION or len(raw) not in (1, 1 + _VALUES.size):
+        return None
+    return bytes(raw[1:])
+
+
+def similarity(sig_a, sig_b):
+    """Jaccard estimada: fracción de posiciones iguales en las dos firmas."""
+    return sum(1 for x, y in zip(_VALUES.unpack(sig_a), _VALUES.unpack(sig_b)) if x == y) / _NUM_PERM
+
+
+def _band_layout(threshold):
+    """(bandas, filas por banda) con la menor cantidad de candidatas
+    (bandas más anchas) que todavía deja pasar un par con similitud
+    `threshold` con probabilidad >= _MIN_RECALL."""
+    best = (_NUM_PERM, 1)
+    for rows in range(1, _NUM_PERM + 1):
+        bands = _NUM_PERM // rows
+        if 1 - (1 - threshold ** rows) ** bands >= _MIN_RECALL:
+            best = (bands, rows)
+    return best
+
+
+def threshold_setting():
+    return float(getattr(settings, 'CONTENIDO_NEAR_DUPLICATE_THRESHOLD', _DEFAULT_THRESHOLD))
+
+
+class NearDuplicateIndex:
+    """Firmas MinHash indexadas por bandas. No es thread-safe: se arma uno
+    por corrida de generación y lo usa solo el thread que junta resultados."""
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold_setting() if threshold is None else threshold
+        self.bands, self.rows = _band_layout(self.threshold)
+        self._buckets = [{} for _ in range(self.bands)]
+        self._signatures = []
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._signatures)
+
+    @classmethod
+    def for_user(cls, user, threshold=None):
+        """Índice con todas las preguntas guardadas de `user`, o None si el
+        dedup por similitud está apagado (umbral <= 0 o >= 1)."""
+        from .models import Question
+
+        index = cls(threshold)
+        if not 0 < index.threshold < 1:
+            return None
+        missing = []
+        for pk, raw in Question.objects.filter(user=user).values_list('pk', 'minhash').iterator(chunk_size=2000):
+            sig = unpack(raw)
+            if sig is None:
+                missing.append(pk)
+            elif sig:
+                index.add(sig)
+
+        if missing:
+            # Preguntas con la firma de otra versión: se calculan una vez y
+            # quedan guardadas.
+            for start in range(0, len(missing), 500):
+                rows = list(Question.objects.filter(pk__in=missing[start:start + 500]).only('pk', 'question_text'))
+                for row in rows:
+                    sig = signature(row.question_text)
+                    row.minhash = pack(sig)
+                    if sig:
+                        index.add(sig)
+                Question.objects.bulk_update(rows, ['minhash'])
+            logger.info(f'Dedup por similitud: {len(missing)} firma(s) MinHash calculadas para {user}.')
+        return index
+
+    def _band_keys(self, sig):
+        width = self.rows * 4
+        return [sig[band * width:(band + 1) * width] for band in range(self.bands)]
+
+    def add(self, sig):
+        position = len(self._signatures)
+        self._signatures.append(sig)
+        for bucket, key in zip(self._buckets, self._band_keys(sig)):
+            bucket.setdefault(key, []).append(position)
+
+    def find(self, sig):
+        """Similitud de la guardada más parecida a `sig` si llega al umbral,
+        o None."""
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._band_keys(sig)):
+            candidates.update(bucket.get(key, ()))
+        best = None
+        for position in candidates:
+            score = similarity(sig, self._signatures[position])
+            if score >= self.threshold and (best is None or score > best):
+                best = score
+        return best
+
+    def add_text(self, text):
+        """Agrega `text` sin compararlo (preguntas ya aceptadas)."""
+        sig = signature(text)
+        if sig is not None:
+            self.add(sig)
+
+    def add_if_new(self, text):
+        """True (y la agrega al índice) si `text` no es casi igual a ninguna
+        pregunta del índice; False si lo es."""
+        sig = signature(text)
+        if sig is None:
+            return True
+        if self.find(sig) is not None:
+            self.rejected += 1
+            return False
+        self.add(sig)
+        return True
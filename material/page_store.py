@@ -0,0 +1,414 @@
+"""
+Almacén de texto por página de cada documento, para el selector de páginas
+del dashboard (document_page_preview / get_pages_text).
+
+Antes, cada vez que el usuario abría el visor o cambiaba la selección de
+páginas, se volvía a abrir el archivo original y a parsearlo entero con
+fitz / python-docx / python-pptx — en un DOCX de 300 páginas eso es leer y
+recorrer todo el XML para quedarse con 3 páginas. Acá el documento se
+parte en unidades (página de PDF, slide de PPTX, página virtual de DOCX,
+bloque de líneas de TXT) una sola vez, al extraerlo — de PDF y PPTX con
+el texto por página/slide que la extracción ya sacó (ver
+_units_from_result), sin volver a abrir el archivo — y se guarda como:
+
+- `<clave>.bin`: el texto de todas las unidades, en UTF-8, una detrás de
+  la otra.
+- `<clave>.json`: el índice — offsets en bytes de cada unidad dentro del
+  .bin, título y cantidad de caracteres (lo que el visor muestra).
+
+El .bin se abre con mmap, así sacar el texto de N páginas seleccionadas es
+cortar N rangos de bytes: O(páginas seleccionadas), sin parsear nada y sin
+cargar el libro entero en memoria.
+
+La clave es el contenido del archivo (SHA-256, igual que la caché de
+extracción — ver extraction_cache.py), y los archivos viven en `var/`:
+artefacto derivado, si se pierde se vuelve a armar solo en el próximo uso.
+El tamaño total está acotado por CONTENIDO_PAGE_STORE_MAX_MB con desalojo
+LRU, como la caché de extracción.
+"""
+import json
+import logging
+import mmap
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Subir si cambia cómo se parte un documento en unidades (tamaño de página
+# virtual de DOCX, bloque de TXT, qué texto se toma de cada página...).
+PAGE_STORE_VERSION = 1
+
+_DEFAULT_MAX_MB = 200
+
+# Páginas virtuales de DOCX: chars ≈ 1 página A4 en texto normal.
+DOCX_PAGE_SIZE = 2800
+# Bloques de TXT, en líneas.
+TXT_BLOCK_LINES = 50
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.pptx', '.docx', '.txt')
+
+
+def _store_dir():
+    return Path(getattr(
+        settings, 'CONTENIDO_PAGE_STORE_DIR',
+        Path(settings.BASE_DIR) / 'var' / 'page_store',
+    ))
+
+
+def _max_bytes():
+    return int(getattr(settings, 'CONTENIDO_PAGE_STORE_MAX_MB', _DEFAULT_MAX_MB)) * 1024 * 1024
+
+
+def _key(file_hash, file_extension):
+    return f'{file_hash}-{file_extension.lstrip(".").lower()}-v{PAGE_STORE_VERSION}'
+
+
+# ============================================================================
+# PARTIR EL DOCUMENTO EN UNIDADES
+# ============================================================================
+
+def _pdf_units(file_path):
+    import fitz
+    doc = fitz.open(file_path)
+    try:
+        for page_num, page in enumerate(doc, 1):
+            text = page.get_text().strip()
+            yield page_num, f'Página {page_num}', text, len(text)
+    finally:
+        doc.close()
+
+
+def _pptx_units(file_path):
+    from pptx import Presentation
+    prs = Presentation(file_path)
+    for i, slide in enumerate(prs.slides, 1):
+        texts = []
+        for shape in slide.shapes:
+            if hasattr(shape, 'text') and shape.text.strip():
+                texts.append(shape.text.strip())
+        yield i, f'Slide {i}', '\n'.join(texts), sum(len(t) for t in texts)
+
+
+def _docx_paragraphs(file_path):
+    """(nombre de estilo, texto) de cada párrafo: en streaming desde el zip
+    (ver document_processor.iter_docx_paragraphs), o con python-docx si el
+    archivo tiene una estructura que esa lectura no contempla."""
+    from document_processor import iter_docx_paragraphs
+    try:
+        return list(iter_docx_paragraphs(file_path))
+    except Exception as exc:
+        logger.info(f'DOCX {os.path.basename(file_path)}: sin lectura en streaming ({exc}); se usa python-docx.')
+        from docx import Document
+        return [
+            (para.style.name if para.style else None, para.text)
+            for para in Document(file_path).paragraphs
+        ]
+
+
+def _docx_units(file_path):
+    paragraphs = _docx_paragraphs(file_path)
+
+    # ── OPCIÓN D: páginas virtuales por cantidad de caracteres ──────────
+    # ROLLBACK: reemplazar este bloque con el bloque comentado de abajo
+    # para volver al modo de secciones por heading (y subir
+    # PAGE_STORE_VERSION).
+    current_text = []
+    current_chars = 0
+    page_idx = 1
+    for _style_name, text in paragraphs:
+        text = text.strip()
+        if not text:
+            continue
+        current_text.append(text)
+        current_chars += len(text) + 1
+        if current_chars >= DOCX_PAGE_SIZE:
+            yield page_idx, f'Página {page_idx}', '\n'.join(current_text), current_chars
+            page_idx += 1
+            current_text = []
+            current_chars = 0
+    if current_text:
+        yield page_idx, f'Página {page_idx}', '\n'.join(current_text), current_chars
+    # ── FIN OPCIÓN D ─────────────────────────────────────────────────────
+
+    # [ROLLBACK DOCX SECTIONS — secciones por heading, descommentar para revertir]
+    # current_text = []; current_chars = 0; section_idx = 1; heading_title = 'Inicio'
+    # for style_name, text in paragraphs:
+    #     text = text.strip()
+    #     if not text:
+    #         continue
+    #     if (style_name or '').startswith('Heading'):
+    #         if current_text:
+    #             yield section_idx, heading_title, '\n'.join(current_text), current_chars
+    #             section_idx += 1; current_text = []; current_chars = 0
+    #         heading_title = text
+    #     else:
+    #         current_text.append(text); current_chars += len(text)
+    #         if current_chars > 1200:
+    #             yield section_idx, heading_title, '\n'.join(current_text), current_chars
+    #             section_idx += 1; current_text = []; current_chars = 0
+    # if current_text:
+    #     yield section_idx, heading_title, '\n'.join(current_text), current_chars
+
+
+def _txt_units(file_path):
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        lines = f.readlines()
+    for i in range(0, len(lines), TXT_BLOCK_LINES):
+        block = ''.join(lines[i:i + TXT_BLOCK_LINES]).strip()
+        yield (
+            i // TXT_BLOCK_LINES + 1,
+            f'Líneas {i+1}–{min(i + TXT_BLOCK_LINES, len(lines))}',
+            block,
+            len(block),
+        )
+
+
+_PAGE_MARKER_RE = re.compile(r'(?:\n\n)?\x00P(\d+)\x00')
+
+
+def _pdf_units_from_result(file_path, result):
+    """Páginas del PDF a partir de los capítulos ya extraídos: cada página
+    lleva su marcador (ver DocumentProcessor._join_pages_with_markers), así
+    que su texto —ya limpio de headers/footers— se recorta de ahí. Las que
+    no quedaron en ningún capítulo (portada y prólogo antes del primer ítem
+    del TOC, capítulos descartados por vacíos) se leen del PDF, solo esas."""
+    texts = {}
+    for chapter in result.get('chapters', []):
+        parts = _PAGE_MARKER_RE.split(chapter.get('content', ''))
+        for page, text in zip(parts[1::2], parts[2::2]):
+            texts.setdefault(int(page), text)
+    total_pages = (result.get('metadata') or {}).get('total_pages') or max(texts, default=0)
+    missing = [n for n in range(1, total_pages + 1) if n not in texts]
+    if missing:
+        import fitz
+        doc = fitz.open(file_path)
+        try:
+            for page_num in missing:
+                texts[page_num] = doc[page_num - 1].get_text().strip()
+        finally:
+            doc.close()
+    for page_num in range(1, total_pages + 1):
+        text = texts[page_num]
+        yield page_num, f'Página {page_num}', text, len(text)
+
+
+def _pptx_units_from_result(file_path, result):
+    """Slides a partir de result['slides'] de process_pptx: su título (la
+    primera shape con texto) y el resto de las shapes."""
+    for slide in result.get('slides', []):
+        number = slide['slide_number']
+        title = slide.get('title', '')
+        if title == f'Slide {number}':
+            title = ''  # título de relleno, la slide no tenía texto propio
+        texts = [t.strip() for t in [title, *slide.get('content', '').split('\n')] if t.strip()]
+        yield number, f'Slide {number}', '\n'.join(texts), sum(len(t) for t in texts)
+
+
+# DOCX y TXT no tienen equivalente: el resultado de la extracción no
+# conserva sus párrafos/líneas (los capítulos de DOCX son por Heading 1 y
+# dejan afuera el texto anterior al primero). Para esos se vuelve a leer el
+# archivo — lectura en streaming del zip / del texto plano, sin parsear
+# nada pesado.
+_RESULT_UNIT_BUILDERS = {
+    '.pdf': _pdf_units_from_result,
+    '.pptx': _pptx_units_from_result,
+}
+
+_UNIT_BUILDERS = {
+    '.pdf': _pdf_units,
+    '.pptx': _pptx_units,
+    '.docx': _docx_units,
+    '.txt': _txt_units,
+}
+
+
+# ============================================================================
+# ESCRITURA / LECTURA
+# ============================================================================
+
+def build(file_path, file_hash, result=None):
+    """Parte el documento en unidades y guarda blob + índice. Devuelve la
+    clave. `result` es el dict de la extracción (ia_processor.
+    extract_text_advanced), si quien llama ya lo tiene: de ahí salen las
+    unidades cuando el formato lo permite. Levanta la excepción del parser
+    si el archivo no se puede leer (quien llama decide si es fatal)."""
+    ext = os.path.splitext(file_path)[1].lower()
+    if result is not None and ext in _RESULT_UNIT_BUILDERS:
+        result_builder = _RESULT_UNIT_BUILDERS[ext]
+
+        def builder(path):
+            return result_builder(path, result)
+    else:
+        builder = _UNIT_BUILDERS[ext]
+    key = _key(file_hash, ext)
+    store_dir = _store_dir()
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    units = []
+    offset = 0
+    fd, tmp_bin = tempfile.mkstemp(dir=store_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for number, title, text, char_count in builder(file_path):
+                data = text.encode('utf-8')
+                f.write(data)
+                units.append([number, title, offset, offset + len(data), char_count])
+                offset += len(data)
+        # El .bin primero y el índice después: un índice presente implica
+        # que su .bin ya está completo (un lector concurrente nunca ve
+        # offsets que apunten más allá del final).
+        os.replace(tmp_bin, store_dir / f'{key}.bin')
+    except BaseException:
+        try:
+            os.unlink(tmp_bin)
+        except OSError:
+            pass
+        raise
+
+    index = {'ext': ext, 'units': units}
+    fd, tmp_idx = tempfile.mkstemp(dir=store_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_idx, store_dir / f'{key}.json')
+    except BaseException:
+        try:
+            os.unlink(tmp_idx)
+        except OSError:
+            pass
+        raise
+
+    _evict_if_needed(store_dir)
+    return key
+
+
+def ensure(file_path, file_hash, result=None):
+    """Arma el almacén del documento si todavía no existe, con las páginas
+    del `result` de la extracción (ver build). Best-effort: pensado para
+    llamarse al extraer (ver ia_processor.extract_text_advanced) — un error
+    acá solo se loguea, el visor lo vuelve a intentar al abrirse."""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext not in _UNIT_BUILDERS or not file_hash:
+        return
+    if (_store_dir() / f'{_key(file_hash, ext)}.json').exists():
+        return
+    try:
+        build(file_path, file_hash, result)
+    except Exception as exc:
+        logger.warning(f'No se pudo armar el almacén de páginas de {os.path.basename(file_path)}: {exc}')
+
+
+class PageStore:
+    """Vista de solo lectura sobre el almacén de un documento. Usar como
+    context manager (cierra el mmap y el archivo)."""
+
+    def __init__(self, bin_path, index):
+        self.ext = index['ext']
+        self._units = index['units']
+        self._by_number = {u[0]: u for u in self._units}
+        self._file = open(bin_path, 'rb')
+        # mmap no acepta archivos vacíos (documento sin nada de texto).
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def __len__(self):
+        return len(self._units)
+
+    def units(self):
+        """(número, título, cantidad de caracteres) de cada unidad, en orden."""
+        return [(u[0], u[1], u[4]) for u in self._units]
+
+    def title(self, number):
+        unit = self._by_number.get(number)
+        return unit[1] if unit else None
+
+    def text(self, number):
+        """Texto de la unidad `number` (1-based), '' si no existe."""
+        unit = self._by_number.get(number)
+        if unit is None or self._mm is None:
+            return ''
+        return self._mm[unit[2]:unit[3]].decode('utf-8')
+
+
+def open_store(file_path, file_hash=None):
+    """Abre el almacén del documento, armándolo primero si falta (por
+    ejemplo: se perdió `var/` en un redeploy, o el documento se extrajo
+    antes de que existiera). `file_hash` es el Contenido.file_hash si quien
+    llama ya lo tiene; si no, se calcula leyendo el archivo — mucho más
+    barato que parsearlo. Devuelve None para extensiones no soportadas."""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext not in _UNIT_BUILDERS:
+        return None
+    if not file_hash:
+        from .cleanup import compute_file_hash
+        with open(file_path, 'rb') as f:
+            file_hash = compute_file_hash(f)
+
+    store_dir = _store_dir()
+    key = _key(file_hash, ext)
+    index_path = store_dir / f'{key}.json'
+    bin_path = store_dir / f'{key}.bin'
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        store = PageStore(bin_path, index)
+    except (OSError, ValueError):
+        build(file_path, file_hash)
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        store = PageStore(bin_path, index)
+
+    try:
+        os.utime(index_path)  # LRU: marcar como recién usado
+    except OSError:
+        pass
+    return store
+
+
+def _evict_if_needed(store_dir):
+    max_bytes = _max_bytes()
+    groups = []
+    total = 0
+    for index_path in store_dir.glob('*.json'):
+        bin_path = index_path.with_suffix('.bin')
+        try:
+            mtime = index_path.stat().st_mtime
+            size = index_path.stat().st_size + bin_path.stat().st_size
+        except OSError:
+            continue
+        groups.append((mtime, size, index_path, bin_path))
+        total += size
+    if total <= max_bytes:
+        return
+
+    groups.sort()  # más viejo (menos usado) primero
+    evicted = 0
+    for _mtime, size, index_path, bin_path in groups:
+        if total <= max_bytes:
+            break
+        try:
+            # El índice primero: sin índice, el .bin huérfano ya no se usa.
+            index_path.unlink()
+            bin_path.unlink()
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    if evicted:
+        logger.info(f'Almacén de páginas: {evicted} documento(s) desalojado(s) por tamaño.')
@@ -0,0 +1,184 @@
+"""
+Estado de los proveedores de IA, chequeado en segundo plano.
+
+El dashboard del procesador, ai_config_status y check_local_ai_status
+llamaban a backend.get_status() en la request: un GET /models (o /api/tags
+de Ollama) con timeout de 5 s, dos veces en OpenAICompatibleBackend. Un
+proveedor lento frenaba la página entera.
+
+Acá cada proveedor distinto — backend.health_key(): proveedor, URL base,
+huella de la key y modelo (en Gemini, "listo para generar" depende del
+modelo) — tiene una entrada con el último get_status() conocido. Un thread
+del proceso lo vuelve a pedir cada CONTENIDO_PROVIDER_HEALTH_INTERVAL_SECONDS
+mientras alguien lo esté mirando; las vistas leen lo último (get_status) con
+cuándo se chequeó, sin esperar a la red. La única espera es la primera vez
+que aparece un proveedor en este proceso: todavía no hay nada que mostrar,
+y decir "desconectada" sin haber probado sería mentir.
+"""
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_INTERVAL_SECONDS = 60
+# Primera vez que se pide un proveedor: cuánto se espera el primer chequeo
+# (el de los backends tiene timeout de 5 s, hasta dos llamadas).
+_FIRST_PROBE_WAIT_SECONDS = 12.0
+# Sin que ninguna vista lo pida por esto, se deja de chequear; por esto
+# otro, se olvida (la entrada guarda el backend, con su key).
+_IDLE_SECONDS = 600
+_FORGET_SECONDS = 3600
+_SCHEDULER_TICK_SECONDS = 1.0
+
+_entries = {}
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_scheduler_started = False
+
+
+def key_fingerprint(api_key):
+    """Huella corta de una API key para distinguir entradas sin guardarla
+    en la clave."""
+    if not api_key:
+        return ''
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+
+
+def _interval():
+    return float(getattr(settings, 'CONTENIDO_PROVIDER_HEALTH_INTERVAL_SECONDS', _DEFAULT_INTERVAL_SECONDS))
+
+
+class _Entry:
+    def __init__(self, backend):
+        self.backend = backend
+        self.status = None
+        self.checked_at = None      # time.time() del último chequeo terminado
+        self.checked_mono = None
+        self.probing = False
+        self.last_used = time.monotonic()
+        self.first_probe = threading.Event()
+
+
+def _probe(key, entry):
+    started = time.monotonic()
+    try:
+        status = entry.backend.get_status()
+    except Exception as exc:
+        status = {'connected': False, 'error': str(exc)}
+    elapsed = time.monotonic() - started
+    with _lock:
+        entry.status = status
+        entry.checked_at = time.time()
+        entry.checked_mono = time.monotonic()
+        entry.probing = False
+    entry.first_probe.set()
+    if elapsed > 2:
+        logger.info(f'Estado de IA: {key[0]} tardó {elapsed:.1f}s en responder el chequeo.')
+
+
+def _start_probe(key, entry):
+    """Con _lock tomado."""
+    entry.probing = True
+    threading.Thread(target=_probe, args=(key, entry), name='provider-health-probe', daemon=True).start()
+
+
+def _scheduler():
+    while True:
+        _wakeup.wait(_SCHEDULER_TICK_SECONDS)
+        _wakeup.clear()
+        now = time.monotonic()
+        interval = _interval()
+        with _lock:
+            for key, entry in list(_entries.items()):
+                idle = now - entry.last_used
+                if idle > _FORGET_SECONDS:
+                    del _entries[key]
+                    continue
+                if entry.probing or idle > _IDLE_SECONDS:
+                    continue
+                if entry.checked_mono is None or now - entry.checked_mono >= interval:
+                    _start_probe(key, entry)
+
+
+def _ensure_scheduler():
+    global _scheduler_started
+    if _scheduler_started:
+        return
+    with _lock:
+        if not _scheduler_started:
+            threading.Thread(target=_scheduler, name='provider-health', daemon=True).start()
+            _scheduler_started = True
+
+
+def get_status(backend):
+    """
+    Último backend.get_status() conocido para el proveedor de `backend`,
+    más 'health': cuándo se chequeó ('checked_at', ISO), hace cuántos
+    segundos ('age_seconds'), si ya pasó más de dos intervalos sin un
+    chequeo nuevo ('stale') y si hay uno en curso ('checking'). No espera a
+    la red salvo la primera vez que aparece ese proveedor en el proceso.
+    """
+    _ensure_scheduler()
+    key = backend.health_key()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            entry = _entries[key] = _Entry(backend)
+            _start_probe(key, entry)
+        entry.last_used = time.monotonic()
+        # El backend más nuevo (misma key, configuración recién resuelta)
+        # es el que se usa para el próximo chequeo.
+        entry.backend = backend
+
+    if entry.status is None:
+        entry.first_probe.wait(_FIRST_PROBE_WAIT_SECONDS)
+
+    with _lock:
+        status = dict(entry.status) if entry.status is not None else None
+        checked_at, checked_mono, probing = entry.checked_at, entry.checked_mono, entry.probing
+
+    if status is None:
+        status = {'connected': False, 'error': 'El proveedor de IA no respondió el chequeo a tiempo.'}
+    age = time.monotonic() - checked_mono if checked_mono is not None else None
+    status['health'] = {
+        'checked_at': (
+            datetime.fromtimestamp(checked_at, tz=dt_timezone.utc).isoformat() if checked_at else None
+        ),
+        'age_seconds': int(age) if age is not None else None,
+        'stale': age is None or age > 2 * _interval(),
+        'checking': probing,
+    }
+    return status
+
+
+def refresh(backend):
+    """Pide un chequeo nuevo ya (sin esperarlo): botón "Actualizar estado"."""
+    key = backend.health_key()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and not entry.probing:
+            entry.backend = backend
+            _start_probe(key, entry)
+    _wakeup.set()
+
+
+def get_stats():
+    """Entradas del registro en este proceso (diagnóstico para admins)."""
+    now = time.monotonic()
+    with _lock:
+        return [
+            {
+                'provider': key[0],
+                'base_url': key[1],
+                'model': key[3],
+                'connected': (entry.status or {}).get('connected'),
+                'age_seconds': int(now - entry.checked_mono) if entry.checked_mono is not None else None,
+                'idle_seconds': int(now - entry.last_used),
+            }
+            for key, entry in _entries.items()
+        ]
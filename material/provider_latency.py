@@ -0,0 +1,135 @@
+"""
+Latencia de las llamadas de generación por proveedor (groq, gemini, ...),
+en histogramas en memoria del proceso.
+
+Los usa DemoRoutingBackend para decidir cuándo una llamada a Groq ya tarda
+más de lo normal (el p95 de las últimas) y conviene mandar la misma a
+Gemini en paralelo — ver hedge_deadline() y DemoRoutingBackend._generate_hedged
+en ai_router.py. Se registran solo las llamadas exitosas de producción
+(GlobalFallbackBackend.generate): un 429 vuelve enseguida y tiraría el p95
+para abajo, y el monitoreo prueba modelos que no son los activos.
+
+Cada corrida del monitoreo de Groq guarda una copia
+(GroqMonitorRun.latency_histograms, ver groq_monitor.run_text_test): queda
+la evolución en el tiempo y, después de un reinicio, el proceso arranca con
+la última en vez de sin datos (ver _seed).
+
+Buckets de ancho geométrico (de 0,25 s a ~6 min): el error relativo es el
+mismo en llamadas de 1 s y de 40 s. Cuando un histograma junta más de
+_MAX_COUNT llamadas se reducen todas a la mitad, así pesa más lo reciente.
+"""
+import logging
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_BUCKET_BOUNDS = [round(0.25 * 1.5 ** i, 3) for i in range(19)]  # límite superior de cada bucket (s)
+_MAX_COUNT = 2000
+# Con menos llamadas que esto el p95 no dice mucho: se usa el default.
+_MIN_SAMPLES = 20
+_DEFAULT_HEDGE_AFTER_SECONDS = 30.0
+_DEFAULT_HEDGE_MIN_SECONDS = 8.0
+
+_lock = threading.Lock()
+_histograms = {}  # proveedor -> lista de len(_BUCKET_BOUNDS) + 1 conteos (el último, lo que pasa del final)
+_seeded = False
+_hedge_stats = {'hedged': 0, 'secondary_won': 0, 'primary_won': 0}
+
+
+def _seed():
+    """La primera vez en el proceso: los histogramas de la última corrida
+    del monitoreo que los tenga."""
+    global _seeded
+    if _seeded:
+        return
+    _seeded = True
+    try:
+        from .models import GroqMonitorRun
+        run = GroqMonitorRun.objects.exclude(latency_histograms={}).only('latency_histograms').first()
+    except Exception as e:
+        logger.warning(f'No se pudieron leer las latencias guardadas: {e}')
+        return
+    if run is None:
+        return
+    with _lock:
+        for provider, counts in (run.latency_histograms or {}).items():
+            if provider not in _histograms and isinstance(counts, list) and len(counts) == len(_BUCKET_BOUNDS) + 1:
+                _histograms[provider] = [float(c) for c in counts]
+
+
+def _bucket(seconds):
+    for i, bound in enumerate(_BUCKET_BOUNDS):
+        if seconds <= bound:
+            return i
+    return len(_BUCKET_BOUNDS)
+
+
+def record(provider, seconds):
+    """Una llamada exitosa a `provider` que tardó `seconds`."""
+    if not provider or seconds is None or seconds < 0:
+        return
+    _seed()
+    with _lock:
+        counts = _histograms.setdefault(provider, [0.0] * (len(_BUCKET_BOUNDS) + 1))
+        counts[_bucket(seconds)] += 1
+        if sum(counts) > _MAX_COUNT:
+            _histograms[provider] = [c / 2 for c in counts]
+
+
+def quantile(provider, q):
+    """Segundos (límite superior del bucket) por debajo de los que terminó
+    la fracción `q` de las llamadas, o None con menos de _MIN_SAMPLES."""
+    _seed()
+    with _lock:
+        counts = list(_histograms.get(provider) or ())
+    total = sum(counts)
+    if total < _MIN_SAMPLES:
+        return None
+    target = q * total
+    cumulative = 0.0
+    for i, count in enumerate(counts):
+        cumulative += count
+        if cumulative >= target:
+            return _BUCKET_BOUNDS[i] if i < len(_BUCKET_BOUNDS) else _BUCKET_BOUNDS[-1] * 1.5
+    return _BUCKET_BOUNDS[-1] * 1.5
+
+
+def hedge_deadline(provider):
+    """Cuánto esperar a `provider` antes de mandar la misma llamada al
+    otro: su p95, nunca menos de CONTENIDO_DEMO_HEDGE_MIN_SECONDS."""
+    floor = float(getattr(settings, 'CONTENIDO_DEMO_HEDGE_MIN_SECONDS', _DEFAULT_HEDGE_MIN_SECONDS))
+    p95 = quantile(provider, 0.95)
+    return max(floor, p95 if p95 is not None else _DEFAULT_HEDGE_AFTER_SECONDS)
+
+
+def count_hedge(outcome):
+    """'hedged' al mandar la segunda llamada; 'secondary_won' o
+    'primary_won' según cuál respondió primero bien."""
+    with _lock:
+        _hedge_stats[outcome] += 1
+
+
+def snapshot():
+    """Conteos por proveedor, para guardar con una corrida del monitoreo."""
+    _seed()
+    with _lock:
+        return {provider: [round(c, 2) for c in counts] for provider, counts in _histograms.items()}
+
+
+def get_stats():
+    """p50/p95 y llamadas por proveedor, y cuántas veces se cubrió una
+    llamada lenta con el otro proveedor (diagnóstico para admins)."""
+    with _lock:
+        providers = list(_histograms)
+        stats = {'hedging': dict(_hedge_stats), 'bucket_bounds': _BUCKET_BOUNDS}
+    stats['providers'] = {
+        provider: {
+            'calls': round(sum(_histograms.get(provider) or ())),
+            'p50_seconds': quantile(provider, 0.5),
+            'p95_seconds': quantile(provider, 0.95),
+        }
+        for provider in providers
+    }
+    return stats
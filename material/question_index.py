@@ -0,0 +1,138 @@
+"""
+Índice TF-IDF de las preguntas ya guardadas de un Contenido, para armar el
+bloque "PREGUNTAS YA GENERADAS... NO REPETIR" del prompt de cada fragmento
+(ver _generate_questions_for_chunk en views_document_processor.py).
+
+Antes el bloque eran siempre las primeras 40 preguntas de la base, fuera
+cual fuera el tema del fragmento: hasta 1-2k tokens de prompt por llamada
+contra el TPM chiquito del pool compartido de Groq, y la mayoría sin nada
+que ver con el texto que se estaba mandando. Ahora se arma el índice una
+vez por corrida y para cada fragmento se eligen solo las más parecidas a su
+texto (similitud coseno), hasta CONTENIDO_EXISTING_QUESTIONS_TOP_K preguntas
+y CONTENIDO_EXISTING_QUESTIONS_TOKEN_BUDGET tokens.
+
+Vectores dispersos en dicts y no NumPy: NumPy no es dependencia del
+proyecto, y con unos cientos de preguntas cortas no hace falta.
+"""
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+from django.conf import settings
+
+_DEFAULT_TOP_K = 15
+_DEFAULT_TOKEN_BUDGET = 600
+# Lo que mandaba el prompt antes de este índice (ver report()).
+_LEGACY_SAMPLE = 40
+
+_WORD_RE = re.compile(r'[a-z0-9]{3,}')
+# Palabras que no dicen nada del tema (las de 1-2 letras ya las descarta
+# _WORD_RE). Sin tildes: se comparan después de normalizar.
+_STOPWORDS = frozenset('''
+    los las del una uno unos unas que por para con sin sobre entre como mas pero sus
+    este esta estos estas ese esa esos esas eso esto aquel cual cuales cuando donde
+    quien quienes cuyo muy tambien segun ser son fue fueron era eran estan hay
+    tiene tienen puede pueden debe deben cada otro otra otros otras todo toda todos
+    todas mismo misma siguiente siguientes correcta correcto incorrecta verdadero falso
+    afirmacion opcion pregunta respuesta explica explique describe describa
+    indica indique menciona mencione define defina identifica identifique
+'''.split())
+
+
+def _terms(text):
+    # Sin tildes ni mayúsculas: "Fotosíntesis" y "fotosintesis" son el mismo término.
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return [w for w in _WORD_RE.findall(text) if w not in _STOPWORDS]
+
+
+def _weights(counts, idf):
+    """TF sublineal (1 + log tf) x IDF, normalizado a norma 1. Los términos
+    que no aparecen en ninguna pregunta no suman a ninguna similitud."""
+    vector = {
+        term: (1.0 + math.log(tf)) * idf[term]
+        for term, tf in counts.items() if term in idf
+    }
+    norm = math.sqrt(sum(w * w for w in vector.values()))
+    return {term: w / norm for term, w in vector.items()} if norm else {}
+
+
+def _question_line(question):
+    return f'[{question.get("tipo", "")}] {question.get("pregunta", "")}'
+
+
+class ExistingQuestionIndex:
+    """Se arma una vez por corrida con la lista de dicts {pregunta,
+    respuesta, tipo} de _get_existing_questions_for_contenido; select() se
+    puede llamar desde varios threads a la vez (fragmentos en paralelo)."""
+
+    def __init__(self, questions):
+        from .ia_processor import count_tokens
+
+        self.questions = list(questions or [])
+        term_lists = [_terms(q.get('pregunta', '')) for q in self.questions]
+        doc_freq = Counter(term for terms in term_lists for term in set(terms))
+        n = len(self.questions)
+        self._idf = {term: math.log((1 + n) / (1 + df)) + 1.0 for term, df in doc_freq.items()}
+        self._vectors = [_weights(Counter(terms), self._idf) for terms in term_lists]
+        self._tokens = [count_tokens(_question_line(q)) for q in self.questions]
+        self._legacy_tokens = sum(self._tokens[:_LEGACY_SAMPLE])
+
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'selected': 0, 'tokens': 0, 'legacy_tokens': 0}
+
+    def __len__(self):
+        return len(self.questions)
+
+    def select(self, text, top_k=None, token_budget=None):
+        """Las preguntas más parecidas a `text`, de la más a la menos
+        parecida, hasta top_k preguntas y token_budget tokens. Las que no
+        comparten ningún término con el texto no entran. Sin texto (página
+        escaneada que va solo con imágenes) no hay con qué comparar: se
+        toman las primeras, como antes, pero dentro del mismo presupuesto."""
+        if top_k is None:
+            top_k = int(getattr(settings, 'CONTENIDO_EXISTING_QUESTIONS_TOP_K', _DEFAULT_TOP_K))
+        if token_budget is None:
+            token_budget = int(getattr(settings, 'CONTENIDO_EXISTING_QUESTIONS_TOKEN_BUDGET', _DEFAULT_TOKEN_BUDGET))
+
+        query = _weights(Counter(_terms(text)), self._idf)
+        if query:
+            scored = []
+            for i, vector in enumerate(self._vectors):
+                # Se recorre el más corto de los dos (la pregunta, casi siempre).
+                small, large = (vector, query) if len(vector) <= len(query) else (query, vector)
+                score = sum(w * large.get(term, 0.0) for term, w in small.items())
+                if score > 0:
+                    scored.append((-score, i))
+            ranked = [i for _score, i in sorted(scored)]
+        elif text and text.strip():
+            ranked = []
+        else:
+            ranked = list(range(len(self.questions)))
+
+        chosen, used = [], 0
+        for i in ranked:
+            if len(chosen) >= top_k:
+                break
+            if used + self._tokens[i] > token_budget:
+                continue
+            chosen.append(self.questions[i])
+            used += self._tokens[i]
+
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['selected'] += len(chosen)
+            self._stats['tokens'] += used
+            self._stats['legacy_tokens'] += self._legacy_tokens
+        return chosen
+
+    def report(self):
+        """Tokens de prompt del bloque "no repetir" en lo que va de la
+        corrida, contra lo que habrían costado las primeras 40 preguntas en
+        cada llamada (el comportamiento anterior)."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['saved_tokens'] = stats['legacy_tokens'] - stats['tokens']
+        return stats
@@ -0,0 +1,95 @@
+"""
+Parser incremental del JSON de preguntas que devuelve la IA ({"preguntas":
+[{...}, {...}]} — ver _build_generation_prompt en views_document_processor.py).
+
+Con la respuesta pedida con `stream: true` (OpenAICompatibleBackend y
+LocalAIClient, parámetro on_delta) el texto llega de a pedazos, y esperar a
+tenerlo entero para recién ahí parsear hacía que el docente viera cada
+fragmento de golpe, 10-20 s después de pedirlo. Este parser se alimenta con
+cada pedazo y devuelve cada objeto del array `preguntas` apenas se cierra su
+llave, así stream_questions lo puede mandar como evento SSE propio.
+
+Lo que devuelve es solo un adelanto: el parseo de la respuesta completa en
+_generate_questions_for_chunk sigue siendo el que vale (y el dedup por texto
+de pregunta evita mostrar dos veces la misma).
+
+El mismo recorrido sirve para rescatar una respuesta que no parsea entera
+(salvage_questions): cortada por max_tokens a mitad de una pregunta, o con
+basura después del array.
+"""
+import json
+import re
+
+_ARRAY_START = re.compile(r'"preguntas"\s*:\s*\[')
+
+
+class QuestionStreamParser:
+    """Se alimenta con feed(pedazo); cada llamada devuelve la lista de
+    preguntas (dicts) que quedaron completas con ese pedazo."""
+
+    def __init__(self):
+        self._buffer = ''
+        self._pos = None        # próximo carácter a mirar (None = array no encontrado todavía)
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._obj_start = None
+        self._done = False
+
+    def feed(self, piece):
+        if self._done or not piece:
+            return []
+        self._buffer += piece
+        if self._pos is None:
+            match = _ARRAY_START.search(self._buffer)
+            if match is None:
+                return []
+            self._pos = match.end()
+
+        completed = []
+        buffer = self._buffer
+        i = self._pos
+        while i < len(buffer):
+            c = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in '{[':
+                if self._depth == 0 and c == '{':
+                    self._obj_start = i
+                self._depth += 1
+            elif c in '}]':
+                if self._depth == 0:
+                    # ']' que cierra el array de preguntas: lo que sigue no interesa.
+                    self._done = True
+                    i += 1
+                    break
+                self._depth -= 1
+                if self._depth == 0 and self._obj_start is not None:
+                    question = self._decode(buffer[self._obj_start:i + 1])
+                    if question is not None:
+                        completed.append(question)
+                    self._obj_start = None
+            i += 1
+        self._pos = i
+        return completed
+
+    @staticmethod
+    def _decode(raw):
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            return None
+        return value if isinstance(value, dict) else None
+
+
+def salvage_questions(text):
+    """Todas las preguntas completas (llave cerrada) de una respuesta que
+    json.loads no puede leer entera. Lista vacía si no hay ninguna."""
+    return QuestionStreamParser().feed(text or '')
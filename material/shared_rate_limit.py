@@ -0,0 +1,293 @@
+"""
+Limitador compartido del fallback de demo (GlobalFallbackBackend en
+ai_router.py), por fila de GlobalAIConfig.
+
+Con `--workers 1 --threads 4` varios docentes pueden estar generando a la
+vez contra la misma key de Groq, y lo único que los coordinaba eran los
+reintentos ante un 429 dentro de OpenAICompatibleBackend.generate — cada uno
+gasta una request del cupo diario (RPD) sin generar nada. Acá, antes de
+salir, cada llamada pide admisión contra un presupuesto común:
+
+- lo último que informó el proveedor en los headers (requests y tokens
+  restantes, y cuándo se reinicia cada ventana — ver
+  OpenAICompatibleBackend._parse_rate_limit_headers), menos
+- lo reservado por las llamadas que siguen en vuelo desde cualquier thread o
+  proceso (una reserva por llamada, con vencimiento por si el proceso muere
+  a mitad de camino).
+
+Si no alcanza, se espera al reinicio de la ventana; si eso tarda más que
+CONTENIDO_SHARED_RATE_LIMIT_MAX_WAIT, la llamada ni sale y se devuelve como
+error de cupo (DemoRoutingBackend la manda a Gemini, si está configurado).
+
+Dónde vive ese estado (CONTENIDO_SHARED_RATE_LIMIT_BACKEND):
+- 'memory': dict en memoria del proceso. Alcanza con un solo worker.
+- 'file':   JSON en var/rate_limit/ con flock; varios workers en la misma
+            máquina.
+- 'db':     fila de SharedRateLimitState con select_for_update; varias
+            máquinas contra la misma base.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_BACKEND = 'memory'
+_DEFAULT_MAX_WAIT = 30
+# Una reserva vence sola pasado el timeout de una request al proveedor
+# (120s en OpenAICompatibleBackend) con margen: si el thread o el proceso
+# murió sin liberarla, no puede bloquear el cupo para siempre.
+_LEASE_TTL_SECONDS = 180
+# Entre chequeos mientras se espera cupo: otro worker puede traer headers
+# frescos (o liberar su reserva) antes del reinicio de la ventana.
+_POLL_SECONDS = 2.0
+
+
+class QuotaWaitTooLong(Exception):
+    """No hay cupo y la ventana del proveedor no se reinicia a tiempo."""
+
+    def __init__(self, wait_seconds):
+        super().__init__(f'sin cupo por {wait_seconds:.0f}s')
+        self.wait_seconds = wait_seconds
+
+
+# ---------------------------------------------------------------------------
+# Almacenamiento del estado. Cada uno solo garantiza que transact(key, fn)
+# corra fn(state) de forma atómica sobre el dict del key y lo persista.
+# ---------------------------------------------------------------------------
+
+class _MemoryStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def transact(self, key, fn):
+        with self._lock:
+            return fn(self._states.setdefault(key, {}))
+
+
+class _FileStore:
+    def __init__(self, directory):
+        self._dir = Path(directory)
+        # flock es por descriptor de archivo: entre threads del mismo
+        # proceso sirve igual, pero el lock local evita abrir el archivo en
+        # paralelo solo para quedarse esperando.
+        self._local_lock = threading.Lock()
+
+    def transact(self, key, fn):
+        import fcntl
+
+        self._dir.mkdir(parents=True, exist_ok=True)
+        path = self._dir / f'{key}.json'
+        with self._local_lock, open(self._dir / f'{key}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = {}
+                result = fn(state)
+                fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        json.dump(state, f)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    try:
+                        os.unlink(tmp_path)
+                    except OSError:
+                        pass
+                    raise
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class _DatabaseStore:
+    def __init__(self):
+        # En SQLite select_for_update no hace nada, y dos transacciones que
+        # leen y después escriben a la vez terminan en "database is locked"
+        # sin esperar: dentro de un proceso se serializan acá. Varios
+        # procesos contra SQLite no están cubiertos (para eso, 'file').
+        self._local_lock = threading.Lock()
+
+    def transact(self, key, fn):
+        from django.db import IntegrityError, transaction
+        from .models import SharedRateLimitState
+
+        for attempt in range(2):
+            try:
+                with self._local_lock, transaction.atomic():
+                    row, _ = SharedRateLimitState.objects.select_for_update().get_or_create(config_id=key)
+                    state = dict(row.state or {})
+                    result = fn(state)
+                    row.state = state
+                    row.save(update_fields=['state', 'updated_at'])
+                    return result
+            except IntegrityError:
+                # Dos workers creando la fila a la vez: el segundo la
+                # encuentra creada en el reintento.
+                if attempt:
+                    raise
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _get_store():
+    name = str(getattr(settings, 'CONTENIDO_SHARED_RATE_LIMIT_BACKEND', _DEFAULT_BACKEND)).lower()
+    if name == 'file':
+        try:
+            import fcntl  # noqa: F401
+        except ImportError:
+            logger.warning("Limitador compartido: 'file' necesita fcntl (POSIX), se usa 'memory'.")
+            name = 'memory'
+    elif name not in ('memory', 'db'):
+        name = _DEFAULT_BACKEND
+    with _stores_lock:
+        store = _stores.get(name)
+        if store is None:
+            if name == 'file':
+                store = _FileStore(Path(settings.BASE_DIR) / 'var' / 'rate_limit')
+            elif name == 'db':
+                store = _DatabaseStore()
+            else:
+                store = _MemoryStore()
+            _stores[name] = store
+    return store
+
+
+# ---------------------------------------------------------------------------
+# Lógica de admisión (igual para los tres almacenamientos)
+# ---------------------------------------------------------------------------
+
+def _available(state, prefix, now):
+    """Cupo de la ventana `prefix` (requests/tokens) según el proveedor, sin
+    descontar reservas: el último `remaining_*` informado mientras la ventana
+    siga vigente, el límite completo una vez que se reinició, o None si el
+    proveedor nunca lo informó (sin límite conocido)."""
+    remaining = state.get(f'remaining_{prefix}')
+    if remaining is None:
+        return None
+    reset_at = state.get(f'{prefix}_reset_at')
+    if reset_at is not None and now >= reset_at:
+        return state.get(f'limit_{prefix}')
+    return remaining
+
+
+def _try_admit(state, tokens, now):
+    """Reserva cupo si alcanza. Devuelve (lease_id, 0) o (None, segundos a
+    esperar)."""
+    leases = {
+        lease_id: lease for lease_id, lease in (state.get('leases') or {}).items()
+        if lease.get('expires_at', 0) > now
+    }
+    state['leases'] = leases
+
+    # Las reservas en vuelo se descuentan de la ventana actual aunque hayan
+    # salido en la anterior: el proveedor todavía no las reflejó en ningún
+    # header, y sobrestimar acá solo cuesta esperar un poco más.
+    waits = []
+    requests_available = _available(state, 'requests', now)
+    if requests_available is not None and requests_available - len(leases) <= 0:
+        waits.append(state.get('requests_reset_at'))
+    tokens_available = _available(state, 'tokens', now)
+    if tokens_available is not None:
+        limit_tokens = state.get('limit_tokens')
+        needed = min(tokens, limit_tokens) if limit_tokens else tokens
+        reserved = sum(lease.get('tokens', 0) for lease in leases.values())
+        if tokens_available - reserved < needed:
+            waits.append(state.get('tokens_reset_at'))
+
+    if waits:
+        # Sin hora de reinicio conocida (proveedor que no la manda) no hay
+        # forma de saber cuánto falta: se reintenta al próximo chequeo.
+        wait = max((w - now if w else _POLL_SECONDS) for w in waits)
+        return None, max(wait, 0.0)
+
+    lease_id = uuid.uuid4().hex
+    leases[lease_id] = {'tokens': tokens, 'expires_at': now + _LEASE_TTL_SECONDS}
+    return lease_id, 0.0
+
+
+def _release(state, lease_id, rate_limit, now):
+    from .ai_router import _parse_duration_to_seconds
+
+    (state.get('leases') or {}).pop(lease_id, None)
+    if not rate_limit:
+        return
+    for prefix in ('requests', 'tokens'):
+        remaining = rate_limit.get(f'remaining_{prefix}')
+        if remaining is None:
+            continue
+        reset_seconds = _parse_duration_to_seconds(rate_limit.get(f'reset_{prefix}_raw'))
+        # Las respuestas de llamadas concurrentes llegan en cualquier orden:
+        # mientras la ventana guardada siga vigente, un remaining más alto es
+        # de una llamada que salió antes, no un cupo que se liberó.
+        reset_at = state.get(f'{prefix}_reset_at')
+        stored = state.get(f'remaining_{prefix}')
+        if stored is not None and reset_at is not None and now < reset_at:
+            remaining = min(remaining, stored)
+        state[f'remaining_{prefix}'] = remaining
+        state[f'limit_{prefix}'] = rate_limit.get(f'limit_{prefix}')
+        # Sin hora de reinicio en los headers, el dato se da por vencido al
+        # minuto: mejor una llamada de más que un cupo en cero para siempre.
+        state[f'{prefix}_reset_at'] = now + (reset_seconds if reset_seconds is not None else 60)
+
+
+def _key(config_id):
+    return f'globalaiconfig-{config_id}'
+
+
+def acquire(config_id, tokens, max_wait=None):
+    """
+    Espera (bloqueando) hasta poder mandar una llamada de ~`tokens` tokens
+    con la key de esta fila de GlobalAIConfig y devuelve el id de la reserva
+    (None si el almacenamiento falló), que hay que pasarle después a
+    release().
+
+    Lanza QuotaWaitTooLong si haría falta esperar más de `max_wait` segundos
+    (default: CONTENIDO_SHARED_RATE_LIMIT_MAX_WAIT).
+    """
+    if max_wait is None:
+        max_wait = float(getattr(settings, 'CONTENIDO_SHARED_RATE_LIMIT_MAX_WAIT', _DEFAULT_MAX_WAIT))
+    store = _get_store()
+    key = config_id if isinstance(store, _DatabaseStore) else _key(config_id)
+    deadline = time.time() + max_wait
+    while True:
+        now = time.time()
+        try:
+            lease_id, wait = store.transact(key, lambda state: _try_admit(state, tokens, now))
+        except Exception as exc:
+            # Si el almacenamiento falla (disco, base), la llamada sale igual:
+            # en el peor caso se vuelve a depender del reintento ante un 429.
+            logger.warning(f'Limitador compartido no disponible, la llamada sale sin coordinar: {exc}')
+            return None
+        if lease_id is not None:
+            return lease_id
+        if now + wait > deadline:
+            raise QuotaWaitTooLong(wait)
+        time.sleep(max(min(wait, _POLL_SECONDS), 0.05))
+
+
+def release(config_id, lease_id, rate_limit=None):
+    """Libera la reserva y guarda el cupo que informó el proveedor en la
+    respuesta (dict de _parse_rate_limit_headers, o None)."""
+    store = _get_store()
+    key = config_id if isinstance(store, _DatabaseStore) else _key(config_id)
+    now = time.time()
+    try:
+        store.transact(key, lambda state: _release(state, lease_id, rate_limit, now))
+    except Exception as exc:
+        # La reserva vence sola (_LEASE_TTL_SECONDS): no vale la pena que
+        # un error acá tire abajo una generación que ya salió bien.
+        logger.warning(f'No se pudo actualizar el limitador compartido: {exc}')
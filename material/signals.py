@@ -1,8 +1,8 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.contrib.auth.signals import user_logged_out
-from .models import Profile
+from .models import GlobalAIConfig, InstitutionAIConfig, Profile, UserAIConfig
 import logging
 
 logger = logging.getLogger(__name__)
@@ -55,4 +55,25 @@ def delete_contenido_files_on_logout(sender, request, user, **kwargs):
         logger.warning(
             "Error al limpiar archivos de contenido en logout de %s: %s",
             getattr(user, 'username', '?'), exc
-        )
\ No newline at end of file
+        )
+
+
+@receiver([post_save, post_delete], sender=UserAIConfig)
+def invalidate_user_ai_backend(sender, instance, **kwargs):
+    """El backend de IA ya resuelto de ese usuario (ver
+    ai_router._cached_backend_for_user) deja de valer."""
+    from .ai_router import invalidate_backend_cache
+    invalidate_backend_cache(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=InstitutionAIConfig)
+@receiver([post_save, post_delete], sender=GlobalAIConfig)
+def invalidate_all_ai_backends(sender, instance, **kwargs):
+    """Configuración institucional o fallback de demo: puede cambiar el
+    backend de cualquier usuario, se descartan todos. El cupo en memoria del
+    fallback de demo (demo_quota.py) se vuelve a leer de la fila."""
+    from . import demo_quota
+    from .ai_router import invalidate_backend_cache
+    invalidate_backend_cache()
+    if sender is GlobalAIConfig:
+        demo_quota.forget()
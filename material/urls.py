@@ -80,6 +80,7 @@ urlpatterns = [
 # Document Processor - Nuevas URLs para procesamiento avanzado de documentos
     path('doc-processor/', doc_views.document_processor_dashboard, name='document_processor_dashboard'),
     path('doc-processor/upload/', doc_views.upload_and_process_document, name='upload_and_process_document'),
+    path('doc-processor/upload/stream/', doc_views.upload_and_process_document_stream, name='upload_and_process_document_stream'),
     path('doc-processor/split-chunks/', doc_views.split_text_chunks, name='split_text_chunks'),
     
     # Local AI Server integration
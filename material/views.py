@@ -7218,6 +7218,7 @@ def ai_config_list_models(request):
 def ai_config_status(request):
     """Endpoint JSON que devuelve el estado actual del backend configurado."""
     from django.http import JsonResponse
+    from . import demo_quota, fair_share, provider_health, provider_latency
     from .ai_router import get_backend_for_user, get_global_demo_quota, ensure_fresh_demo_quota, SharedDemoBackend
     from .models import UserAIConfig
 
@@ -7225,7 +7226,8 @@ def ai_config_status(request):
     backend = get_backend_for_user(request.user)
     is_global_fallback = isinstance(backend, SharedDemoBackend)
     try:
-        status = backend.get_status()
+        # Último estado conocido (provider_health.py): no se espera a la red.
+        status = provider_health.get_status(backend)
         # Siempre devolver el source real del usuario como 'backend'
         status['backend'] = config.source
     except Exception as e:
@@ -7245,6 +7247,20 @@ def ai_config_status(request):
                 'remaining_tokens': quota['remaining_tokens'],
                 'limit_tokens': quota['limit_tokens'],
             }
+    if is_admin(request.user):
+        # Reuso de conexiones keep-alive hacia cada proveedor (diagnóstico).
+        from . import generation_cache
+        from .ai_router import get_backend_cache_stats
+        from .http_sessions import get_stats
+        status['http_pools'] = get_stats()
+        # Backends de IA resueltos por usuario que se reusan (ai_router).
+        status['backend_cache'] = get_backend_cache_stats()
+        status['provider_health'] = provider_health.get_stats()
+        status['demo_quota'] = demo_quota.get_stats()
+        status['fair_share'] = fair_share.get_stats()
+        status['provider_latency'] = provider_latency.get_stats()
+        if generation_cache.is_enabled():
+            status['generation_cache'] = generation_cache.get_stats()
     return JsonResponse(status)
 
 
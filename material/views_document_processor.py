@@ -11,31 +11,37 @@ from django.contrib.auth.decorators import login_required
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from django.conf import settings
+import bisect
 import os
 import re
 import uuid
 import shutil
 import tempfile
-import threading
 import time
+import unicodedata
 import logging
 try:
     import fitz  # PyMuPDF
 except ImportError:
     fitz = None
 
-# In-memory job store for SSE streaming jobs (job_id → params)
-_jobs = {}
-_jobs_lock = threading.Lock()
 
 from material.ia_processor import (
     extract_text_advanced,
     extract_page_images,
     count_tokens,
+    token_byte_offsets,
+    token_byte_offsets_many,
     split_text_by_tokens,
+    split_texts_by_tokens,
     optimize_text_for_ai
 )
 from material.local_ai_client import local_ai
+from material import generation_cache, generation_jobs, generation_worker, page_store, provider_health
+from material.generation_engine import RateLimiter, iter_in_order
+from material.near_duplicates import NearDuplicateIndex
+from material.question_index import ExistingQuestionIndex
+from material.question_stream import QuestionStreamParser, salvage_questions
 
 logger = logging.getLogger(__name__)
 
@@ -52,41 +58,31 @@ def _strip_page_markers(text):
     return _PAGE_MARKER_RE.sub('', text or '')
 
 
-@login_required
-@require_http_methods(["POST"])
-def upload_and_process_document(request):
+def _read_upload_request(request):
     """
-    Vista para subir y procesar un documento (PDF, DOCX, PPTX).
-    Retorna estructura completa con capítulos, tokens, metadata.
-    También guarda el archivo como Contenido en la base de datos.
-    
-    POST params:
-        - documento: archivo subido
-        - contenido_title: título para Mis Contenidos (opcional)
-        - remove_headers: bool (opcional, default True)
-        - remove_footers: bool (opcional, default True)
-    
-    Returns:
-        JSON con estructura procesada del documento
+    Validaciones y parámetros comunes de la subida (normal y con progreso).
+    Devuelve (params, None) o (None, JsonResponse de error).
     """
-    from material.models import Contenido, Subject
-
     if 'documento' not in request.FILES:
-        return JsonResponse({
+        return None, JsonResponse({
             'success': False,
             'error': 'No se envió ningún archivo'
         }, status=400)
-    
+
     archivo = request.FILES['documento']
-    remove_headers = request.POST.get('remove_headers', 'true').lower() == 'true'
-    remove_footers = request.POST.get('remove_footers', 'true').lower() == 'true'
-    contenido_title = request.POST.get('contenido_title', '').strip()
-    subject_id = request.POST.get('subject_id', '').strip()
+    params = {
+        'archivo': archivo,
+        'nombre': archivo.name,
+        'remove_headers': request.POST.get('remove_headers', 'true').lower() == 'true',
+        'remove_footers': request.POST.get('remove_footers', 'true').lower() == 'true',
+        'contenido_title': request.POST.get('contenido_title', '').strip(),
+        'subject_id': request.POST.get('subject_id', '').strip(),
+    }
 
     # Validar tamaño (plan gratuito de Render: memoria y tiempo de request limitados)
     max_upload_mb = settings.CONTENIDO_MAX_UPLOAD_MB
     if archivo.size > max_upload_mb * 1024 * 1024:
-        return JsonResponse({
+        return None, JsonResponse({
             'success': False,
             'error': (
                 f'El archivo pesa {archivo.size / (1024 * 1024):.1f}MB y supera el máximo permitido '
@@ -95,180 +91,377 @@ def upload_and_process_document(request):
         }, status=400)
 
     # Validar extensión
-    nombre = archivo.name
-    ext = os.path.splitext(nombre)[1].lower()
+    ext = os.path.splitext(params['nombre'])[1].lower()
     if ext not in ['.pdf', '.docx', '.pptx', '.txt']:
-        return JsonResponse({
+        return None, JsonResponse({
             'success': False,
             'error': f'Formato no soportado: {ext}'
         }, status=400)
 
-    if not contenido_title:
-        contenido_title = os.path.splitext(nombre)[0].replace('_', ' ').replace('-', ' ')
+    if not params['contenido_title']:
+        params['contenido_title'] = os.path.splitext(params['nombre'])[0].replace('_', ' ').replace('-', ' ')
 
-    try:
-        import hashlib
-        import tempfile
-        from .cleanup import compute_file_hash
+    return params, None
 
-        # Leer los bytes del archivo UNA sola vez (el stream no es re-readable)
-        file_bytes = archivo.read()
-        file_hash = compute_file_hash(file_bytes)
 
-        # ---- Deduplicación ----
-        existing = Contenido.objects.filter(
-            file_hash=file_hash, uploaded_by=request.user
-        ).first()
+def _place_uploaded_file(request, nombre, file_bytes, file_hash):
+    """
+    Deduplicación: decide de qué archivo se extrae y cuál queda en la sesión.
+
+    Returns dict:
+        extract_path: archivo a extraer.
+        session_file_path: archivo que usan después el visor y la generación.
+        tmp_path: temporal a borrar apenas termina la extracción (o None).
+        contenido_id: Contenido existente reusado/restaurado, o None si el
+            documento es nuevo (el Contenido se crea recién después de
+            extraer bien — ver _create_uploaded_contenido).
+        saved_relative: ruta en storage del archivo guardado (documento nuevo).
+        duplicate_message: aviso para la UI, o None.
+    """
+    from material.models import Contenido
+
+    existing = Contenido.objects.filter(
+        file_hash=file_hash, uploaded_by=request.user
+    ).first()
 
-        duplicate_message = None
+    ext = os.path.splitext(nombre)[1].lower()
 
-        if existing and existing.file_available and existing.file_actually_exists():
-            # Archivo idéntico ya existe y sigue vigente — no guardamos un nuevo archivo
-            contenido_id = existing.id
-            duplicate_message = (
+    if existing and existing.file_available and existing.file_actually_exists():
+        # Archivo idéntico ya existe y sigue vigente — no guardamos un nuevo archivo.
+        # Procesar con archivo temporal (compatible con local y cloud)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
+            tmp.write(file_bytes)
+            tmp_path = tmp.name
+        # Para la sesión usamos el path del archivo existente si es local
+        try:
+            session_file_path = existing.file.path
+        except (ValueError, NotImplementedError, AttributeError):
+            session_file_path = tmp_path  # fallback cloud
+        return {
+            'extract_path': tmp_path,
+            'session_file_path': session_file_path,
+            'tmp_path': tmp_path,
+            'contenido_id': existing.id,
+            'saved_relative': None,
+            'duplicate_message': (
                 f'Este documento ya existe como "{existing.title}". '
                 f'Se usará el archivo guardado; no se creó un duplicado.'
-            )
-            # Procesar con archivo temporal (compatible con local y cloud)
-            ext = os.path.splitext(nombre)[1].lower()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
-                tmp.write(file_bytes)
-                tmp_path = tmp.name
-            try:
-                result = extract_text_advanced(
-                    tmp_path,
-                    remove_headers=remove_headers,
-                    remove_footers=remove_footers
-                )
-            finally:
-                try:
-                    os.unlink(tmp_path)
-                except OSError:
-                    pass
-            file_path = tmp_path  # Solo para la sesión; apunta al archivo original en el caso disponible
-            # Para la sesión usamos el path del archivo existente si es local
-            try:
-                session_file_path = existing.file.path
-            except (ValueError, NotImplementedError, AttributeError):
-                session_file_path = tmp_path  # fallback cloud
-
-        elif existing:
-            # Archivo había expirado, o el registro decía "vigente" pero el archivo
-            # físico ya no está (borrado por reinicio/limpieza sin actualizar
-            # file_deleted_at) — en ambos casos, restaurarlo con el nuevo upload.
-            saved_relative = default_storage.save(f'contenidos/{nombre}', ContentFile(file_bytes))
-            file_path = os.path.join(settings.MEDIA_ROOT, saved_relative)
-            existing.file = saved_relative
-            existing.file_deleted_at = None
-            existing.save(update_fields=['file', 'file_deleted_at'])
-            contenido_id = existing.id
-            duplicate_message = (
+            ),
+        }
+
+    if existing:
+        # Archivo había expirado, o el registro decía "vigente" pero el archivo
+        # físico ya no está (borrado por reinicio/limpieza sin actualizar
+        # file_deleted_at) — en ambos casos, restaurarlo con el nuevo upload.
+        saved_relative = default_storage.save(f'contenidos/{nombre}', ContentFile(file_bytes))
+        file_path = os.path.join(settings.MEDIA_ROOT, saved_relative)
+        existing.file = saved_relative
+        existing.file_deleted_at = None
+        existing.save(update_fields=['file', 'file_deleted_at'])
+        return {
+            'extract_path': file_path,
+            'session_file_path': file_path,
+            'tmp_path': None,
+            'contenido_id': existing.id,
+            'saved_relative': None,
+            'duplicate_message': (
                 f'El archivo de "{existing.title}" había expirado y fue restaurado correctamente.'
-            )
-            result = extract_text_advanced(
-                file_path,
-                remove_headers=remove_headers,
-                remove_footers=remove_footers
-            )
-            session_file_path = file_path
+            ),
+        }
 
-        else:
-            # Documento nuevo
-            saved_relative = default_storage.save(f'contenidos/{nombre}', ContentFile(file_bytes))
-            file_path = os.path.join(settings.MEDIA_ROOT, saved_relative)
+    # Documento nuevo
+    saved_relative = default_storage.save(f'contenidos/{nombre}', ContentFile(file_bytes))
+    file_path = os.path.join(settings.MEDIA_ROOT, saved_relative)
+    return {
+        'extract_path': file_path,
+        'session_file_path': file_path,
+        'tmp_path': None,
+        'contenido_id': None,
+        'saved_relative': saved_relative,
+        'duplicate_message': None,
+    }
 
-            result = extract_text_advanced(
-                file_path,
-                remove_headers=remove_headers,
-                remove_footers=remove_footers
-            )
 
-            contenido = Contenido(
-                title=contenido_title,
-                uploaded_by=request.user,
-                file_hash=file_hash,
-            )
-            contenido.file = saved_relative
-            contenido.save()
-            contenido_id = contenido.id
-            session_file_path = file_path
-        # Etiquetar la materia elegida (si vino informada) sobre el Contenido resultante,
-        # sea nuevo, restaurado o reusado por deduplicación.
-        if subject_id.isdigit():
-            try:
-                subj = Subject.objects.get(pk=int(subject_id))
-                Contenido.objects.get(pk=contenido_id).subjects.add(subj)
-            except Subject.DoesNotExist:
-                pass
+def _create_uploaded_contenido(request, placed, params, file_hash):
+    """Crea el Contenido de un documento nuevo (si hace falta) y lo etiqueta
+    con la materia elegida. Devuelve el contenido_id."""
+    from material.models import Contenido, Subject
 
-        # --- Actualizar sesión ---
-        # Eliminar archivo previo de session temporal si era una sesión de doc_sessions
-        prev_session = request.session.get('doc_processor', {})
-        prev_path = prev_session.get('file_path', '')
-        sessions_dir = os.path.join(settings.MEDIA_ROOT, 'doc_sessions')
-        if prev_path and prev_path.startswith(str(sessions_dir)) and os.path.exists(prev_path):
+    contenido_id = placed['contenido_id']
+    if contenido_id is None:
+        contenido = Contenido(
+            title=params['contenido_title'],
+            uploaded_by=request.user,
+            file_hash=file_hash,
+        )
+        contenido.file = placed['saved_relative']
+        contenido.save()
+        contenido_id = contenido.id
+
+    # Etiquetar la materia elegida (si vino informada) sobre el Contenido resultante,
+    # sea nuevo, restaurado o reusado por deduplicación.
+    subject_id = params['subject_id']
+    if subject_id.isdigit():
+        try:
+            subj = Subject.objects.get(pk=int(subject_id))
+            Contenido.objects.get(pk=contenido_id).subjects.add(subj)
+        except Subject.DoesNotExist:
+            pass
+    return contenido_id
+
+
+def _set_doc_session(request, placed, params, file_hash):
+    """Apunta la sesión doc_processor al documento recién subido. Devuelve
+    el doc_id nuevo y la sesión anterior, cuyo archivo se borra recién
+    cuando el nuevo quedó bien procesado (ver _discard_previous_doc_session)."""
+    prev_session = dict(request.session.get('doc_processor', {}))
+
+    doc_id = str(uuid.uuid4())
+    request.session['doc_processor'] = {
+        'doc_id': doc_id,
+        'file_path': placed['session_file_path'],
+        'filename': params['nombre'],
+        'remove_headers': params['remove_headers'],
+        'remove_footers': params['remove_footers'],
+        'file_hash': file_hash,
+    }
+    request.session.modified = True
+    return doc_id, prev_session
+
+
+def _discard_previous_doc_session(prev_session, new_path):
+    """Borra el archivo de la sesión anterior si era descartable: un
+    temporal de doc_sessions, o un archivo de contenidos/ que quedó sin
+    Contenido (un upload que falló o se cortó a mitad de la extracción y
+    que se dejó en la sesión hasta que otro lo reemplazara)."""
+    from material.models import Contenido
+
+    prev_path = prev_session.get('file_path', '')
+    if not prev_path or prev_path == new_path or not os.path.exists(prev_path):
+        return
+    media_root = str(settings.MEDIA_ROOT).rstrip('/') + '/'
+    if prev_path.startswith(media_root + 'doc_sessions/'):
+        discard = True
+    elif prev_path.startswith(media_root + 'contenidos/'):
+        discard = not Contenido.objects.filter(file=prev_path[len(media_root):]).exists()
+    else:
+        discard = False
+    if discard:
+        try:
+            os.unlink(prev_path)
+        except OSError:
+            pass
+
+
+def _chapter_summary(ch):
+    # content_preview solo para mostrar en UI
+    return {
+        'title': ch.get('title', ''),
+        'tokens': ch.get('tokens', 0),
+        'content_preview': _strip_page_markers(ch.get('content', ''))[:6000],
+        'pages': ch.get('pages', [])
+    }
+
+
+def _upload_response_data(result, doc_id, placed, params, contenido_id):
+    total_tokens = result.get('stats', {}).get('total_tokens', 0)
+    return {
+        'success': True,
+        'doc_id': doc_id,
+        'filename': params['nombre'],
+        'contenido_id': contenido_id,
+        'duplicate_message': placed['duplicate_message'],
+        'metadata': result.get('metadata', {}),
+        'stats': result.get('stats', {}),
+        'scanned_pages': result.get('scanned_pages', []),
+        'chapters': [_chapter_summary(ch) for ch in result.get('chapters', [])],
+        'toc': result.get('toc', []),
+        # Presupuestos de tokens, para que la UI oriente la selección de capítulos
+        'token_budget': {
+            'total_budget': settings.CONTENIDO_MAX_TOTAL_TOKENS,
+            'run_budget': settings.CONTENIDO_MAX_RUN_TOKENS,
+            'exceeds_total_budget': total_tokens > settings.CONTENIDO_MAX_TOTAL_TOKENS,
+        },
+    }
+
+
+def _discard_failed_upload(placed):
+    # Limpiar en caso de error: el temporal de un duplicado, o el archivo
+    # recién guardado/restaurado.
+    for path in (placed.get('tmp_path'), placed.get('extract_path')):
+        if path and os.path.exists(path):
             try:
-                os.unlink(prev_path)
+                os.unlink(path)
             except OSError:
                 pass
 
-        doc_id = str(uuid.uuid4())
-        request.session['doc_processor'] = {
-            'doc_id': doc_id,
-            'file_path': session_file_path,
-            'filename': nombre,
-            'remove_headers': remove_headers,
-            'remove_footers': remove_footers,
-        }
-        request.session.modified = True
-        # ---------------------------------------------------
 
-        total_tokens = result.get('stats', {}).get('total_tokens', 0)
+@login_required
+@require_http_methods(["POST"])
+def upload_and_process_document(request):
+    """
+    Vista para subir y procesar un documento (PDF, DOCX, PPTX).
+    Retorna estructura completa con capítulos, tokens, metadata.
+    También guarda el archivo como Contenido en la base de datos.
+    
+    POST params:
+        - documento: archivo subido
+        - contenido_title: título para Mis Contenidos (opcional)
+        - remove_headers: bool (opcional, default True)
+        - remove_footers: bool (opcional, default True)
+    
+    Returns:
+        JSON con estructura procesada del documento
+    """
+    from .cleanup import compute_file_hash
+
+    params, error_response = _read_upload_request(request)
+    if error_response:
+        return error_response
 
-        # Formatear respuesta (content_preview solo para mostrar en UI)
-        response_data = {
-            'success': True,
-            'doc_id': doc_id,
-            'filename': nombre,
-            'contenido_id': contenido_id,
-            'duplicate_message': duplicate_message,
-            'metadata': result.get('metadata', {}),
-            'stats': result.get('stats', {}),
-            'scanned_pages': result.get('scanned_pages', []),
-            'chapters': [
-                {
-                    'title': ch.get('title', ''),
-                    'tokens': ch.get('tokens', 0),
-                    'content_preview': _strip_page_markers(ch.get('content', ''))[:6000],
-                    'pages': ch.get('pages', [])
-                }
-                for ch in result.get('chapters', [])
-            ],
-            'toc': result.get('toc', []),
-            # Presupuestos de tokens, para que la UI oriente la selección de capítulos
-            'token_budget': {
-                'total_budget': settings.CONTENIDO_MAX_TOTAL_TOKENS,
-                'run_budget': settings.CONTENIDO_MAX_RUN_TOKENS,
-                'exceeds_total_budget': total_tokens > settings.CONTENIDO_MAX_TOTAL_TOKENS,
-            },
-        }
+    placed = {}
+    try:
+        # Leer los bytes del archivo UNA sola vez (el stream no es re-readable)
+        file_bytes = params['archivo'].read()
+        file_hash = compute_file_hash(file_bytes)
 
-        return JsonResponse(response_data)
+        placed = _place_uploaded_file(request, params['nombre'], file_bytes, file_hash)
+        try:
+            result = extract_text_advanced(
+                placed['extract_path'],
+                remove_headers=params['remove_headers'],
+                remove_footers=params['remove_footers'],
+                file_hash=file_hash,
+            )
+        finally:
+            if placed['tmp_path']:
+                try:
+                    os.unlink(placed['tmp_path'])
+                except OSError:
+                    pass
+
+        contenido_id = _create_uploaded_contenido(request, placed, params, file_hash)
+        doc_id, prev_session = _set_doc_session(request, placed, params, file_hash)
+        _discard_previous_doc_session(prev_session, placed['session_file_path'])
+
+        return JsonResponse(_upload_response_data(result, doc_id, placed, params, contenido_id))
         
     except Exception as e:
-        # Limpiar en caso de error
-        if 'file_path' in locals() and os.path.exists(file_path):
-            try:
-                os.unlink(file_path)
-            except OSError:
-                pass
-        
+        _discard_failed_upload(placed)
         return JsonResponse({
             'success': False,
             'error': str(e)
         }, status=500)
 
 
+@login_required
+@require_http_methods(["POST"])
+def upload_and_process_document_stream(request):
+    """
+    Igual que upload_and_process_document, pero la respuesta es un stream
+    SSE (text/event-stream) con el avance de la extracción, para que el
+    dashboard vaya llenando la lista de capítulos mientras se procesa el
+    libro en vez de esperar callado hasta el final.
+
+    Es un POST (lleva el archivo), así que del lado del navegador se lee con
+    fetch + ReadableStream, no con EventSource.
+
+    Eventos (cada uno `data: {json}`):
+        {"type": "start", "filename", "contenido_id", "duplicate_message",
+         "metadata", "toc", "scanned_pages"}
+        {"type": "chapter", "index", "chapter": {...resumen...},
+         "pages_done", "total_pages"}
+        {"type": "done", ...mismo JSON que upload_and_process_document...}
+        {"type": "error", "message"}
+
+    La validación (archivo, tamaño, formato) responde JSON con error igual
+    que la vista normal, antes de abrir el stream. La sesión se actualiza
+    también antes: Django guarda la sesión al armar la respuesta, no al
+    terminar de mandar el cuerpo del stream. Por eso el archivo de la sesión
+    anterior se borra recién después del evento 'done', y si la extracción
+    falla el archivo nuevo no se borra (la sesión ya apunta a él): lo
+    descarta el próximo upload que salga bien.
+    """
+    import json as json_module
+    from .cleanup import compute_file_hash
+    from .ia_processor import iter_extract_text_advanced
+
+    params, error_response = _read_upload_request(request)
+    if error_response:
+        return error_response
+
+    try:
+        file_bytes = params['archivo'].read()
+        file_hash = compute_file_hash(file_bytes)
+        placed = _place_uploaded_file(request, params['nombre'], file_bytes, file_hash)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+    doc_id, prev_session = _set_doc_session(request, placed, params, file_hash)
+
+    def event_stream():
+        def sse(payload):
+            return f'data: {json_module.dumps(payload)}\n\n'
+
+        try:
+            total_pages = 0
+            chapter_idx = 0
+            result = None
+            for event in iter_extract_text_advanced(
+                placed['extract_path'],
+                remove_headers=params['remove_headers'],
+                remove_footers=params['remove_footers'],
+                file_hash=file_hash,
+            ):
+                if event['type'] == 'metadata':
+                    total_pages = event['metadata'].get('total_pages', 0)
+                    yield sse({
+                        'type': 'start',
+                        'filename': params['nombre'],
+                        'contenido_id': placed['contenido_id'],
+                        'duplicate_message': placed['duplicate_message'],
+                        'metadata': event['metadata'],
+                        'toc': event['toc'],
+                        'scanned_pages': event['scanned_pages'],
+                    })
+                elif event['type'] == 'chapter':
+                    yield sse({
+                        'type': 'chapter',
+                        'index': chapter_idx,
+                        'chapter': _chapter_summary(event['chapter']),
+                        'pages_done': event['pages_done'],
+                        'total_pages': total_pages,
+                    })
+                    chapter_idx += 1
+                elif event['type'] == 'result':
+                    result = event['result']
+
+            contenido_id = _create_uploaded_contenido(request, placed, params, file_hash)
+            done = _upload_response_data(result, doc_id, placed, params, contenido_id)
+            done['type'] = 'done'
+            # Antes del yield: si el cliente cierra la conexión apenas recibe
+            # "done", el generador no se reanuda y el archivo anterior
+            # quedaría huérfano.
+            _discard_previous_doc_session(prev_session, placed['session_file_path'])
+            yield sse(done)
+        except Exception as e:
+            # La sesión ya apunta al archivo nuevo: no se borra acá (ver
+            # _discard_previous_doc_session); solo el temporal, en el finally.
+            logger.exception("Error en upload_and_process_document_stream")
+            yield sse({'type': 'error', 'message': str(e)})
+        finally:
+            if placed['tmp_path']:
+                try:
+                    os.unlink(placed['tmp_path'])
+                except OSError:
+                    pass
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 @require_http_methods(["POST"])
 def split_text_chunks(request):
@@ -277,35 +470,68 @@ def split_text_chunks(request):
     
     POST params:
         - text: texto a dividir
+        - texts: (repetible) varios textos a dividir de una vez, ej. los
+          capítulos seleccionados — en vez de `text`
         - max_tokens: límite por chunk (default: 4000)
+        - overlap: tokens repetidos entre chunks consecutivos (default: 0)
     
     Returns:
-        JSON con chunks
+        JSON con chunks (con `texts`: una entrada por texto en 'documents')
     """
+    texts = [t for t in request.POST.getlist('texts') if t]
     text = request.POST.get('text', '')
-    max_tokens = int(request.POST.get('max_tokens', 4000))
-    
-    if not text:
+    try:
+        max_tokens = int(request.POST.get('max_tokens', 4000))
+        overlap = int(request.POST.get('overlap', 0))
+    except ValueError:
+        return JsonResponse({
+            'success': False,
+            'error': 'max_tokens y overlap deben ser números enteros'
+        }, status=400)
+    if max_tokens <= 0 or overlap < 0 or overlap >= max_tokens:
+        return JsonResponse({
+            'success': False,
+            'error': 'max_tokens debe ser mayor que 0 y overlap estar entre 0 y max_tokens - 1'
+        }, status=400)
+
+    if not text and not texts:
         return JsonResponse({
             'success': False,
             'error': 'No se proporcionó texto'
         }, status=400)
+
+    def describe(chunks):
+        return [
+            {
+                'chunk_number': i + 1,
+                'tokens': count_tokens(chunk),
+                'preview': chunk[:100] + '...' if len(chunk) > 100 else chunk
+            }
+            for i, chunk in enumerate(chunks)
+        ]
     
     try:
-        chunks = split_text_by_tokens(text, max_tokens=max_tokens)
+        if texts:
+            documents = split_texts_by_tokens(texts, max_tokens=max_tokens, overlap=overlap)
+            return JsonResponse({
+                'success': True,
+                'total_chunks': sum(len(chunks) for chunks in documents),
+                'max_tokens_per_chunk': max_tokens,
+                'overlap': overlap,
+                'documents': [
+                    {'total_chunks': len(chunks), 'chunks': describe(chunks)}
+                    for chunks in documents
+                ],
+            })
+
+        chunks = split_text_by_tokens(text, max_tokens=max_tokens, overlap=overlap)
         
         return JsonResponse({
             'success': True,
             'total_chunks': len(chunks),
             'max_tokens_per_chunk': max_tokens,
-            'chunks': [
-                {
-                    'chunk_number': i + 1,
-                    'tokens': count_tokens(chunk),
-                    'preview': chunk[:100] + '...' if len(chunk) > 100 else chunk
-                }
-                for i, chunk in enumerate(chunks)
-            ]
+            'overlap': overlap,
+            'chunks': describe(chunks)
         })
         
     except Exception as e:
@@ -324,7 +550,8 @@ def document_processor_dashboard(request):
     # Obtener backend configurado para este usuario (no la instancia global)
     from .ai_router import get_backend_for_user, get_global_demo_quota, ensure_fresh_demo_quota, SharedDemoBackend
     backend = get_backend_for_user(request.user)
-    ai_status = backend.get_status()
+    # Último estado conocido (provider_health.py): no se espera a la red.
+    ai_status = provider_health.get_status(backend)
 
     using_shared_fallback = isinstance(backend, SharedDemoBackend)
     if using_shared_fallback:
@@ -398,7 +625,9 @@ def process_contenido_by_id(request, contenido_id):
         return JsonResponse({'success': False, 'error': f'Formato no soportado: {ext}'}, status=400)
 
     try:
-        result = extract_text_advanced(file_path, remove_headers=True, remove_footers=True)
+        result = extract_text_advanced(
+            file_path, remove_headers=True, remove_footers=True, file_hash=contenido.file_hash,
+        )
 
         # Limpiar sesion previa
         prev_session = request.session.get('doc_processor', {})
@@ -416,6 +645,7 @@ def process_contenido_by_id(request, contenido_id):
             'filename': contenido.file.name.split('/')[-1],
             'remove_headers': True,
             'remove_footers': True,
+            'file_hash': contenido.file_hash,
         }
         request.session.modified = True
 
@@ -467,7 +697,11 @@ def check_local_ai_status(request):
         from .models import UserAIConfig
         config, _ = UserAIConfig.objects.get_or_create(user=request.user)
         backend = get_backend_for_user(request.user)
-        status = backend.get_status()
+        if request.GET.get('refresh') == '1':
+            # Botón "Actualizar estado": chequeo nuevo en segundo plano; la
+            # respuesta trae health.checking y el cliente vuelve a preguntar.
+            provider_health.refresh(backend)
+        status = provider_health.get_status(backend)
         # OJO: NO pisar status['backend'] con config.source. config.source es
         # la preferencia guardada por el usuario ('ollama_local', 'byok', etc.),
         # pero get_backend_for_user() puede resolver a un backend real distinto
@@ -584,6 +818,8 @@ def generate_questions_from_chapters(request):
         - chapters: lista de capítulos con título (fallback si no hay sesión)
         - filename: nombre del archivo fuente
         - doc_id: ID de documento (opcional, para validación)
+        - bypass_cache: True para no reusar respuestas guardadas de la IA
+          (generation_cache.py) y pedir todo de nuevo (opcional)
 
     Returns:
         JSON con preguntas generadas
@@ -606,7 +842,7 @@ def generate_questions_from_chapters(request):
         # Verificar servidor IA
         from .ai_router import get_backend_for_user
         _ai_backend = get_backend_for_user(request.user)
-        _status = _ai_backend.get_status()
+        _status = provider_health.get_status(_ai_backend)
         if not _status.get('connected'):
             backend_type = _status.get('backend', 'ollama_local')
             if backend_type == 'ollama_local':
@@ -658,6 +894,7 @@ def generate_questions_from_chapters(request):
                 existing_questions_list=existing_questions_list,
                 existing_texts_set=existing_texts_set,
                 include_images=bool(data.get('include_images')),
+                bypass_cache=bool(data.get('bypass_cache')),
             )
             return JsonResponse({
                 'success': True,
@@ -679,7 +916,8 @@ def generate_questions_from_chapters(request):
                 full_result = extract_text_advanced(
                     session_file,
                     remove_headers=doc_session.get('remove_headers', True),
-                    remove_footers=doc_session.get('remove_footers', True)
+                    remove_footers=doc_session.get('remove_footers', True),
+                    file_hash=doc_session.get('file_hash'),
                 )
                 all_session_chapters = full_result.get('chapters', [])
 
@@ -733,13 +971,12 @@ def generate_questions_from_chapters(request):
         # no contra los chunks de cada capítulo por separado (eso hacía que pedir
         # 20 preguntas con 3 capítulos terminara generando ~20 por capítulo, unas
         # 60 en total).
-        chapter_chunks = [
-            (chapter, _split_into_chunks(
-                chapter.get('content', chapter.get('content_preview', '')), max_tokens=_content_chunk_tokens
-            ))
-            for chapter in chapters_to_process
-        ]
+        chapter_chunks = list(zip(chapters_to_process, _split_chapters_into_chunks(
+            [chapter.get('content', chapter.get('content_preview', '')) for chapter in chapters_to_process],
+            max_tokens=_content_chunk_tokens,
+        )))
         total_chunks_all = sum(len(chunks) for _, chunks in chapter_chunks)
+        existing_index = ExistingQuestionIndex(existing_questions_list) if existing_questions_list else None
 
         for chapter, chunks in chapter_chunks:
             title = chapter.get('title', 'Capítulo')
@@ -776,8 +1013,9 @@ def generate_questions_from_chapters(request):
                     chunk_questions = _generate_questions_for_chunk(
                         chunk['text'], title, questions_per_chunk, chunk_idx, len(chunks),
                         question_types=question_types, backend=_ai_backend,
-                        existing_questions=existing_questions_list,
+                        existing_index=existing_index,
                         output_tokens_ceiling=_output_tokens_ceiling,
+                        bypass_cache=bool(data.get('bypass_cache')),
                     )
                 except Exception as exc:
                     logger.warning(f"Chunk {chunk_idx + 1}/{len(chunks)} de '{title}' falló: {exc}")
@@ -804,7 +1042,10 @@ def generate_questions_from_chapters(request):
                 break
 
         # Deduplicar contra preguntas ya en BD y entre sí
-        all_questions = _deduplicate_questions(all_questions, extra_seen=existing_texts_set)
+        near_index = NearDuplicateIndex.for_user(request.user)
+        all_questions = _deduplicate_questions(all_questions, extra_seen=existing_texts_set, near_index=near_index)
+        if near_index is not None and near_index.rejected:
+            logger.info(f"Dedup por similitud: {near_index.rejected} pregunta(s) casi duplicada(s) descartada(s).")
 
         if not all_questions:
             backend_status = _ai_backend.get_status() if _ai_backend else {}
@@ -824,12 +1065,16 @@ def generate_questions_from_chapters(request):
             }, status=422)
 
         logger.info(f"Total preguntas generadas (dedup): {len(all_questions)}")
+        index_report = _log_existing_index_report(existing_index, f'Contenido {contenido_id}')
 
         return JsonResponse({
             'success': True,
             'questions': all_questions,
             'count': len(all_questions),
             'existing_count': len(existing_questions_list),
+            # Tokens de prompt que se ahorró el bloque "no repetir" contra
+            # mandar siempre las primeras 40 (ver question_index.py).
+            'existing_prompt_tokens_saved': index_report['saved_tokens'] if index_report else 0,
             'failed_chunks': failed_chunks,
         })
 
@@ -844,30 +1089,23 @@ def generate_questions_from_chapters(request):
 def _store_streaming_job(request, chapter_indices, chapters_from_request, filename,
                          question_types=None, total_questions=20, questions_per_block=0,
                          existing_questions_list=None, existing_texts_set=None,
-                         include_images=False):
-    """Guarda los parámetros del job en memoria y retorna el job_id."""
-    job_id = str(uuid.uuid4())
-    with _jobs_lock:
-        # Limpiar jobs viejos (> 10 min) para no acumular basura
-        now = time.time()
-        stale = [jid for jid, j in _jobs.items() if now - j.get('created_at', 0) > 600]
-        for jid in stale:
-            _jobs.pop(jid, None)
-
-        _jobs[job_id] = {
-            'chapter_indices': chapter_indices,
-            'chapters_from_request': chapters_from_request,
-            'filename': filename,
-            'question_types': question_types or [],
-            'total_questions': total_questions,
-            'questions_per_block': questions_per_block,  # 0 = calcular automáticamente
-            'doc_session': dict(request.session.get('doc_processor', {})),
-            'user_id': request.user.id,
-            'created_at': now,
-            'existing_questions_list': existing_questions_list or [],
-            'existing_texts_set': existing_texts_set or set(),
-            'include_images': include_images,
-        }
+                         include_images=False, bypass_cache=False):
+    """Encola el GenerationJob con los parámetros (lo genera el worker, ver
+    generation_worker.py) y retorna el job_id."""
+    job_id = generation_jobs.create(request.user, {
+        'chapter_indices': chapter_indices,
+        'chapters_from_request': chapters_from_request,
+        'filename': filename,
+        'question_types': question_types or [],
+        'total_questions': total_questions,
+        'questions_per_block': questions_per_block,  # 0 = calcular automáticamente
+        'doc_session': dict(request.session.get('doc_processor', {})),
+        'existing_questions_list': existing_questions_list or [],
+        'existing_texts_set': sorted(existing_texts_set or []),
+        'include_images': include_images,
+        'bypass_cache': bypass_cache,
+    })
+    generation_worker.ensure_started()
     return job_id
 
 
@@ -912,7 +1150,7 @@ def _chunking_budget(backend):
     """Cuánto contenido mandar por fragmento y cuántos tokens de salida pedir,
     respetando el TPM real del proveedor cuando se conoce (fallback
     compartido de demo, vía el último cupo capturado de sus headers reales —
-    ver GlobalFallbackBackend._save_quota_snapshot). Con proveedores propios
+    ver demo_quota.py: de memoria, sin ir a la base). Con proveedores propios
     (BYOK) no se conoce ese límite de antemano, así que se usan los defaults
     de siempre.
 
@@ -936,7 +1174,7 @@ def _chunking_budget(backend):
     return content_budget, output_budget
 
 
-def _split_into_chunks(content, max_tokens=3000):
+def _split_into_chunks(content, max_tokens=3000, token_starts=None):
     """Divide el contenido en fragmentos de ≤ max_tokens tokens.
 
     Devuelve una lista de dicts {'text': ..., 'pages': [...]} — 'text' es el
@@ -948,59 +1186,184 @@ def _split_into_chunks(content, max_tokens=3000):
     marcadores (DOCX/PPTX/TXT, que no tienen ese concepto de página física),
     'pages' queda vacía — quien llama debe caer de vuelta a las páginas del
     capítulo entero en ese caso.
+
+    token_starts: offsets ya calculados de `content` (ver
+    _split_chapters_into_chunks), para no volver a codificarlo.
     """
-    raw_chunks = _split_into_chunks_raw(content, max_tokens=max_tokens)
+    raw_chunks = _split_into_chunks_raw(content, max_tokens=max_tokens, token_starts=token_starts)
+
+    # Los marcadores se ubican una sola vez en todo el contenido; las
+    # páginas de cada fragmento son las de los marcadores que caen dentro de
+    # su tramo [start, end) del contenido original (un marcador nunca queda
+    # partido: no tiene saltos de línea).
+    markers = [(m.start(), int(m.group(1))) for m in _PAGE_MARKER_RE.finditer(content)]
+    marker_positions = [pos for pos, _page in markers]
+
     result = []
-    for raw in raw_chunks:
-        pages = sorted({int(p) for p in _PAGE_MARKER_RE.findall(raw)})
+    for raw, start, end in raw_chunks:
+        first = bisect.bisect_left(marker_positions, start)
+        last = bisect.bisect_left(marker_positions, end)
+        pages = sorted({page for _pos, page in markers[first:last]})
         result.append({'text': _PAGE_MARKER_RE.sub('', raw).strip(), 'pages': pages})
     return result
 
 
-def _split_into_chunks_raw(content, max_tokens=3000):
+def _split_chapters_into_chunks(contents, max_tokens=3000):
+    """_split_into_chunks de cada capítulo seleccionado, con todos
+    codificados de una vez (encode_batch, que tiktoken reparte entre
+    threads) en vez de uno por uno. Una lista de fragmentos por capítulo."""
+    return [
+        _split_into_chunks(content, max_tokens=max_tokens, token_starts=starts)
+        for content, starts in zip(contents, token_byte_offsets_many(contents))
+    ]
+
+
+def _is_word_char(ch):
+    # Letras y números (\p{L} / \p{N} del pre-tokenizador de tiktoken).
+    return unicodedata.category(ch)[0] in 'LN'
+
+
+class _TokenSpanCounter:
+    """Cuenta los tokens de tramos [start, end) de `text` — párrafos o
+    líneas enteras, que es lo que pide _split_into_chunks_raw — con el
+    texto codificado UNA sola vez (ver ia_processor.token_byte_offsets),
+    con búsqueda binaria sobre los offsets acumulados de cada token en vez
+    de volver a pasar cada tramo por tiktoken.
+
+    El resultado es exactamente count_tokens(text[start:end]). Lo delicado
+    son los bordes: tiktoken a veces junta el final de un párrafo con el
+    salto de línea que sigue (".\n\n", "!?\n", espacios + "\n") y ahí el
+    tramo aislado se tokeniza distinto. Por eso solo se toma del texto
+    completo la parte del medio, entre el final de la primera y de la
+    última tira de letras/números del tramo — el pre-tokenizador de
+    tiktoken siempre corta ahí, aislado o no —, y los dos pedacitos de los
+    bordes (signos, espacios) se codifican sueltos.
+    """
+
+    def __init__(self, text, token_starts=None):
+        self.text = text
+        self.token_starts = token_byte_offsets(text) if token_starts is None else token_starts
+        self.total = len(self.token_starts)
+        # Los pedacitos de borde se repiten muchísimo (".", ":", "", la
+        # primera palabra de cada línea...): se codifica cada uno una vez.
+        self._fragment_tokens = {'': 0}
+        # Offset en bytes de cada inicio/fin de línea: los bordes de todos
+        # los tramos que se cuentan caen ahí.
+        self._byte_at = {}
+        char_pos = byte_pos = 0
+        for line in text.split('\n'):
+            self._byte_at[char_pos] = byte_pos
+            char_pos += len(line)
+            byte_pos += len(line.encode('utf-8'))
+            self._byte_at[char_pos] = byte_pos
+            char_pos += 1
+            byte_pos += 1
+
+    def _byte_offset(self, char_pos):
+        byte_pos = self._byte_at.get(char_pos)
+        if byte_pos is None:
+            byte_pos = len(self.text[:char_pos].encode('utf-8'))
+        return byte_pos
+
+    def _count_fragment(self, fragment):
+        tokens = self._fragment_tokens.get(fragment)
+        if tokens is None:
+            tokens = self._fragment_tokens[fragment] = count_tokens(fragment)
+        return tokens
+
+    def count(self, start, end):
+        if start >= end:
+            return 0
+        text = self.text
+
+        # Fin de la primera tira de letras/números del tramo.
+        head_end = start
+        while head_end < end and not _is_word_char(text[head_end]):
+            head_end += 1
+        if head_end == end:
+            # Solo signos/espacios: corto, se codifica entero.
+            return count_tokens(text[start:end])
+        word_class = unicodedata.category(text[head_end])[0]
+        while head_end < end and unicodedata.category(text[head_end])[0] == word_class:
+            head_end += 1
+
+        # Fin de la última tira de letras/números del tramo.
+        tail_start = end
+        while not _is_word_char(text[tail_start - 1]):
+            tail_start -= 1
+
+        head_bytes = self._byte_offset(start) + len(text[start:head_end].encode('utf-8'))
+        tail_bytes = self._byte_offset(end) - len(text[tail_start:end].encode('utf-8'))
+        middle = (bisect.bisect_left(self.token_starts, tail_bytes)
+                  - bisect.bisect_left(self.token_starts, head_bytes))
+        return self._count_fragment(text[start:head_end]) + middle + self._count_fragment(text[tail_start:end])
+
+
+def _split_into_chunks_raw(content, max_tokens=3000, token_starts=None):
     """Algoritmo de fragmentado en sí (por párrafos, y por líneas si un
     párrafo solo ya supera max_tokens) — ver _split_into_chunks (el que hay
-    que usar desde afuera) para la envoltura consciente de páginas."""
-    total_tokens = count_tokens(content)
-    if total_tokens <= max_tokens:
-        return [content]
+    que usar desde afuera) para la envoltura consciente de páginas.
+
+    Devuelve [(texto, start, end)]: el texto del fragmento (con marcadores)
+    y el tramo del contenido original que abarca. El contenido se codifica
+    una sola vez (_TokenSpanCounter) en vez de una por párrafo y por línea.
+
+    Se conserva tal cual el armado anterior, incluido un detalle: las
+    últimas líneas de un párrafo partido por líneas quedan como partes
+    sueltas y se unen con '\n\n' (no '\n') con lo que siga — así los
+    fragmentos son idénticos a los de antes.
+    """
+    counter = _TokenSpanCounter(content, token_starts)
+    if counter.total <= max_tokens:
+        return [(content, 0, len(content))]
 
-    # Dividir por párrafos y agrupar hasta el límite
-    paragraphs = content.split('\n\n')
     chunks = []
-    current_parts = []
+    current_parts = []  # tramos (start, end) de content
     current_tokens = 0
 
-    for para in paragraphs:
-        para_tokens = count_tokens(para)
+    def flush(separator):
+        chunks.append((
+            separator.join(content[start:end] for start, end in current_parts),
+            current_parts[0][0],
+            current_parts[-1][1],
+        ))
+
+    # Dividir por párrafos y agrupar hasta el límite
+    para_start = 0
+    for para in content.split('\n\n'):
+        para_end = para_start + len(para)
+        para_tokens = counter.count(para_start, para_end)
         # Si un párrafo solo ya supera el límite, cortarlo por líneas
         if para_tokens > max_tokens:
             if current_parts:
-                chunks.append('\n\n'.join(current_parts))
+                flush('\n\n')
                 current_parts = []
                 current_tokens = 0
-            lines = para.split('\n')
-            for line in lines:
-                line_tokens = count_tokens(line)
+            line_start = para_start
+            for line in para.split('\n'):
+                line_end = line_start + len(line)
+                line_tokens = counter.count(line_start, line_end)
                 if current_tokens + line_tokens > max_tokens and current_parts:
-                    chunks.append('\n'.join(current_parts))
-                    current_parts = [line]
+                    flush('\n')
+                    current_parts = [(line_start, line_end)]
                     current_tokens = line_tokens
                 else:
-                    current_parts.append(line)
+                    current_parts.append((line_start, line_end))
                     current_tokens += line_tokens
+                line_start = line_end + 1
         elif current_tokens + para_tokens > max_tokens and current_parts:
-            chunks.append('\n\n'.join(current_parts))
-            current_parts = [para]
+            flush('\n\n')
+            current_parts = [(para_start, para_end)]
             current_tokens = para_tokens
         else:
-            current_parts.append(para)
+            current_parts.append((para_start, para_end))
             current_tokens += para_tokens
+        para_start = para_end + 2
 
     if current_parts:
-        chunks.append('\n\n'.join(current_parts))
+        flush('\n\n')
 
-    return chunks if chunks else [content]
+    return chunks if chunks else [(content, 0, len(content))]
 
 
 def _build_generation_prompt(context):
@@ -1030,7 +1393,7 @@ def _build_generation_prompt(context):
         return DEFAULT_PROMPT_TEMPLATE.format(**context), DEFAULT_TEMPERATURE
 
 
-def _generate_questions_for_chunk(content, chapter_title, num_questions, chunk_idx, total_chunks, question_types=None, backend=None, existing_questions=None, images=None, output_tokens_ceiling=None, generate_kwargs=None):
+def _generate_questions_for_chunk(content, chapter_title, num_questions, chunk_idx, total_chunks, question_types=None, backend=None, existing_questions=None, images=None, output_tokens_ceiling=None, generate_kwargs=None, rate_limiter=None, bypass_cache=False, generation_info=None, on_question=None, allow_followup=True, existing_index=None):
     """Genera preguntas para un fragmento de capítulo usando la IA configurada.
 
     Args:
@@ -1040,7 +1403,12 @@ def _generate_questions_for_chunk(content, chapter_title, num_questions, chunk_i
         chunk_idx: Índice del fragmento actual (0-based).
         total_chunks: Total de fragmentos del capítulo.
         question_types: Lista de tipos habilitados.
-        existing_questions: lista de dicts {pregunta, respuesta, tipo} ya guardadas en BD.
+        existing_questions: lista de dicts {pregunta, respuesta, tipo} que van
+            siempre al bloque "no repetir" (las primeras 40). Con existing_index,
+            solo las de esta misma corrida (rescatadas, las del texto del fragmento).
+        existing_index: question_index.ExistingQuestionIndex opcional con las
+            preguntas ya guardadas en BD, armado una vez por corrida: al bloque
+            "no repetir" se suman solo las más parecidas a `content`.
         images: lista opcional de data-URIs (ver ia_processor.extract_page_images) para
             mandar junto con el texto a un modelo con visión. Si el modelo configurado
             no soporta imágenes, la llamada falla y este chunk se reporta como error
@@ -1052,6 +1420,22 @@ def _generate_questions_for_chunk(content, chapter_title, num_questions, chunk_i
             ej. reasoning_effort para modelos de razonamiento (gpt-oss, qwen3.x
             en Groq). Los backends que no reconocen el kwarg lo ignoran (todos
             aceptan **kwargs), así que es seguro pasarlo sin importar el backend.
+        rate_limiter: generation_engine.RateLimiter opcional — si viene, la
+            llamada espera cupo de RPM/TPM antes de salir y le devuelve al
+            limitador el cupo informado por el proveedor en la respuesta.
+        bypass_cache: ignorar la caché de respuestas (generation_cache.py) para
+            esta llamada — ni se lee ni se guarda.
+        generation_info: dict opcional que se completa con datos de la llamada
+            para quien llama: 'cached' (True si la respuesta salió de la caché).
+        on_question: callback opcional — si viene, la respuesta se pide en
+            streaming a los backends que lo soportan y se llama
+            on_question(pregunta) con cada pregunta apenas se completa en el
+            texto (question_stream.py), antes de que termine la llamada. Lo
+            que se devuelve al final sigue siendo la lista completa.
+        allow_followup: si la respuesta vino cortada por max_tokens, se
+            rescatan las preguntas completas y se pide el resto en una segunda
+            llamada más corta (una sola vez: la segunda llega con esto en False).
+            generation_info['recovered'] queda con cuántas se rescataron.
     """
     import json as json_module
 
@@ -1082,9 +1466,11 @@ def _generate_questions_for_chunk(content, chapter_title, num_questions, chunk_i
 
     # Bloque de preguntas ya existentes para evitar repeticiones
     existing_block = ""
-    if existing_questions:
-        # Limitar a 40 para no inflar el prompt innecesariamente
-        sample = existing_questions[:40]
+    # Limitar a 40 para no inflar el prompt innecesariamente
+    sample = list(existing_questions or [])[:40]
+    if existing_index is not None:
+        sample += existing_index.select(content)
+    if sample:
         lines = [f'  {i+1}. [{q["tipo"]}] {q["pregunta"]}' for i, q in enumerate(sample)]
         existing_block = (
             f"\n\nPREGUNTAS YA GENERADAS PARA ESTE DOCUMENTO (NO REPETIR NI PARAFRASEAR):\n"
@@ -1155,10 +1541,45 @@ def _generate_questions_for_chunk(content, chapter_title, num_questions, chunk_i
     extra_kwargs['json_mode'] = True
     if generate_kwargs:
         extra_kwargs.update(generate_kwargs)
-    if backend is not None:
-        result = backend.generate(prompt=prompt, temperature=temperature, max_tokens=gen_max_tokens, **extra_kwargs)
-    else:
-        result = local_ai.generate(prompt=prompt, temperature=temperature, max_tokens=gen_max_tokens)
+    cache_key = None
+    result = None
+    from_cache = False
+    if not bypass_cache and generation_cache.is_enabled():
+        cache_key = generation_cache.make_key(
+            prompt, generation_cache.backend_fingerprint(backend if backend is not None else local_ai),
+            temperature, gen_max_tokens, extra_kwargs if backend is not None else None,
+        )
+        cached = generation_cache.get(cache_key)
+        if cached is not None:
+            result = dict(cached, success=True)
+            from_cache = True
+            logger.info(f"Chunk {chunk_idx + 1}/{total_chunks} de '{chapter_title}': respuesta tomada de la caché de generación.")
+    if generation_info is not None:
+        generation_info['cached'] = from_cache
+
+    if result is None:
+        if rate_limiter is not None:
+            waited = rate_limiter.acquire(count_tokens(prompt) + gen_max_tokens)
+            if waited:
+                logger.info(f"Chunk {chunk_idx + 1}/{total_chunks} esperó {waited:.1f}s por cupo del proveedor (RPM/TPM).")
+        stream_kwargs = {}
+        if on_question is not None:
+            # Los backends sin streaming (Gemini nativo, Anthropic) ignoran
+            # on_delta vía **kwargs y la pregunta llega recién con el total.
+            parser = QuestionStreamParser()
+
+            def on_delta(piece):
+                for question in parser.feed(piece):
+                    if question.get('tipo', 'opcion_multiple') in question_types:
+                        on_question(question)
+
+            stream_kwargs['on_delta'] = on_delta
+        if backend is not None:
+            result = backend.generate(prompt=prompt, temperature=temperature, max_tokens=gen_max_tokens, **extra_kwargs, **stream_kwargs)
+        else:
+            result = local_ai.generate(prompt=prompt, temperature=temperature, max_tokens=gen_max_tokens, **stream_kwargs)
+        if rate_limiter is not None:
+            rate_limiter.observe(result.get('rate_limit'))
 
     if not result['success']:
         error_msg = result.get('error', 'Error desconocido del proveedor de IA')
@@ -1185,15 +1606,58 @@ def _generate_questions_for_chunk(content, chapter_title, num_questions, chunk_i
             ai_response = ai_response[start:end + 1]
         questions_data = json_module.loads(ai_response)
         questions = questions_data.get('preguntas', [])
+        # Solo se guarda lo que se pudo parsear: una respuesta rota o cortada
+        # por tokens no se repite en el próximo intento.
+        if cache_key and not from_cache and not result.get('truncated'):
+            generation_cache.put(cache_key, result)
         # Filtrar solo los tipos habilitados (la IA puede equivocarse)
         questions = [q for q in questions if q.get('tipo', 'opcion_multiple') in question_types]
         return questions
     except Exception as e:
         logger.warning(f"No se pudo parsear JSON del chunk {chunk_idx + 1}: {e}")
-        truncation_note = ' (truncado por límite de tokens)' if result.get('truncated') else ''
-        raise RuntimeError(
-            f'La IA respondió, pero el contenido no tenía el formato esperado (fragmento {chunk_idx + 1} de {total_chunks} de "{chapter_title}"){truncation_note}.'
-        ) from e
+        # Antes una respuesta cortada por max_tokens se perdía entera por la
+        # última pregunta a medio escribir: se rescatan las que sí cerraron.
+        recovered = salvage_questions(result['text'])
+        if not recovered:
+            truncation_note = ' (truncado por límite de tokens)' if result.get('truncated') else ''
+            raise RuntimeError(
+                f'La IA respondió, pero el contenido no tenía el formato esperado (fragmento {chunk_idx + 1} de {total_chunks} de "{chapter_title}"){truncation_note}.'
+            ) from e
+
+    logger.warning(
+        f"Chunk {chunk_idx + 1}/{total_chunks} de '{chapter_title}': JSON incompleto, "
+        f"se rescataron {len(recovered)} de {num_questions} pregunta(s) completas."
+    )
+    if generation_info is not None:
+        generation_info['recovered'] = len(recovered)
+    questions = [q for q in recovered if q.get('tipo', 'opcion_multiple') in question_types]
+    missing = num_questions - len(recovered)
+    if not (result.get('truncated') and missing > 0 and allow_followup):
+        return questions
+
+    # Pedir solo lo que faltó, con las rescatadas al principio del bloque de
+    # "no repetir" (van siempre, antes de las elegidas del índice). Con menos preguntas
+    # pedidas, gen_max_tokens también baja y esta vez entra.
+    already = [
+        {'pregunta': q.get('pregunta', ''), 'tipo': q.get('tipo', 'opcion_multiple')}
+        for q in recovered
+    ]
+    try:
+        questions += _generate_questions_for_chunk(
+            content, chapter_title, missing, chunk_idx, total_chunks,
+            question_types=question_types, backend=backend,
+            existing_questions=already + list(existing_questions or []),
+            images=images, output_tokens_ceiling=output_tokens_ceiling,
+            generate_kwargs=generate_kwargs, rate_limiter=rate_limiter,
+            bypass_cache=bypass_cache, on_question=on_question,
+            allow_followup=False, existing_index=existing_index,
+        )
+    except Exception as followup_exc:
+        logger.warning(
+            f"Chunk {chunk_idx + 1}/{total_chunks}: falló la llamada por las {missing} pregunta(s) "
+            f"restantes ({followup_exc}); se sigue con las rescatadas."
+        )
+    return questions
 
 
 def _first_source_page(source_chapters):
@@ -1206,10 +1670,12 @@ def _first_source_page(source_chapters):
     return None
 
 
-def _deduplicate_questions(questions, extra_seen=None):
+def _deduplicate_questions(questions, extra_seen=None, near_index=None):
     """Elimina duplicados comparando los primeros 80 chars (case-insensitive).
 
     extra_seen: set adicional de claves (primeros 120 chars) ya vistas en BD.
+    near_index: near_duplicates.NearDuplicateIndex opcional — descarta además
+        las casi iguales (parafraseadas) a una del índice o a una ya aceptada.
     """
     seen = set(extra_seen) if extra_seen else set()
     unique = []
@@ -1217,11 +1683,34 @@ def _deduplicate_questions(questions, extra_seen=None):
         key80  = q.get('pregunta', '').lower().strip()[:80]
         key120 = q.get('pregunta', '').lower().strip()[:120]
         if key80 and key80 not in seen and key120 not in seen:
+            if _is_near_duplicate(near_index, q):
+                continue
             seen.add(key80)
             unique.append(q)
     return unique
 
 
+def _is_near_duplicate(near_index, question):
+    """True si `question` es casi igual a una del índice; si no lo es, queda
+    agregada al índice para las que vengan después."""
+    return near_index is not None and not near_index.add_if_new(question.get('pregunta', ''))
+
+
+def _log_existing_index_report(existing_index, label):
+    """Loguea cuántos tokens de prompt se ahorró la corrida en el bloque
+    "no repetir" y devuelve el reporte (None si no había preguntas previas)."""
+    if existing_index is None:
+        return None
+    report = existing_index.report()
+    if report['calls']:
+        logger.info(
+            f"{label}: bloque 'no repetir' con {report['selected']} pregunta(s) en {report['calls']} "
+            f"llamada(s), {report['tokens']} tokens de prompt (antes: {report['legacy_tokens']}; "
+            f"ahorro: {report['saved_tokens']})."
+        )
+    return report
+
+
 def _get_existing_questions_for_contenido(contenido_id, user):
     """
     Devuelve (texts_set, summary_list) con todas las preguntas ya guardadas
@@ -1250,225 +1739,430 @@ def _get_existing_questions_for_contenido(contenido_id, user):
     return texts_set, summary_list
 
 
-@login_required
-@require_http_methods(["GET"])
-def stream_questions(request, job_id):
+def _run_generation_job(job_row, token):
     """
-    SSE endpoint: transmite preguntas a medida que se generan por chunks.
-    El cliente abre un EventSource hacia esta URL tras recibir job_id del
-    endpoint POST /generate-questions/ con stream_mode=true.
+    Genera (o retoma) un GenerationJob ya reclamado con `token`, desde un
+    thread del worker (generation_worker.py) y no desde la request. No manda
+    nada al cliente: cada fragmento terminado, y cada pregunta adelantada del
+    que se está generando, queda guardado en la base, y stream_questions lo
+    lee de ahí. Sale sin terminar el job si perdió el reclamo (otro worker lo
+    retomó) o si nadie lo está mirando (generation_jobs.is_watched).
     """
-    import json as json_module
+    from material.models import GenerationJob
+    from .ai_router import get_backend_for_user
 
-    def event_stream(job, user_id, backend):
-        # Verificar usuario antes de procesar
-        if job.get('user_id') != user_id:
-            yield f'data: {json_module.dumps({"type": "error", "message": "No autorizado"})}\n\n'
-            return
-
-        chapter_indices = job['chapter_indices']
-        chapters_from_request = job['chapters_from_request']
-        filename = job['filename']
-        doc_session = job['doc_session']
-        question_types = job.get('question_types') or []
-        total_questions = max(1, int(job.get('total_questions', 20) or 20))
-        questions_per_block_override = int(job.get('questions_per_block', 0) or 0)
-        existing_questions_list = job.get('existing_questions_list') or []
-        existing_texts_set = set(job.get('existing_texts_set') or [])
-        include_images = bool(job.get('include_images'))
-        content_chunk_tokens, output_tokens_ceiling = _chunking_budget(backend)
-
-        # Obtener contenido completo (misma lógica que generate_questions_from_chapters)
-        chapters_to_process = []
-        session_file = doc_session.get('file_path')
-        if session_file and os.path.exists(session_file):
-            try:
-                full_result = extract_text_advanced(
-                    session_file,
-                    remove_headers=doc_session.get('remove_headers', True),
-                    remove_footers=doc_session.get('remove_footers', True)
-                )
-                all_session_chapters = full_result.get('chapters', [])
-                if chapter_indices:
-                    chapters_to_process = [
-                        all_session_chapters[i]
-                        for i in chapter_indices
-                        if i < len(all_session_chapters)
-                    ]
-                else:
-                    req_titles = {ch.get('title', '') for ch in chapters_from_request}
-                    chapters_to_process = [
-                        ch for ch in all_session_chapters
-                        if ch.get('title', '') in req_titles
-                    ]
-            except Exception as exc:
-                logger.warning(f"SSE: no se pudo re-procesar sesion: {exc}")
+    params = job_row.params
+    backend = get_backend_for_user(job_row.user)
+
+    def fail(message):
+        generation_jobs.finish(job_row.pk, token, GenerationJob.STATUS_ERROR, message)
+
+    chapter_indices = params.get('chapter_indices') or []
+    chapters_from_request = params.get('chapters_from_request') or []
+    filename = params.get('filename', '')
+    doc_session = params.get('doc_session') or {}
+    question_types = params.get('question_types') or []
+    total_questions = max(1, int(params.get('total_questions', 20) or 20))
+    questions_per_block_override = int(params.get('questions_per_block', 0) or 0)
+    existing_questions_list = params.get('existing_questions_list') or []
+    existing_texts_set = set(params.get('existing_texts_set') or [])
+    include_images = bool(params.get('include_images'))
+    bypass_cache = bool(params.get('bypass_cache'))
+    content_chunk_tokens, output_tokens_ceiling = _chunking_budget(backend)
+
+    # Obtener contenido completo (misma lógica que generate_questions_from_chapters)
+    chapters_to_process = []
+    session_file = doc_session.get('file_path')
+    if session_file and os.path.exists(session_file):
+        try:
+            full_result = extract_text_advanced(
+                session_file,
+                remove_headers=doc_session.get('remove_headers', True),
+                remove_footers=doc_session.get('remove_footers', True),
+                file_hash=doc_session.get('file_hash'),
+            )
+            all_session_chapters = full_result.get('chapters', [])
+            if chapter_indices:
+                chapters_to_process = [
+                    all_session_chapters[i]
+                    for i in chapter_indices
+                    if i < len(all_session_chapters)
+                ]
+            else:
+                req_titles = {ch.get('title', '') for ch in chapters_from_request}
+                chapters_to_process = [
+                    ch for ch in all_session_chapters
+                    if ch.get('title', '') in req_titles
+                ]
+        except Exception as exc:
+            logger.warning(f"SSE: no se pudo re-procesar sesion: {exc}")
+
+    if not chapters_to_process:
+        chapters_to_process = chapters_from_request
+
+    if not chapters_to_process:
+        fail('No se pudo obtener el contenido de los capítulos')
+        return
+
+    # Imágenes del documento (opt-in): se extraen una sola vez para todo
+    # el documento y se reparten por capítulo según sus páginas. Solo se
+    # adjuntan al primer chunk de cada capítulo (no a todos) para no
+    # repetir la misma imagen en cada llamada — cada imagen mandada de
+    # nuevo suma costo/latencia en el proveedor de IA.
+    doc_images = []
+    if include_images and session_file and os.path.exists(session_file):
+        try:
+            doc_images = extract_page_images(session_file, max_images=12)
+        except Exception as exc:
+            logger.warning(f"No se pudieron extraer imágenes del documento: {exc}")
+
+    selected_tokens = _chapters_total_tokens(chapters_to_process)
+    run_budget = settings.CONTENIDO_MAX_RUN_TOKENS
+    if selected_tokens > run_budget:
+        budget_msg = (
+            f'Se seleccionaron {_fmt_es(selected_tokens)} tokens de contenido, y el máximo por '
+            f'tanda es {_fmt_es(run_budget)}. Elegir menos capítulos y generar el resto en otra tanda.'
+        )
+        fail(budget_msg)
+        return
 
-        if not chapters_to_process:
-            chapters_to_process = chapters_from_request
+    # Pre-calcular total de chunks para progress
+    chapter_splits = _split_chapters_into_chunks(
+        [chapter.get('content', chapter.get('content_preview', '')) for chapter in chapters_to_process],
+        max_tokens=content_chunk_tokens,
+    )
+    total_chunks_all = sum(len(chunks) for chunks in chapter_splits)
+
+    generation_jobs.set_total_chunks(job_row.pk, total_chunks_all)
+
+    seen_keys = set(existing_texts_set)  # inicializar con preguntas ya en BD
+    # Además del prefijo, se descartan las casi iguales (parafraseadas) a
+    # cualquier pregunta guardada del usuario o ya generada en esta corrida.
+    near_index = NearDuplicateIndex.for_user(job_row.user)
+    total_generated = 0
+    # Fragmentos que ya terminó un worker anterior (reiniciado a mitad de
+    # camino): cuentan para el dedup y para el tope, y no se vuelven a pedir.
+    stored_events = generation_jobs.chunk_events(job_row.pk)
+    for chunk_number, stored in stored_events:
+        for q in stored.get('questions') or []:
+            seen_keys.add(q.get('pregunta', '').lower().strip()[:80])
+            if near_index is not None:
+                near_index.add_text(q.get('pregunta', ''))
+            total_generated += 1
+    done_chunks = {chunk_number for chunk_number, _ in stored_events}
+    # Preguntas ya adelantadas (y mostradas) del fragmento que quedó a
+    # medias: se retoma desde ellas, así siguen en su evento 'questions'
+    # final, cuentan para el dedup y el tope, y el total guardado no baja.
+    streamed = {}
+    for chunk_number, stored in generation_jobs.partial_events(job_row.pk):
+        if chunk_number in done_chunks:
+            continue
+        streamed[chunk_number] = list(stored.get('questions') or [])
+        for q in streamed[chunk_number]:
+            seen_keys.add(q.get('pregunta', '').lower().strip()[:80])
+            if near_index is not None:
+                near_index.add_text(q.get('pregunta', ''))
+            total_generated += 1
+
+    # Plan completo de fragmentos, en el orden en que se emiten los
+    # eventos: se despachan en paralelo (ver generation_engine) pero los
+    # resultados se procesan de a uno y en este mismo orden.
+    chunk_jobs = []
+    chunk_idx_global = 0
+    for chapter, chunks in zip(chapters_to_process, chapter_splits):
+        pages = chapter.get('pages', [])
+        chapter_pages = set(pages)
+        chapter_images = [img for img in doc_images if img['page'] in chapter_pages][:3]
+        # Física → impresa (ver document_processor._detect_printed_page_number
+        # y el mismo comentario en generate_questions_from_chapters): si no
+        # se detectó número impreso para una página, se cita la física.
+        printed_map = dict(zip(pages, chapter.get('printed_pages', [])))
+        # Si el usuario pidió una cantidad fija por bloque, respetarla;
+        # si no, distribuir total_questions entre todos los chunks. El piso
+        # es 1 (no 2): con muchos chunks chicos, un piso de 2 podía duplicar
+        # ampliamente lo pedido (ej. 20 preguntas en un documento con 30
+        # chunks resultaba en 60, no 20).
+        if questions_per_block_override > 0:
+            questions_per_chunk = questions_per_block_override
+        else:
+            questions_per_chunk = max(1, min(12, total_questions // max(total_chunks_all, 1)))
 
-        if not chapters_to_process:
-            yield f'data: {json_module.dumps({"type": "error", "message": "No se pudo obtener el contenido de los capítulos"})}\n\n'
-            return
-
-        # Imágenes del documento (opt-in): se extraen una sola vez para todo
-        # el documento y se reparten por capítulo según sus páginas. Solo se
-        # adjuntan al primer chunk de cada capítulo (no a todos) para no
-        # repetir la misma imagen en cada llamada — cada imagen mandada de
-        # nuevo suma costo/latencia en el proveedor de IA.
-        doc_images = []
-        if include_images and session_file and os.path.exists(session_file):
-            try:
-                doc_images = extract_page_images(session_file, max_images=12)
-            except Exception as exc:
-                logger.warning(f"No se pudieron extraer imágenes del documento: {exc}")
+        for i, chunk in enumerate(chunks):
+            chunk_idx_global += 1
+            chunk_jobs.append({
+                'chunk': chunk,
+                'index': i,
+                'chapter_chunks': len(chunks),
+                'chunk_global': chunk_idx_global,
+                'title': chapter.get('title', 'Capítulo'),
+                'pages': pages,
+                'printed_map': printed_map,
+                'questions_per_chunk': questions_per_chunk,
+                'images': chapter_images if (chapter_images and i == 0) else [],
+                'has_text': _chunk_has_content(chunk['text']),
+            })
 
-        selected_tokens = _chapters_total_tokens(chapters_to_process)
-        run_budget = settings.CONTENIDO_MAX_RUN_TOKENS
-        if selected_tokens > run_budget:
-            budget_msg = (
-                f'Se seleccionaron {_fmt_es(selected_tokens)} tokens de contenido, y el máximo por '
-                f'tanda es {_fmt_es(run_budget)}. Elegir menos capítulos y generar el resto en otra tanda.'
+    # Reemplaza al time.sleep(2) fijo entre fragmentos: cada llamada espera
+    # lo justo según el RPM/TPM real del proveedor.
+    rate_limiter = RateLimiter.for_backend(backend)
+    # Bloque "no repetir" de cada fragmento: solo las preguntas de la base
+    # más parecidas a su texto (question_index.py), no siempre las mismas 40.
+    existing_index = ExistingQuestionIndex(existing_questions_list) if existing_questions_list else None
+
+    def generate_chunk(job, emit):
+        """Corre en un thread del pool: solo llamadas a la IA, nada de
+        estado compartido de la corrida (dedup, tope, eventos). Cada
+        pregunta que la IA termina de escribir se adelanta con emit();
+        devuelve (preguntas, True si todas las respuestas salieron de la
+        caché, preguntas rescatadas de respuestas cortadas)."""
+        if not job['has_text'] and not job['images']:
+            return None
+        text = job['chunk']['text']
+        text_info, image_info = {}, {}
+        # Fragmento sin texto propio (página escaneada) pero con imágenes
+        # asociadas: no tiene sentido una llamada de solo texto.
+        text_questions = []
+        if job['has_text']:
+            text_questions = _generate_questions_for_chunk(
+                text, job['title'], job['questions_per_chunk'], job['index'], job['chapter_chunks'],
+                question_types=question_types, backend=backend,
+                existing_index=existing_index,
+                output_tokens_ceiling=output_tokens_ceiling,
+                rate_limiter=rate_limiter,
+                bypass_cache=bypass_cache,
+                generation_info=text_info,
+                on_question=emit,
             )
-            yield f'data: {json_module.dumps({"type": "error", "message": budget_msg})}\n\n'
-            return
-
-        # Pre-calcular total de chunks para progress
-        chapter_splits = []
-        total_chunks_all = 0
-        for chapter in chapters_to_process:
-            content = chapter.get('content', chapter.get('content_preview', ''))
-            chunks = _split_into_chunks(content, max_tokens=content_chunk_tokens)
-            chapter_splits.append(chunks)
-            total_chunks_all += len(chunks)
-
-        yield f'data: {json_module.dumps({"type": "start", "total_chunks": total_chunks_all, "filename": filename, "existing_count": len(existing_questions_list)})}\n\n'
-
-        seen_keys = set(existing_texts_set)  # inicializar con preguntas ya en BD
-        total_generated = 0
-        chunk_idx_global = 0
-
-        target_reached = False
-        for chapter, chunks in zip(chapters_to_process, chapter_splits):
-            if target_reached:
-                break
-            title = chapter.get('title', 'Capítulo')
-            pages = chapter.get('pages', [])
-            chapter_pages = set(pages)
-            chapter_images = [img for img in doc_images if img['page'] in chapter_pages][:3]
-            # Física → impresa (ver document_processor._detect_printed_page_number
-            # y el mismo comentario en generate_questions_from_chapters): si no
-            # se detectó número impreso para una página, se cita la física.
-            printed_map = dict(zip(pages, chapter.get('printed_pages', [])))
-            # Si el usuario pidió una cantidad fija por bloque, respetarla;
-            # si no, distribuir total_questions entre todos los chunks. El piso
-            # es 1 (no 2): con muchos chunks chicos, un piso de 2 podía duplicar
-            # ampliamente lo pedido (ej. 20 preguntas en un documento con 30
-            # chunks resultaba en 60, no 20).
-            if questions_per_block_override > 0:
-                questions_per_chunk = questions_per_block_override
-            else:
-                questions_per_chunk = max(1, min(12, total_questions // max(total_chunks_all, 1)))
-
-            for i, chunk in enumerate(chunks):
-                chunk_idx_global += 1
-                chunk_images = chapter_images if (chapter_images and i == 0) else []
-                chunk_has_text = _chunk_has_content(chunk['text'])
-                if not chunk_has_text and not chunk_images:
-                    logger.warning(f"SSE chunk {chunk_idx_global} de '{title}' sin texto suficiente, se omite.")
-                    yield f'data: {json_module.dumps({"type": "chunk_error", "chunk": chunk_idx_global, "total_chunks": total_chunks_all, "chapter_title": title, "message": "Fragmento sin texto extraíble (posible página escaneada o solo con imágenes) — no se generaron preguntas."})}\n\n'
+        image_questions = []
+        if job['images']:
+            # Texto e imágenes van por separado a su proveedor
+            # correspondiente (ver DemoRoutingBackend en ai_router.py):
+            # Groq no tiene modelos con visión, así que mandar todo junto
+            # en una sola llamada forzaba también el texto a Gemini. Si
+            # esta segunda llamada falla, no se pierde lo ya generado del
+            # texto — se loguea y se sigue solo con eso.
+            try:
+                image_questions = _generate_questions_for_chunk(
+                    text, job['title'], job['questions_per_chunk'], job['index'], job['chapter_chunks'],
+                    question_types=question_types, backend=backend,
+                    existing_questions=text_questions,
+                    existing_index=existing_index,
+                    images=job['images'],
+                    output_tokens_ceiling=output_tokens_ceiling,
+                    rate_limiter=rate_limiter,
+                    bypass_cache=bypass_cache,
+                    generation_info=image_info,
+                    on_question=emit,
+                )
+            except Exception as img_exc:
+                logger.warning(f"SSE chunk {job['chunk_global']} (imágenes) de '{job['title']}' falló: {img_exc}")
+        infos = [info for info in (text_info, image_info) if info]
+        return (
+            text_questions + image_questions,
+            bool(infos) and all(info['cached'] for info in infos),
+            sum(info.get('recovered', 0) for info in infos),
+        )
+
+    def display_pages(job):
+        # Páginas del FRAGMENTO puntual del que salieron estas preguntas
+        # (no de todo el capítulo/tanda) — ver comentario análogo en
+        # generate_questions_from_chapters.
+        chunk_pages = job['chunk']['pages'] or job['pages']
+        printed_map = job['printed_map']
+        return sorted({printed_map.get(p) or p for p in chunk_pages}) if chunk_pages else []
+
+    pending_jobs = [] if total_generated >= total_questions else [
+        job for job in chunk_jobs if job['chunk_global'] not in done_chunks
+    ]
+    # `streamed`: preguntas ya adelantadas sueltas de cada fragmento; el
+    # evento 'questions' guardado al terminarlo las incluye a todas.
+
+    def complete_chunk(chunk_number, event):
+        """Guarda el evento del fragmento. False si hay que dejar de
+        generar (reclamo perdido, o nadie mirando)."""
+        if not generation_jobs.save_chunk(job_row.pk, token, chunk_number, event):
+            logger.warning(f"Job {job_row.pk}: otro worker tomó el job, se deja de generar acá.")
+            return False
+        if not generation_jobs.is_watched(job_row.pk):
+            # Pestaña cerrada: no seguir gastando cupo. Si vuelve a
+            # conectarse (Last-Event-ID), el worker lo retoma desde acá.
+            logger.info(f"Job {job_row.pk}: sin nadie conectado, se pausa.")
+            return False
+        return True
+
+    results = iter_in_order(pending_jobs, generate_chunk)
+    try:
+        for job, kind, value in results:
+            chunk_idx_global = job['chunk_global']
+            title = job['title']
+            if kind == 'partial':
+                # Pregunta adelantada mientras la IA sigue escribiendo el
+                # fragmento. Mismo dedup y mismo tope que el bloque
+                # completo: cuando llegue el evento 'questions' de este
+                # fragmento, la ya enviada se descarta por seen_keys.
+                q = value
+                key = q.get('pregunta', '').lower().strip()[:80]
+                if not key or key in seen_keys or total_generated >= total_questions:
                     continue
-                # Pequeño respiro entre requests: varios fragmentos seguidos sin
-                # pausa pueden superar el límite por minuto (TPM/RPM) de Groq.
-                if chunk_idx_global > 1:
-                    time.sleep(2)
-                try:
-                    # Fragmento sin texto propio (página escaneada) pero con
-                    # imágenes asociadas: no tiene sentido una llamada de solo
-                    # texto — el chunk_error de arriba ya la habría descartado
-                    # si tampoco tuviera imágenes.
-                    text_questions = []
-                    if chunk_has_text:
-                        text_questions = _generate_questions_for_chunk(
-                            chunk['text'], title, questions_per_chunk, i, len(chunks),
-                            question_types=question_types, backend=backend,
-                            existing_questions=existing_questions_list,
-                            output_tokens_ceiling=output_tokens_ceiling,
-                        )
-                    image_questions = []
-                    if chunk_images:
-                        # Texto e imágenes van por separado a su proveedor
-                        # correspondiente (ver DemoRoutingBackend en
-                        # ai_router.py): Groq no tiene modelos con visión, así
-                        # que mandar todo junto en una sola llamada forzaba
-                        # también el texto a Gemini. Si esta segunda llamada
-                        # falla, no se pierde lo ya generado del texto — se
-                        # loguea y se sigue solo con eso.
-                        try:
-                            image_questions = _generate_questions_for_chunk(
-                                chunk['text'], title, questions_per_chunk, i, len(chunks),
-                                question_types=question_types, backend=backend,
-                                existing_questions=existing_questions_list + text_questions,
-                                images=chunk_images,
-                                output_tokens_ceiling=output_tokens_ceiling,
-                            )
-                        except Exception as img_exc:
-                            logger.warning(f"SSE chunk {chunk_idx_global} (imágenes) de '{title}' falló: {img_exc}")
-                    raw_questions = text_questions + image_questions
-                    # Páginas del FRAGMENTO puntual del que salieron estas
-                    # preguntas (no de todo el capítulo/tanda) — ver comentario
-                    # análogo en generate_questions_from_chapters.
-                    chunk_pages = chunk['pages'] or pages
-                    display_pages = sorted({printed_map.get(p) or p for p in chunk_pages}) if chunk_pages else []
-                    new_qs = []
-                    for q in raw_questions:
-                        key = q.get('pregunta', '').lower().strip()[:80]
-                        if key and key not in seen_keys:
-                            seen_keys.add(key)
-                            q['source_chapters'] = [{'title': title, 'pages': display_pages}]
-                            q['source_file'] = filename
-                            new_qs.append(q)
-
-                    # Tope duro: "cantidad de preguntas" (total_questions) es un
-                    # techo absoluto, tanto si el modelo no respeta "generá
-                    # exactamente N preguntas" al pie de la letra, como si el
-                    # usuario configuró "preguntas por bloque" — ese campo solo
-                    # controla el tamaño de cada bloque que se muestra en pantalla
-                    # (útil en modo pausa), nunca debería poder superar el total
-                    # pedido. Antes, con un override de bloque > 0, el total se
-                    # ignoraba por completo.
-                    remaining = max(0, total_questions - total_generated)
-                    new_qs = new_qs[:remaining]
-
-                    total_generated += len(new_qs)
-                    event = {
-                        'type': 'questions',
-                        'questions': new_qs,
-                        'chunk': chunk_idx_global,
-                        'total_chunks': total_chunks_all,
-                        'chapter_title': title,
-                    }
-                    yield f'data: {json_module.dumps(event)}\n\n'
-
-                    # "cantidad de preguntas" es un objetivo total, no un piso:
-                    # paramos apenas lo alcanzamos en vez de seguir procesando el
-                    # resto del documento y generar de más.
-                    if total_generated >= total_questions:
-                        target_reached = True
-                        break
-
-                except GeneratorExit:
+                if _is_near_duplicate(near_index, q):
+                    continue
+                seen_keys.add(key)
+                q['source_chapters'] = [{'title': title, 'pages': display_pages(job)}]
+                q['source_file'] = filename
+                total_generated += 1
+                streamed.setdefault(chunk_idx_global, []).append(q)
+                if not generation_jobs.save_partial(job_row.pk, token, chunk_idx_global, {
+                    'type': 'partial', 'chunk': chunk_idx_global, 'total_chunks': total_chunks_all,
+                    'chapter_title': title, 'questions': streamed[chunk_idx_global],
+                }):
                     return
-                except Exception as exc:
-                    logger.warning(f"SSE chunk {chunk_idx_global} error: {exc}")
-                    yield f'data: {json_module.dumps({"type": "chunk_error", "chunk": chunk_idx_global, "total_chunks": total_chunks_all, "chapter_title": title, "message": str(exc)})}\n\n'
+                continue
+            chunk_result = value if kind == 'result' else None
+            message = None
+            if not job['has_text'] and not job['images']:
+                logger.warning(f"SSE chunk {chunk_idx_global} de '{title}' sin texto suficiente, se omite.")
+                message = "Fragmento sin texto extraíble (posible página escaneada o solo con imágenes) — no se generaron preguntas."
+            elif kind == 'error':
+                logger.warning(f"SSE chunk {chunk_idx_global} error: {value}")
+                message = str(value)
+            if message is not None:
+                # Las preguntas sueltas que alcanzaron a salir antes del
+                # error quedan guardadas con el fragmento.
+                if not complete_chunk(chunk_idx_global, {
+                    'type': 'chunk_error', 'chunk': chunk_idx_global, 'total_chunks': total_chunks_all,
+                    'chapter_title': title, 'message': message,
+                    'questions': streamed.get(chunk_idx_global, []),
+                }):
+                    return
+                continue
+
+            raw_questions, from_cache, recovered = chunk_result
+            chunk_display_pages = display_pages(job)
+            new_qs = []
+            for q in raw_questions:
+                key = q.get('pregunta', '').lower().strip()[:80]
+                if key and key not in seen_keys and not _is_near_duplicate(near_index, q):
+                    seen_keys.add(key)
+                    q['source_chapters'] = [{'title': title, 'pages': chunk_display_pages}]
+                    q['source_file'] = filename
+                    new_qs.append(q)
+
+            # Tope duro: "cantidad de preguntas" (total_questions) es un
+            # techo absoluto, tanto si el modelo no respeta "generá
+            # exactamente N preguntas" al pie de la letra, como si el
+            # usuario configuró "preguntas por bloque" — ese campo solo
+            # controla el tamaño de cada bloque que se muestra en pantalla
+            # (útil en modo pausa), nunca debería poder superar el total
+            # pedido. Antes, con un override de bloque > 0, el total se
+            # ignoraba por completo.
+            remaining = max(0, total_questions - total_generated)
+            new_qs = new_qs[:remaining]
+
+            total_generated += len(new_qs)
+            event = {
+                'type': 'questions',
+                'questions': streamed.get(chunk_idx_global, []) + new_qs,
+                'chunk': chunk_idx_global,
+                'total_chunks': total_chunks_all,
+                'chapter_title': title,
+                # Respuesta reusada de una generación anterior idéntica
+                # (generation_cache.py): no gastó cupo del proveedor.
+                'cached': from_cache,
+                # Preguntas rescatadas de una respuesta cortada por
+                # max_tokens (el resto se pidió aparte, ver allow_followup).
+                'recovered': recovered,
+            }
+            if not complete_chunk(chunk_idx_global, event):
+                return
+
+            # "cantidad de preguntas" es un objetivo total, no un piso:
+            # paramos apenas lo alcanzamos en vez de seguir procesando el
+            # resto del documento y generar de más (los fragmentos que
+            # todavía no salieron al proveedor se cancelan).
+            if total_generated >= total_questions:
+                break
+    finally:
+        # También al cortar antes (tope, reclamo perdido, nadie mirando).
+        results.close()
+        _log_existing_index_report(existing_index, f'Job {job_row.pk}')
+        if near_index is not None and near_index.rejected:
+            logger.info(f"Job {job_row.pk}: {near_index.rejected} pregunta(s) casi duplicada(s) descartada(s).")
+
+    generation_jobs.finish(job_row.pk, token, GenerationJob.STATUS_DONE)
 
-        yield f'data: {json_module.dumps({"type": "done", "total": total_generated})}\n\n'
 
-    with _jobs_lock:
-        job = _jobs.pop(job_id, None)
 
-    if not job:
+@login_required
+@require_http_methods(["GET"])
+def stream_questions(request, job_id):
+    """
+    SSE endpoint: transmite preguntas a medida que se generan por chunks.
+    El cliente abre un EventSource hacia esta URL tras recibir job_id del
+    endpoint POST /generate-questions/ con stream_mode=true.
+
+    La generación no corre acá sino en el worker (generation_worker.py), que
+    va guardando cada fragmento en la base (GenerationJob, ver
+    generation_jobs.py); esta vista solo lee lo guardado y lo reenvía, cada
+    fragmento terminado con `id: <n° de fragmento>`. Cada conexión dura como
+    mucho CONTENIDO_GENERATION_SSE_MAX_SECONDS: después se cierra y el
+    EventSource reconecta solo con Last-Event-ID, así un job largo no tiene
+    tomado un thread de gunicorn durante minutos (ni choca con --timeout).
+    """
+    import json as json_module
+    from material import fair_share
+    from material.models import GenerationJob
+
+    def sse(event, event_id=None):
+        prefix = f'id: {event_id}\n' if event_id is not None else ''
+        return f'{prefix}data: {json_module.dumps(event)}\n\n'
+
+    def event_stream(job_row, last_event_id):
+        state = {'after': last_event_id, 'start_sent': False, 'partial_sent': {}}
+        deadline = time.monotonic() + float(getattr(settings, 'CONTENIDO_GENERATION_SSE_MAX_SECONDS', 25))
+        followed = generation_jobs.tail(job_row.pk, state, deadline)
+        try:
+            while True:
+                kind, value = next(followed)
+                if kind == 'start':
+                    yield sse({
+                        'type': 'start', 'total_chunks': value.total_chunks,
+                        'filename': value.params.get('filename', ''),
+                        'existing_count': len(value.params.get('existing_questions_list') or []),
+                        # Reconexión: el cliente ya tiene lo anterior a Last-Event-ID.
+                        'resumed': bool(last_event_id),
+                        # Turnos del pool compartido (fair_share.py): cuántas
+                        # llamadas esperan y cuánto esperaría la próxima de
+                        # este usuario, para mostrar una demora estimada.
+                        'queue': fair_share.estimate(fair_share.owner_for_user(request.user)),
+                    })
+                elif kind == 'event':
+                    chunk_number, event = value
+                    yield sse(event, chunk_number)
+                elif kind == 'partial':
+                    # Preguntas adelantadas del fragmento en curso, sin id:
+                    # el fragmento todavía no terminó.
+                    event, new_questions = value
+                    for q in new_questions:
+                        yield sse({
+                            'type': 'question', 'question': q, 'chunk': event['chunk'],
+                            'total_chunks': event['total_chunks'], 'chapter_title': event['chapter_title'],
+                        })
+                else:
+                    yield ': keepalive\n\n'
+        except StopIteration as stop:
+            finished_job = stop.value
+
+        if finished_job is None:
+            # Se cumplió el tiempo de esta conexión: el cliente reconecta solo.
+            yield 'retry: 500\n' + sse({'type': 'reconnect'})
+        elif finished_job.status == GenerationJob.STATUS_ERROR:
+            yield sse({'type': 'error', 'message': finished_job.error or 'La generación terminó con error.'})
+        else:
+            yield sse({'type': 'done', 'total': finished_job.total_generated})
+
+    job_row = generation_jobs.get_for_user(job_id, request.user)
+
+    if not job_row:
         def _not_found():
             import json as j
             yield f'data: {j.dumps({"type": "error", "message": "Job no encontrado o expirado"})}\n\n'
@@ -1476,11 +2170,19 @@ def stream_questions(request, job_id):
         response['Cache-Control'] = 'no-cache'
         return response
 
-    from .ai_router import get_backend_for_user
-    _sse_backend = get_backend_for_user(request.user)
+    # Hay alguien mirando (un job sin conexiones se pausa, ver
+    # generation_jobs.is_watched) y un worker que lo tome.
+    generation_jobs.touch(job_row.pk)
+    generation_worker.ensure_started()
+
+    # Lo manda el navegador al reconectar: último fragmento que recibió.
+    try:
+        last_event_id = max(0, int(request.headers.get('Last-Event-ID') or 0))
+    except ValueError:
+        last_event_id = 0
 
     response = StreamingHttpResponse(
-        event_stream(job, request.user.id, _sse_backend),
+        event_stream(job_row, last_event_id),
         content_type='text/event-stream'
     )
     response['Cache-Control'] = 'no-cache'
@@ -1530,6 +2232,7 @@ def document_page_preview(request):
                     request.session.setdefault('doc_processor', {})
                     request.session['doc_processor']['file_path'] = file_path
                     request.session['doc_processor']['filename'] = filename
+                    request.session['doc_processor']['file_hash'] = contenido.file_hash
                     request.session.modified = True
             except (Contenido.DoesNotExist, ValueError, AttributeError, OSError):
                 pass
@@ -1538,141 +2241,64 @@ def document_page_preview(request):
             return JsonResponse({'success': False, 'error': 'No hay documento en sesión. Sube o selecciona uno primero.'}, status=400)
 
     ext = os.path.splitext(file_path)[1].lower()
+    if ext not in page_store.SUPPORTED_EXTENSIONS:
+        return JsonResponse({'success': False, 'error': f'Formato no soportado para preview: {ext}'}, status=400)
 
     try:
-        if ext == '.pdf':
-            doc = fitz.open(file_path)
-            total_pages = doc.page_count
-            doc.close()
-            # Usar endpoint interno para servir el archivo (funciona con DEBUG=False en Render)
-            file_url = '/doc-processor/serve-file/'
-            return JsonResponse({
-                'success': True,
-                'file_type': 'pdf',
-                'filename': filename,
-                'total_pages': total_pages,
-                'file_url': file_url,
-            })
-
-        elif ext == '.pptx':
-            from pptx import Presentation as _Prs
-            prs = _Prs(file_path)
-            slides = []
-            for i, slide in enumerate(prs.slides, 1):
-                texts = []
-                for shape in slide.shapes:
-                    if hasattr(shape, 'text') and shape.text.strip():
-                        texts.append(shape.text.strip())
-                slides.append({
-                    'slide_number': i,
-                    'text': '\n'.join(texts) or f'(Slide {i} sin texto)',
-                    'char_count': sum(len(t) for t in texts),
+        # Texto por página/slide/sección desde el almacén de páginas (armado
+        # al extraer el documento — ver material/page_store.py), sin volver
+        # a parsear el archivo original en cada apertura del visor.
+        file_hash = request.session.get('doc_processor', {}).get('file_hash')
+        with page_store.open_store(file_path, file_hash) as store:
+            if ext == '.pdf':
+                # Usar endpoint interno para servir el archivo (funciona con DEBUG=False en Render)
+                file_url = '/doc-processor/serve-file/'
+                return JsonResponse({
+                    'success': True,
+                    'file_type': 'pdf',
+                    'filename': filename,
+                    'total_pages': len(store),
+                    'file_url': file_url,
                 })
-            return JsonResponse({
-                'success': True,
-                'file_type': 'pptx',
-                'filename': filename,
-                'total_pages': len(slides),
-                'slides': slides,
-            })
 
-        elif ext == '.docx':
-            from docx import Document as _Doc
-            doc = _Doc(file_path)
-
-            # ── OPCIÓN D: páginas virtuales por cantidad de caracteres ──────────
-            # ROLLBACK: reemplazar este bloque con el bloque comentado de abajo
-            # para volver al modo de secciones por heading.
-            DOCX_PAGE_SIZE = 2800  # chars ≈ 1 página A4 en texto normal
-            sections = []
-            current_text = []
-            current_chars = 0
-            page_idx = 1
-            for para in doc.paragraphs:
-                text = para.text.strip()
-                if not text:
-                    continue
-                current_text.append(text)
-                current_chars += len(text) + 1
-                if current_chars >= DOCX_PAGE_SIZE:
-                    sections.append({
-                        'section_number': page_idx,
-                        'title': f'Página {page_idx}',
-                        'text': '\n'.join(current_text),
-                        'char_count': current_chars,
+            elif ext == '.pptx':
+                slides = []
+                for number, _title, char_count in store.units():
+                    slides.append({
+                        'slide_number': number,
+                        'text': store.text(number) or f'(Slide {number} sin texto)',
+                        'char_count': char_count,
                     })
-                    page_idx += 1
-                    current_text = []
-                    current_chars = 0
-            if current_text:
-                sections.append({
-                    'section_number': page_idx,
-                    'title': f'Página {page_idx}',
-                    'text': '\n'.join(current_text),
-                    'char_count': current_chars,
+                return JsonResponse({
+                    'success': True,
+                    'file_type': 'pptx',
+                    'filename': filename,
+                    'total_pages': len(slides),
+                    'slides': slides,
                 })
-            # ── FIN OPCIÓN D ─────────────────────────────────────────────────────
-
-            # [ROLLBACK DOCX SECTIONS — secciones por heading, descommentar para revertir]
-            # sections = []
-            # current_text = []
-            # current_chars = 0
-            # section_idx = 1
-            # heading_title = 'Inicio'
-            # for para in doc.paragraphs:
-            #     text = para.text.strip()
-            #     if not text:
-            #         continue
-            #     if para.style.name.startswith('Heading'):
-            #         if current_text:
-            #             sections.append({'section_number': section_idx, 'title': heading_title,
-            #                              'text': '\n'.join(current_text), 'char_count': current_chars})
-            #             section_idx += 1; current_text = []; current_chars = 0
-            #         heading_title = text
-            #     else:
-            #         current_text.append(text); current_chars += len(text)
-            #         if current_chars > 1200:
-            #             sections.append({'section_number': section_idx, 'title': heading_title,
-            #                              'text': '\n'.join(current_text), 'char_count': current_chars})
-            #             section_idx += 1; current_text = []; current_chars = 0
-            # if current_text:
-            #     sections.append({'section_number': section_idx, 'title': heading_title,
-            #                      'text': '\n'.join(current_text), 'char_count': current_chars})
-            # URL del archivo para docx-preview.js
-            file_url = '/doc-processor/serve-file/'
-            return JsonResponse({
-                'success': True,
-                'file_type': 'docx',
-                'filename': filename,
-                'total_pages': len(sections),
-                'file_url': file_url,
-                'sections': sections,
-            })
 
-        elif ext == '.txt':
-            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-                lines = f.readlines()
-            # Dividir en bloques de ~50 líneas
-            block_size = 50
-            sections = []
-            for i in range(0, len(lines), block_size):
-                block = ''.join(lines[i:i + block_size]).strip()
-                sections.append({
-                    'section_number': i // block_size + 1,
-                    'title': f'Líneas {i+1}–{min(i+block_size, len(lines))}',
-                    'text': block,
-                    'char_count': len(block),
-                })
-            return JsonResponse({
+            # DOCX (páginas virtuales de ~2800 caracteres) y TXT (bloques de
+            # 50 líneas) — el armado de las secciones está en page_store.
+            sections = [
+                {
+                    'section_number': number,
+                    'title': title,
+                    'text': store.text(number),
+                    'char_count': char_count,
+                }
+                for number, title, char_count in store.units()
+            ]
+            response = {
                 'success': True,
-                'file_type': 'txt',
+                'file_type': ext.lstrip('.'),
                 'filename': filename,
                 'total_pages': len(sections),
                 'sections': sections,
-            })
-
-        else:
-            return JsonResponse({'success': False, 'error': f'Formato no soportado para preview: {ext}'}, status=400)
+            }
+            if ext == '.docx':
+                # URL del archivo para docx-preview.js
+                response['file_url'] = '/doc-processor/serve-file/'
+            return JsonResponse(response)
 
     except Exception as e:
         logger.exception("Error en document_page_preview")
@@ -1722,6 +2348,7 @@ def get_pages_text(request):
                     request.session.setdefault('doc_processor', {})
                     request.session['doc_processor']['file_path'] = file_path
                     request.session['doc_processor']['filename'] = filename
+                    request.session['doc_processor']['file_hash'] = contenido.file_hash
                     request.session.modified = True
             except (Contenido.DoesNotExist, ValueError, AttributeError, OSError):
                 pass
@@ -1731,116 +2358,36 @@ def get_pages_text(request):
 
     ext = os.path.splitext(file_path)[1].lower()
 
+    # Qué unidades mandó el dashboard según el tipo de documento.
+    if ext == '.pdf':
+        selected_key, missing_error = 'pages', 'No se enviaron páginas.'
+    elif ext == '.pptx':
+        selected_key, missing_error = 'slides', 'No se enviaron slides.'
+    else:
+        selected_key, missing_error = 'sections', 'No se enviaron secciones.'
+
     try:
         chapters = []
 
-        if ext == '.pdf':
-            selected_pages = [int(p) for p in data.get('pages', [])]
-            if not selected_pages:
-                return JsonResponse({'success': False, 'error': 'No se enviaron páginas.'}, status=400)
-            doc = fitz.open(file_path)
-            for page_num in sorted(selected_pages):
-                if 1 <= page_num <= doc.page_count:
-                    page = doc[page_num - 1]
-                    text = page.get_text().strip()
-                    if text:
-                        chapters.append({
-                            'title': f'Página {page_num}',
-                            'content': text,
-                            'tokens': count_tokens(text),
-                            'pages': [page_num],
-                        })
-            doc.close()
-
-        elif ext == '.pptx':
-            from pptx import Presentation as _Prs
-            selected = set(int(s) for s in data.get('slides', []))
+        if ext in page_store.SUPPORTED_EXTENSIONS:
+            selected = sorted(set(int(p) for p in data.get(selected_key, [])))
             if not selected:
-                return JsonResponse({'success': False, 'error': 'No se enviaron slides.'}, status=400)
-            prs = _Prs(file_path)
-            for i, slide in enumerate(prs.slides, 1):
-                if i in selected:
-                    texts = []
-                    for shape in slide.shapes:
-                        if hasattr(shape, 'text') and shape.text.strip():
-                            texts.append(shape.text.strip())
-                    text = '\n'.join(texts)
+                return JsonResponse({'success': False, 'error': missing_error}, status=400)
+            # Cada unidad seleccionada es un corte del mmap del almacén de
+            # páginas (ver material/page_store.py): O(páginas elegidas), sin
+            # reabrir ni parsear el archivo original.
+            file_hash = request.session.get('doc_processor', {}).get('file_hash')
+            with page_store.open_store(file_path, file_hash) as store:
+                for number in selected:
+                    text = store.text(number)
                     if text:
                         chapters.append({
-                            'title': f'Slide {i}',
+                            'title': store.title(number),
                             'content': text,
                             'tokens': count_tokens(text),
-                            'pages': [i],
+                            'pages': [number],
                         })
 
-        elif ext in ('.docx', '.txt'):
-            selected = set(int(s) for s in data.get('sections', []))
-            if not selected:
-                return JsonResponse({'success': False, 'error': 'No se enviaron secciones.'}, status=400)
-            # Re-usar la misma lógica de document_page_preview para extraer secciones
-            if ext == '.docx':
-                from docx import Document as _Doc
-                doc = _Doc(file_path)
-
-                # ── OPCIÓN D: páginas virtuales (debe coincidir con document_page_preview) ──
-                # ROLLBACK: reemplazar con el bloque comentado al final de este if
-                DOCX_PAGE_SIZE = 2800
-                sections_all = []
-                current_text = []
-                current_chars = 0
-                page_idx = 1
-                for para in doc.paragraphs:
-                    text = para.text.strip()
-                    if not text:
-                        continue
-                    current_text.append(text)
-                    current_chars += len(text) + 1
-                    if current_chars >= DOCX_PAGE_SIZE:
-                        sections_all.append((page_idx, f'Página {page_idx}', '\n'.join(current_text)))
-                        page_idx += 1
-                        current_text = []
-                        current_chars = 0
-                if current_text:
-                    sections_all.append((page_idx, f'Página {page_idx}', '\n'.join(current_text)))
-                # ── FIN OPCIÓN D ────────────────────────────────────────────────────
-
-                # [ROLLBACK DOCX SECTIONS — descommentar para revertir]
-                # sections_all = []
-                # current_text = []; current_chars = 0; section_idx = 1; heading_title = 'Inicio'
-                # for para in doc.paragraphs:
-                #     text = para.text.strip()
-                #     if not text: continue
-                #     if para.style.name.startswith('Heading'):
-                #         if current_text:
-                #             sections_all.append((section_idx, heading_title, '\n'.join(current_text)))
-                #             section_idx += 1; current_text = []; current_chars = 0
-                #         heading_title = text
-                #     else:
-                #         current_text.append(text); current_chars += len(text)
-                #         if current_chars > 1200:
-                #             sections_all.append((section_idx, heading_title, '\n'.join(current_text)))
-                #             section_idx += 1; current_text = []; current_chars = 0
-                # if current_text:
-                #     sections_all.append((section_idx, heading_title, '\n'.join(current_text)))
-            else:
-                with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-                    lines = f.readlines()
-                block_size = 50
-                sections_all = []
-                for i in range(0, len(lines), block_size):
-                    block = ''.join(lines[i:i + block_size]).strip()
-                    idx = i // block_size + 1
-                    sections_all.append((idx, f'Líneas {i+1}–{min(i+block_size, len(lines))}', block))
-
-            for sec_num, title, text in sections_all:
-                if sec_num in selected and text:
-                    chapters.append({
-                        'title': title,
-                        'content': text,
-                        'tokens': count_tokens(text),
-                        'pages': [sec_num],
-                    })
-
         if not chapters:
             return JsonResponse({'success': False, 'error': 'No se pudo extraer texto de las unidades seleccionadas.'}, status=400)
 
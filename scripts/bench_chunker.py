@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del fragmentado por tokens de la generación de preguntas
+(views_document_processor._split_into_chunks).
+
+Compara la implementación actual (el capítulo se codifica una sola vez con
+tiktoken y los párrafos/líneas se cuentan por búsqueda binaria sobre los
+offsets de los tokens) contra la anterior (count_tokens del contenido
+entero, después uno por párrafo y otro por línea de cada párrafo que no
+entra), copiada abajo tal cual como referencia. Además de los tiempos,
+verifica que las dos devuelvan exactamente los mismos fragmentos.
+
+El capítulo de prueba es de ~45.000 tokens (CONTENIDO_MAX_RUN_TOKENS, el
+tope de una corrida): el texto de un PDF si se pasa uno, o si no el fixture
+del test de carga de Groq repetido, con marcadores de página como los que
+incrusta document_processor.py.
+
+Uso:
+    python scripts/bench_chunker.py [ruta/a/libro.pdf]
+
+Variables de entorno:
+    BENCH_CHAPTER_TOKENS   tamaño del capítulo de prueba (default: 45000)
+    BENCH_REPEAT           repeticiones por medición (default: 20)
+
+Imprime un único JSON (stdout) con los tiempos promedio en ms por tamaño de
+fragmento.
+"""
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'educaapp.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from material.ia_processor import count_tokens, _processor  # noqa: E402
+from material.views_document_processor import _split_into_chunks  # noqa: E402
+
+CHAPTER_TOKENS = int(os.environ.get('BENCH_CHAPTER_TOKENS', '45000'))
+REPEAT = int(os.environ.get('BENCH_REPEAT', '20'))
+FIXTURE_PATH = Path(__file__).parent / 'fixtures' / 'groq_test_content.txt'
+# 3000 = default; 600 = piso con el TPM más bajo del fallback compartido
+# (ver _chunking_budget), donde casi todo párrafo se parte por líneas.
+CHUNK_SIZES = (600, 1500, 3000)
+
+_PAGE_MARKER_RE = re.compile(r'\x00P(\d+)\x00')
+
+
+# ---- Implementación anterior (referencia) ----
+
+def _split_into_chunks_reference(content, max_tokens=3000):
+    raw_chunks = _split_into_chunks_raw_reference(content, max_tokens=max_tokens)
+    result = []
+    for raw in raw_chunks:
+        pages = sorted({int(p) for p in _PAGE_MARKER_RE.findall(raw)})
+        result.append({'text': _PAGE_MARKER_RE.sub('', raw).strip(), 'pages': pages})
+    return result
+
+
+def _split_into_chunks_raw_reference(content, max_tokens=3000):
+    total_tokens = count_tokens(content)
+    if total_tokens <= max_tokens:
+        return [content]
+
+    paragraphs = content.split('\n\n')
+    chunks = []
+    current_parts = []
+    current_tokens = 0
+
+    for para in paragraphs:
+        para_tokens = count_tokens(para)
+        if para_tokens > max_tokens:
+            if current_parts:
+                chunks.append('\n\n'.join(current_parts))
+                current_parts = []
+                current_tokens = 0
+            lines = para.split('\n')
+            for line in lines:
+                line_tokens = count_tokens(line)
+                if current_tokens + line_tokens > max_tokens and current_parts:
+                    chunks.append('\n'.join(current_parts))
+                    current_parts = [line]
+                    current_tokens = line_tokens
+                else:
+                    current_parts.append(line)
+                    current_tokens += line_tokens
+        elif current_tokens + para_tokens > max_tokens and current_parts:
+            chunks.append('\n\n'.join(current_parts))
+            current_parts = [para]
+            current_tokens = para_tokens
+        else:
+            current_parts.append(para)
+            current_tokens += para_tokens
+
+    if current_parts:
+        chunks.append('\n\n'.join(current_parts))
+
+    return chunks if chunks else [content]
+
+
+# ---- Capítulo de prueba ----
+
+def build_chapter(pdf_path=None):
+    if pdf_path:
+        import fitz
+        with fitz.open(pdf_path) as doc:
+            pages = [page.get_text().strip() for page in doc]
+    else:
+        text = FIXTURE_PATH.read_text(encoding='utf-8')
+        pages = [text] * (CHAPTER_TOKENS // max(1, count_tokens(text)) + 1)
+
+    parts = []
+    tokens = 0
+    for page_num, page_text in enumerate(pages, 1):
+        if tokens >= CHAPTER_TOKENS:
+            break
+        parts.append(f'\x00P{page_num}\x00{page_text}')
+        tokens += count_tokens(page_text)
+    chapter = '\n\n'.join(parts)
+
+    # Recortar al tamaño pedido exacto (en tokens).
+    encoding = _processor.encoding
+    return encoding.decode(encoding.encode(chapter)[:CHAPTER_TOKENS])
+
+
+def timed_ms(fn, *args, **kwargs):
+    fn(*args, **kwargs)  # calentar
+    t0 = time.perf_counter()
+    for _ in range(REPEAT):
+        fn(*args, **kwargs)
+    return round((time.perf_counter() - t0) / REPEAT * 1000, 2)
+
+
+def main():
+    pdf_path = sys.argv[1] if len(sys.argv) > 1 else None
+    chapter = build_chapter(pdf_path)
+
+    results = []
+    for max_tokens in CHUNK_SIZES:
+        same = _split_into_chunks(chapter, max_tokens) == _split_into_chunks_reference(chapter, max_tokens)
+        reference_ms = timed_ms(_split_into_chunks_reference, chapter, max_tokens)
+        current_ms = timed_ms(_split_into_chunks, chapter, max_tokens)
+        results.append({
+            'max_tokens': max_tokens,
+            'chunks': len(_split_into_chunks(chapter, max_tokens)),
+            'reference_ms': reference_ms,
+            'current_ms': current_ms,
+            'speedup': round(reference_ms / current_ms, 2) if current_ms else None,
+            'identical': same,
+        })
+
+    print(json.dumps({
+        'source': pdf_path or str(FIXTURE_PATH),
+        'chapter_tokens': count_tokens(chapter),
+        'chapter_chars': len(chapter),
+        'repeat': REPEAT,
+        'results': results,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Compara los dos detectores de páginas escaneadas de document_processor.py:
+
+- pdf-inspector (DocumentProcessor._detect_scanned_pages): abre y parsea el
+  archivo entero por su cuenta, aparte de PyMuPDF. Era el que se usaba en
+  cada extracción; hoy queda como verificación (CONTENIDO_VERIFY_SCANNED_PAGES).
+- PyMuPDF (DocumentProcessor._classify_scanned_pages): texto extraíble +
+  cobertura de imágenes, sobre el mismo fitz.Document de la extracción.
+
+Para cada PDF mide el tiempo de pared de cada uno y cuántas páginas
+clasifican igual. El tiempo de PyMuPDF incluye abrir el documento y leer el
+texto de las páginas cubiertas de imágenes — texto que en la extracción real
+no se vuelve a leer (ver iter_pdf_chapters), así que es una cota por arriba
+de lo que agrega de verdad.
+
+Uso:
+    python scripts/bench_scanned_detection.py [archivo.pdf ...]
+
+Sin argumentos usa los PDFs de ejemplo del repo (raíz y media/). Los que no
+se pueden abrir (ej. media/contenidos/test_wizard.pdf, que no es un PDF
+válido) se reportan con su error y no cuentan para el total.
+
+Variables de entorno:
+    BENCH_REPEAT   repeticiones por medición (default: 3)
+
+Imprime un único JSON (stdout).
+"""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import fitz  # noqa: E402
+
+from document_processor import DocumentProcessor  # noqa: E402
+
+REPEAT = int(os.environ.get('BENCH_REPEAT', '3'))
+
+
+def sample_pdfs():
+    return sorted(set(ROOT.glob('*.pdf')) | set((ROOT / 'media').rglob('*.pdf')))
+
+
+def timed_ms(fn, *args):
+    result = fn(*args)
+    t0 = time.perf_counter()
+    for _ in range(REPEAT):
+        fn(*args)
+    return result, round((time.perf_counter() - t0) / REPEAT * 1000, 2)
+
+
+def classify_with_fitz(processor, pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return processor._classify_scanned_pages(doc)
+
+
+def display_path(pdf_path):
+    return str(pdf_path.relative_to(ROOT)) if pdf_path.is_relative_to(ROOT) else str(pdf_path)
+
+
+def bench_file(processor, pdf_path):
+    try:
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+    except Exception as exc:
+        return {'file': display_path(pdf_path), 'error': str(exc)}
+
+    inspector_pages, inspector_ms = timed_ms(processor._detect_scanned_pages, str(pdf_path))
+    fitz_pages, fitz_ms = timed_ms(classify_with_fitz, processor, str(pdf_path))
+
+    inspector_set = set(inspector_pages)
+    fitz_set = set(fitz_pages)
+    disagree = sorted(inspector_set ^ fitz_set)
+    return {
+        'file': display_path(pdf_path),
+        'pages': page_count,
+        'pdf_inspector_ms': inspector_ms,
+        'fitz_ms': fitz_ms,
+        'pdf_inspector_scanned': sorted(inspector_set),
+        'fitz_scanned': sorted(fitz_set),
+        'agreeing_pages': page_count - len(disagree),
+        'disagreeing_pages': disagree,
+    }
+
+
+def main():
+    paths = [Path(p).resolve() for p in sys.argv[1:]] or sample_pdfs()
+    processor = DocumentProcessor()
+    files = [bench_file(processor, path) for path in paths]
+
+    measured = [f for f in files if 'error' not in f]
+    total_pages = sum(f['pages'] for f in measured)
+    agreeing = sum(f['agreeing_pages'] for f in measured)
+    inspector_ms = sum(f['pdf_inspector_ms'] for f in measured)
+    fitz_ms = sum(f['fitz_ms'] for f in measured)
+
+    print(json.dumps({
+        'repeat': REPEAT,
+        'files': files,
+        'total': {
+            'files': len(measured),
+            'pages': total_pages,
+            'pdf_inspector_ms': round(inspector_ms, 2),
+            'fitz_ms': round(fitz_ms, 2),
+            'speedup': round(inspector_ms / fitz_ms, 2) if fitz_ms else None,
+            'agreement_rate': round(agreeing / total_pages, 4) if total_pages else None,
+        },
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()